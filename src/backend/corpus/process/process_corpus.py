@@ -1,10 +1,17 @@
+from collections import deque
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
 
 from tqdm import tqdm
 
 from backend.corpus.items import MetaType, TextCategory
-from backend.db.db import DatabaseManager
+from backend.db.db import (
+    AGG_META_PROPERTY,
+    AGG_SUBFOLDER,
+    AGG_TEXT_CATEGORY,
+    AGG_TOTAL,
+    DatabaseManager,
+)
 from backend.corpus.process.process_cha import process_cha_file
 from backend.project.config import CorpusConfig
 from backend.corpus.process.process_doc import (
@@ -12,6 +19,8 @@ from backend.corpus.process.process_doc import (
     get_doc_level_meta_props,
     get_sents_from_doc,
 )
+from backend.nlp_models.ner import SENT_CHUNK_SIZE, NERModel
+from backend.nlp_models.runtime import RuntimeConfig, available_cores
 from backend.nlp_models.semantic import SemanticModel
 from backend.utils.functions import is_quant
 from backend.utils.nlp import SpacyModel
@@ -24,9 +33,36 @@ class CorpusProcessor:
     associated text, meta categories, and subfolders.
     """
 
-    def __init__(self, config: CorpusConfig, db: DatabaseManager) -> None:
+    def __init__(
+        self,
+        config: CorpusConfig,
+        db: DatabaseManager,
+        runtime: RuntimeConfig | None = None,
+        annotate: bool = False,
+        spacy_processes: int = 1,
+        extract_entities: bool = False,
+    ) -> None:
+        """
+        Args:
+            config (CorpusConfig)
+            db (DatabaseManager)
+            runtime (RuntimeConfig | None, optional): Runtime of the
+                embedding model. Defaults to None.
+            annotate (bool, optional): Whether to store the annotations of
+                each word token (see AnnotationStore). Defaults to False.
+            spacy_processes (int, optional): spaCy processes for tokenizing
+                and annotating sentences (0 for the number of cores).
+                Defaults to 1.
+            extract_entities (bool, optional): Whether to store the named
+                entities of each sentence in the entities table. Defaults to
+                False.
+        """
         self.config = config
         self.db = db
+        self.runtime = runtime
+        self.annotate = annotate
+        self.spacy_processes = spacy_processes or available_cores()
+        self.extract_entities = extract_entities
         self.corpus_path = config.corpus_path
         self.included_extensions = config.included_extensions
         self.ignored_extensions = config.ignored_extensions
@@ -58,20 +94,32 @@ class CorpusProcessor:
         files = list(self.corpus_path.rglob("*"))  # type: ignore
         if frontend_connect:
             frontend_connect.taskInfo.emit("Processing files", len(files))
-        for f in tqdm(files, desc="Processing files"):
-            if f.is_file() and self.file_ext_filter(f):
-                self.process_file(f)
-            if frontend_connect:
-                frontend_connect.increment.emit()
+
+        def iter_file_ds():
+            for f in tqdm(files, desc="Processing files"):
+                if f.is_file() and self.file_ext_filter(f):
+                    file_d = self.read_file(f)
+                    if file_d is not None:
+                        yield file_d
+                if frontend_connect:
+                    frontend_connect.increment.emit()
+
+        for file_d in self.tokenize_files(iter_file_ds()):
+            self.db.insert_file_entry(file_d)
 
         if add_embeddings:
             self.add_embeddings()
+        if self.extract_entities:
+            self.add_entities(frontend_connect=frontend_connect)
 
         self.get_text_categories()
         self.get_word_count_and_meta_prop_info(frontend_connect=frontend_connect)
 
-    def process_file(self, file_path: Path) -> None:
-        """.cha files handled separately."""
+    def read_file(self, file_path: Path) -> dict[str, Any] | None:
+        """
+        Returns the file_d of a file, with its sentences not yet tokenized,
+        or None if it couldn't be read. .cha files handled separately.
+        """
         file_type = file_path.suffix
 
         if file_type == ".cha":
@@ -108,17 +156,75 @@ class CorpusProcessor:
 
         if file_d.get("error"):
             # Log errors here.
-            pass
-        else:
-            file_d["subfolders"] = self.config.get_subfolder_names_for_path(file_path)
-            self.db.insert_file_entry(file_d)
+            return None
+        file_d["subfolders"] = self.config.get_subfolder_names_for_path(file_path)
+        return file_d
+
+    def tokenize_files(
+        self, file_ds: Iterable[dict[str, Any]]
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Tokenizes the sentences of file_ds (and stores their annotations, if
+        annotate is set), yielding each file_d once all of its sentences are
+        done. The sentences of all files go through one SpacyModel.tokenize,
+        so batches and chunks sent to worker processes span files.
+        """
+        # [file_d, sentences not yet done] of the files read by the pipe, in
+        # order
+        pending = deque()
+        # (sent_d, its file's entry in pending) of the sentences sent to the
+        # pipe, in order. Kept here rather than sent to the worker processes
+        # with the sentences.
+        queued = deque()
+
+        def iter_sentences():
+            for file_d in file_ds:
+                entry = [file_d, len(file_d["sent_dicts"])]
+                pending.append(entry)
+                for sent_d in file_d["sent_dicts"]:
+                    queued.append((sent_d, entry))
+                    yield sent_d["sentence"]
+
+        results = self.spacy_model.tokenize(
+            iter_sentences(), annotate=self.annotate, n_process=self.spacy_processes
+        )
+        for words, annotations in results:
+            sent_d, entry = queued.popleft()
+            # Tokenized once here; tasks use the stored token ids
+            sent_d["tokens"] = words
+            sent_d["word_count"] = len(words)
+            if self.annotate:
+                sent_d["annotations"] = annotations
+            entry[1] -= 1
+            while pending and not pending[0][1]:
+                yield pending.popleft()[0]
+        # Files without sentences after the last sentence
+        while pending:
+            yield pending.popleft()[0]
 
     def add_embeddings(self):
-        s_model = SemanticModel()
+        s_model = SemanticModel(runtime=self.runtime)
         sents = self.db.get_all_sents(sents_only=True)
         s_model.encode_sents(sents)  # type: ignore
         self.db.add_embeddings(s_model.sent_embeds)  # type: ignore
 
+    def add_entities(self, frontend_connect: Any = None) -> None:
+        """
+        Runs NER once over all sentences (on the configured runtime) and
+        stores the entities, so NER counts and entity filters are queries.
+        """
+        ner_model = NERModel(self.runtime)
+        n_sents = len(self.db.get_sent_ids())
+        batches = self.db.iter_sent_batches(
+            columns=(), batch_size=SENT_CHUNK_SIZE, ordered=True
+        )
+        for rows in ner_model.iter_entity_rows(
+            batches,
+            frontend_connect=frontend_connect,
+            n_batches=-(-n_sents // SENT_CHUNK_SIZE),
+        ):
+            self.db.insert_entities(rows)
+
     def get_text_categories(self) -> None:
         self.config.text_categories = {}
         text_labels = self.config.get_text_labels()
@@ -169,17 +275,16 @@ class CorpusProcessor:
         }
 
     def get_word_count_and_meta_prop_info(self, frontend_connect: Any) -> None:
+        """
+        Reads meta property values and sentence/word counts from the
+        aggregate counts built up while files were inserted.
+        """
         # Meta prop info
         meta_prop_values = {}
 
-        results = self.db.get_all_sents()
-        for filename, meta_prop_refs in results["meta_properties"].items():  # type: ignore
-            for meta_prop_ref in meta_prop_refs:
-                label_name = meta_prop_ref["label_name"]
-                name = meta_prop_ref["name"]
-                value = meta_prop_ref["value"]
-                meta_prop_values.setdefault((label_name, name), set())
-                meta_prop_values[(label_name, name)].add(value)
+        for label_name, name, value in self.db.get_aggregate_counts(AGG_META_PROPERTY):
+            meta_prop_values.setdefault((label_name, name), set())
+            meta_prop_values[(label_name, name)].add(value)
 
         for (label_name, name), values in meta_prop_values.items():
             value_info = self.get_meta_prop_value_info(values)
@@ -198,42 +303,20 @@ class CorpusProcessor:
             meta_prop.cat_values = value_info["cat_values"]
 
         # Sent and word counts for whole corpus, subfolders and text categories
-        sent_and_word_counts = {
-            "total": {"sent_count": 0, "word_count": 0},
-            "text_categories": {
-                name: {"sent_count": 0, "word_count": 0}
-                for name in self.config.text_categories
-            },
-            "subfolders": {
-                subfolder: {"sent_count": 0, "word_count": 0}
-                for subfolder in self.config.subfolders
-            },
-        }
-        if frontend_connect:
-            frontend_connect.taskInfo.emit("Getting counts", len(results["sent_dicts"]))  # type: ignore
-        for sent_dict in results["sent_dicts"]:  # type: ignore
-            if frontend_connect:
-                frontend_connect.increment.emit()
-            sent = sent_dict["sentence"]
-            word_count = self.spacy_model.word_count(sent)
-            sent_and_word_counts["total"]["sent_count"] += 1
-            sent_and_word_counts["total"]["word_count"] += word_count
-            for text_category in sent_dict["text_categories"]:
-                sent_and_word_counts["text_categories"][text_category][
-                    "sent_count"
-                ] += 1
-                sent_and_word_counts["text_categories"][text_category][
-                    "word_count"
-                ] += word_count
-            for subfolder, d in sent_and_word_counts["subfolders"].items():
-                if subfolder in sent_dict["file_path"].parents:
-                    d["sent_count"] += 1
-                    d["word_count"] += word_count
-        self.config.summary["sent_count"] = sent_and_word_counts["total"]["sent_count"]
-        self.config.summary["word_count"] = sent_and_word_counts["total"]["word_count"]
-        for text_category, d in sent_and_word_counts["text_categories"].items():
-            self.config.text_categories[text_category].sent_count = d["sent_count"]
-            self.config.text_categories[text_category].word_count = d["word_count"]
-        for subfolder, d in sent_and_word_counts["subfolders"].items():
-            self.config.subfolders[subfolder].sent_count = d["sent_count"]
-            self.config.subfolders[subfolder].word_count = d["word_count"]
+        empty_counts = {"sent_count": 0, "word_count": 0}
+        total_counts = self.db.get_aggregate_counts(AGG_TOTAL)
+        total_counts = total_counts.get(AGG_TOTAL, empty_counts)
+        self.config.summary["sent_count"] = total_counts["sent_count"]
+        self.config.summary["word_count"] = total_counts["word_count"]
+
+        text_category_counts = self.db.get_aggregate_counts(AGG_TEXT_CATEGORY)
+        for name, text_category in self.config.text_categories.items():
+            d = text_category_counts.get(name, empty_counts)
+            text_category.sent_count = d["sent_count"]
+            text_category.word_count = d["word_count"]
+
+        subfolder_counts = self.db.get_aggregate_counts(AGG_SUBFOLDER)
+        for subfolder in self.config.subfolders.values():
+            d = subfolder_counts.get(subfolder.name, empty_counts)
+            subfolder.sent_count = d["sent_count"]
+            subfolder.word_count = d["word_count"]
@@ -0,0 +1,82 @@
+"""
+Token annotations (POS, dependency label and head, morphology and lemma)
+stored at ingest, one record per word token, aligned with the token ids.
+
+Labels are interned in a table per field, so a token's annotations are a
+fixed-size record of ids (see ANNOTATION_DTYPE).
+"""
+
+from typing import Any, Iterable
+
+import numpy as np
+
+from backend.db.vocab import Vocabulary
+
+# Interned fields, in table order
+ANNOTATION_FIELDS = ("pos", "dep", "morph", "lemma")
+# head is the position of the token's head among the sentence's word tokens
+# (its own position for the root), or -1 if the head isn't a word token
+ANNOTATION_DTYPE = np.dtype(
+    [
+        ("pos", np.uint8),
+        ("dep", np.uint8),
+        ("head", np.int16),
+        ("morph", np.int32),
+        ("lemma", np.int32),
+    ]
+)
+
+
+class AnnotationTables:
+    """Label table (a Vocabulary) of each interned annotation field."""
+
+    def __init__(self, labels: dict[str, Iterable[str]] | None = None) -> None:
+        labels = labels or {}
+        self.tables = {
+            field: Vocabulary(labels.get(field, ())) for field in ANNOTATION_FIELDS
+        }
+
+    def __getitem__(self, field: str) -> Vocabulary:
+        if field not in self.tables:
+            raise ValueError(f"Unknown annotation field: {field}")
+        return self.tables[field]
+
+    def sizes(self) -> dict[str, int]:
+        return {field: len(table) for field, table in self.tables.items()}
+
+    def labels(self) -> dict[str, list[str]]:
+        return {field: table.tokens for field, table in self.tables.items()}
+
+    def encode(self, annotations: dict[str, list[Any]]) -> np.ndarray:
+        """
+        Records (ANNOTATION_DTYPE) of a sentence's word tokens, adding unknown
+        labels to the tables.
+
+        Args:
+            annotations (dict[str, list[Any]]): List of labels for each field
+                of ANNOTATION_FIELDS, and "head" (see
+                SpacyModel.annotations).
+        """
+        records = np.zeros(len(annotations["head"]), dtype=ANNOTATION_DTYPE)
+        for field in ANNOTATION_FIELDS:
+            records[field] = self.tables[field].encode(annotations[field])
+        for field in ("pos", "dep"):
+            if len(self.tables[field]) > 256:
+                raise ValueError(f"Too many {field} labels for uint8 ids")
+        heads = np.asarray(annotations["head"], dtype=np.int64)
+        heads[heads > np.iinfo(np.int16).max] = -1
+        records["head"] = heads
+        return records
+
+    def label_mask(self, field: str, labels: str | Iterable[str]) -> np.ndarray:
+        """
+        Mask over field's table of the given labels. For morph, labels are
+        features (e.g. "Tense=Past"), matching every morphology that has them.
+        """
+        labels = {labels} if isinstance(labels, str) else set(labels)
+        table = self[field].tokens
+        if field == "morph":
+            return np.array(
+                [labels <= set(morph.split("|")) for morph in table], dtype=bool
+            )
+        return np.array([label in labels for label in table], dtype=bool)
@@ -0,0 +1,251 @@
+"""
+Columnar batch of sentences, used instead of lists of sent_dicts.
+
+Columns are parallel arrays indexed by position in the batch. File paths and
+text categories are interned: each batch has a table of distinct values and
+the rows store indices into it (text categories in CSR form, since a
+sentence can have any number of them). Token ids are also stored in CSR form,
+as one flat array with offsets.
+"""
+
+from dataclasses import dataclass
+from itertools import chain
+from typing import Any, Iterable, Iterator
+
+import numpy as np
+
+from backend.db.vocab import Vocabulary
+from backend.utils.functions import iter_chunks
+
+
+@dataclass
+class SentenceBatch:
+    # Sentence ids (int64), -1 for sentences not from the database
+    ids: np.ndarray
+    sentences: list[str]
+    # Distinct file paths and index of each sentence's path (int32, -1 if none)
+    file_table: list[str] | None = None
+    file_index: np.ndarray | None = None
+    # Distinct text categories. The categories of sentence i are
+    # category_table[category_index[category_offsets[i]:category_offsets[i + 1]]]
+    category_table: list[str] | None = None
+    category_offsets: np.ndarray | None = None
+    category_index: np.ndarray | None = None
+    word_counts: np.ndarray | None = None
+    # group_id column of the sentences table (int64, -1 if null)
+    group_ids: np.ndarray | None = None
+    # (n sentences x embedding size), float32
+    embeddings: np.ndarray | None = None
+    sent_tiers: list[dict[str, str]] | None = None
+    # Token ids (int32) of all sentences. The tokens of sentence i are
+    # tokens[token_offsets[i]:token_offsets[i + 1]] (int64 offsets), and
+    # their strings are in vocabulary.
+    tokens: np.ndarray | None = None
+    token_offsets: np.ndarray | None = None
+    vocabulary: Vocabulary | None = None
+    # Group membership (n sentences x n groups), bool. Set for batches from a
+    # grouped selection (see GroupedSelection); None means a single group.
+    groups: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    @property
+    def n_groups(self) -> int:
+        return 1 if self.groups is None else self.groups.shape[1]
+
+    def group_masks(self) -> np.ndarray:
+        """Group membership, with a single all-True column if not grouped."""
+        if self.groups is None:
+            return np.ones((len(self), 1), dtype=bool)
+        return self.groups
+
+    def iter_groups(self) -> Iterator[np.ndarray]:
+        """Yields the group indices of each sentence."""
+        for row in self.group_masks():
+            yield np.flatnonzero(row)
+
+    def file_path(self, i: int) -> str | None:
+        if self.file_table is None or self.file_index[i] < 0:  # type: ignore
+            return None
+        return self.file_table[self.file_index[i]]  # type: ignore
+
+    def text_categories(self, i: int) -> list[str]:
+        if self.category_table is None:
+            return []
+        start, end = self.category_offsets[i : i + 2]  # type: ignore
+        return [self.category_table[j] for j in self.category_index[start:end]]  # type: ignore
+
+    def token_ids(self, i: int) -> np.ndarray:
+        return self.tokens[self.token_offsets[i] : self.token_offsets[i + 1]]  # type: ignore
+
+    def token_lengths(self) -> np.ndarray:
+        return np.diff(self.token_offsets)  # type: ignore
+
+    def set_tokens(
+        self, token_ids_l: list[np.ndarray], vocabulary: Vocabulary
+    ) -> "SentenceBatch":
+        """Sets the token ids of each sentence."""
+        self.token_offsets = np.zeros(len(token_ids_l) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in token_ids_l], out=self.token_offsets[1:])
+        if token_ids_l:
+            self.tokens = np.concatenate(token_ids_l).astype(np.int32, copy=False)
+        else:
+            self.tokens = np.empty(0, dtype=np.int32)
+        self.vocabulary = vocabulary
+        return self
+
+    def records(self) -> Iterator[dict[str, Any]]:
+        """Yields a sent_dict for each sentence, with the available columns."""
+        for i, sentence in enumerate(self.sentences):
+            record = {"id": int(self.ids[i]), "sentence": sentence}
+            if self.file_table is not None:
+                record["file_path"] = self.file_path(i)
+            if self.category_table is not None:
+                record["text_categories"] = self.text_categories(i)
+            if self.word_counts is not None:
+                record["word_count"] = int(self.word_counts[i])
+            if self.group_ids is not None:
+                group_id = int(self.group_ids[i])
+                record["group_id"] = None if group_id < 0 else group_id
+            if self.embeddings is not None:
+                record["embedding"] = self.embeddings[i]
+            if self.sent_tiers is not None:
+                record["sent_tiers"] = self.sent_tiers[i]
+            if self.tokens is not None and self.vocabulary is not None:
+                record["tokens"] = self.vocabulary.decode(self.token_ids(i))
+            yield record
+
+    def with_groups(self, groups: np.ndarray) -> "SentenceBatch":
+        self.groups = groups
+        return self
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict[str, Any] | str]) -> "SentenceBatch":
+        """Builds a batch from sent_dicts (or plain sentences)."""
+        records = [{"sentence": r} if isinstance(r, str) else r for r in records]
+        batch = cls(
+            ids=np.array([r.get("id", -1) for r in records], dtype=np.int64),
+            sentences=[r["sentence"] for r in records],
+        )
+        if records and "file_path" in records[0]:
+            batch.file_table, batch.file_index = intern(
+                None if r["file_path"] is None else str(r["file_path"]) for r in records
+            )
+        if records and "text_categories" in records[0]:
+            (
+                batch.category_table,
+                batch.category_offsets,
+                batch.category_index,
+            ) = intern_lists(r["text_categories"] for r in records)
+        if records and "word_count" in records[0]:
+            batch.word_counts = np.array(
+                [r["word_count"] or 0 for r in records], dtype=np.int32
+            )
+        if records and "group_id" in records[0]:
+            batch.group_ids = np.array(
+                [-1 if r["group_id"] is None else r["group_id"] for r in records],
+                dtype=np.int64,
+            )
+        if records and records[0].get("embedding") is not None:
+            batch.embeddings = np.array(
+                [r["embedding"] for r in records], dtype=np.float32
+            )
+        if records and "sent_tiers" in records[0]:
+            batch.sent_tiers = [r["sent_tiers"] for r in records]
+        return batch
+
+    @classmethod
+    def concat(cls, batches: Iterable["SentenceBatch"]) -> "SentenceBatch":
+        """Concatenates batches with the same columns into one batch."""
+        batches = list(batches)
+        if not batches:
+            return cls(ids=np.empty(0, dtype=np.int64), sentences=[])
+        first = batches[0]
+        batch = cls(
+            ids=np.concatenate([b.ids for b in batches]),
+            sentences=[s for b in batches for s in b.sentences],
+        )
+        if first.file_table is not None:
+            batch.file_table, batch.file_index = intern(
+                b.file_path(i) for b in batches for i in range(len(b))
+            )
+        if first.category_table is not None:
+            (
+                batch.category_table,
+                batch.category_offsets,
+                batch.category_index,
+            ) = intern_lists(
+                b.text_categories(i) for b in batches for i in range(len(b))
+            )
+        if first.word_counts is not None:
+            batch.word_counts = np.concatenate([b.word_counts for b in batches])  # type: ignore
+        if first.group_ids is not None:
+            batch.group_ids = np.concatenate([b.group_ids for b in batches])  # type: ignore
+        if all(b.embeddings is not None for b in batches):
+            batch.embeddings = np.concatenate([b.embeddings for b in batches])  # type: ignore
+        if first.sent_tiers is not None:
+            batch.sent_tiers = [t for b in batches for t in b.sent_tiers]  # type: ignore
+        batch.vocabulary = first.vocabulary
+        if first.tokens is not None:
+            batch.set_tokens(
+                [b.token_ids(i) for b in batches for i in range(len(b))],
+                first.vocabulary,  # type: ignore
+            )
+        if first.groups is not None:
+            batch.groups = np.concatenate([b.groups for b in batches])  # type: ignore
+        return batch
+
+
+def intern(values: Iterable[str | None]) -> tuple[list[str], np.ndarray]:
+    """Returns (distinct values, index of each value), with -1 for None."""
+    table = {}
+    index = [
+        -1 if value is None else table.setdefault(value, len(table)) for value in values
+    ]
+    return list(table), np.array(index, dtype=np.int32)
+
+
+def intern_lists(
+    value_lists: Iterable[list[str]],
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Returns (distinct values, offsets, flat indices) in CSR form."""
+    table = {}
+    offsets = [0]
+    index = []
+    for values in value_lists:
+        index.extend(table.setdefault(value, len(table)) for value in values)
+        offsets.append(len(index))
+    return (
+        list(table),
+        np.array(offsets, dtype=np.int32),
+        np.array(index, dtype=np.int32),
+    )
+
+
+# Sentences in any of the forms accepted by iter_batches
+SentenceData = SentenceBatch | Iterable[SentenceBatch] | Iterable[dict[str, Any] | str]
+
+
+def iter_batches(
+    data: SentenceData,
+    batch_size: int = 1000,
+) -> Iterator[SentenceBatch]:
+    """
+    Yields SentenceBatches from a batch, an iterable of batches, or an
+    iterable of sent_dicts/sentences (which are batched batch_size at a time).
+    """
+    if isinstance(data, SentenceBatch):
+        yield data
+        return
+    items = iter(data)
+    for first in items:
+        break
+    else:
+        return
+    items = chain([first], items)
+    if isinstance(first, SentenceBatch):
+        yield from items  # type: ignore
+    else:
+        for chunk in iter_chunks(items, batch_size):
+            yield SentenceBatch.from_records(chunk)  # type: ignore
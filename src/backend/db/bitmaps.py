@@ -0,0 +1,216 @@
+"""
+Bitmap index over sentence ids for resolving corpus selections without SQL.
+
+A packed bitset (np.packbits over a bool array indexed by sentence id) is
+stored for every subfolder, text category and categorical meta property
+value. Quantitative meta properties are stored as float64 arrays indexed by
+sentence id (NaN where missing), so min/max filters are a vectorized
+comparison. Selections are resolved with AND/OR/NOT over the bitsets.
+"""
+
+import json
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from backend.db.db import (
+    AGG_META_PROPERTY,
+    AGG_SUBFOLDER,
+    AGG_TEXT_CATEGORY,
+    DatabaseManager,
+)
+
+ALL_SENTS = "all"
+
+
+def _key(*parts: str) -> str:
+    return "\x1f".join(parts)
+
+
+class BitmapIndex:
+    def __init__(
+        self,
+        size: int,
+        bitmaps: dict[str, np.ndarray],
+        numeric: dict[str, np.ndarray],
+        non_numeric: set[str] | None = None,
+    ) -> None:
+        # Max sentence id + 1
+        self.size = size
+        # Packed bitsets (uint8)
+        self.bitmaps = bitmaps
+        # Quantitative meta property values (float64)
+        self.numeric = numeric
+        # Keys of quantitative meta properties that aren't indexed (some of
+        # their values aren't numbers). Filters on these fall back to SQL.
+        self.non_numeric = non_numeric or set()
+
+    @classmethod
+    def build(
+        cls, db: DatabaseManager, quantitative: set[tuple[str, str]]
+    ) -> "BitmapIndex":
+        """
+        Args:
+            db (DatabaseManager)
+            quantitative (set[tuple[str, str]]): (label_name, name) of
+                quantitative meta properties.
+        """
+        size = db.get_max_sent_id() + 1
+        bitmaps = {}
+        numeric = {}
+        non_numeric = set()
+
+        def pack(ids: np.ndarray) -> np.ndarray:
+            mask = np.zeros(size, dtype=bool)
+            mask[ids] = True
+            return np.packbits(mask)
+
+        bitmaps[_key(ALL_SENTS)] = pack(db.get_sent_ids())
+        for kind in (AGG_SUBFOLDER, AGG_TEXT_CATEGORY):
+            for (name,), ids in db.iter_group_sent_ids(kind):
+                bitmaps[_key(kind, name)] = pack(ids)
+        for (label_name, name, value), ids in db.iter_group_sent_ids(AGG_META_PROPERTY):
+            if (label_name, name) not in quantitative:
+                bitmaps[_key(AGG_META_PROPERTY, label_name, name, value)] = pack(ids)
+                continue
+            key = _key(AGG_META_PROPERTY, label_name, name)
+            try:
+                number = float(value)
+            except ValueError:
+                # e.g. dates; filters on these fall back to SQL
+                non_numeric.add(key)
+                continue
+            if key not in numeric:
+                numeric[key] = np.full(size, np.nan, dtype=np.float64)
+            numeric[key][ids] = number
+        for key in non_numeric:
+            numeric.pop(key, None)
+        return cls(size, bitmaps, numeric, non_numeric)
+
+    def save(self, path: Path) -> None:
+        keys = {
+            "bitmaps": list(self.bitmaps),
+            "numeric": list(self.numeric),
+            "non_numeric": sorted(self.non_numeric),
+        }
+        arrays = {f"b{i}": a for i, a in enumerate(self.bitmaps.values())}
+        arrays.update({f"n{i}": a for i, a in enumerate(self.numeric.values())})
+        with path.open("wb") as f:
+            np.savez_compressed(
+                f, keys=np.array(json.dumps(keys)), size=self.size, **arrays
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> "BitmapIndex":
+        with np.load(path) as data:
+            keys = json.loads(str(data["keys"]))
+            bitmaps = {k: data[f"b{i}"] for i, k in enumerate(keys["bitmaps"])}
+            numeric = {k: data[f"n{i}"] for i, k in enumerate(keys["numeric"])}
+            non_numeric = set(keys.get("non_numeric", []))
+            # Values saved as float32 by older versions are too imprecise to
+            # compare, so filters on them fall back to SQL
+            non_numeric.update(k for k, a in numeric.items() if a.dtype != np.float64)
+            numeric = {k: a for k, a in numeric.items() if k not in non_numeric}
+            return cls(int(data["size"]), bitmaps, numeric, non_numeric)
+
+    # Set operations on packed bitsets
+
+    def empty(self) -> np.ndarray:
+        return np.zeros_like(self.bitmaps[_key(ALL_SENTS)])
+
+    def union(self, *bitmaps: np.ndarray) -> np.ndarray:
+        return np.bitwise_or.reduce(bitmaps) if bitmaps else self.empty()
+
+    def intersect(self, *bitmaps: np.ndarray) -> np.ndarray:
+        if not bitmaps:
+            return self.bitmaps[_key(ALL_SENTS)]
+        return np.bitwise_and.reduce(bitmaps)
+
+    def negate(self, bitmap: np.ndarray) -> np.ndarray:
+        # Restricted to existing sentences (also clears the padding bits)
+        return np.bitwise_and(np.invert(bitmap), self.bitmaps[_key(ALL_SENTS)])
+
+    def to_ids(self, bitmap: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.size)).astype(np.int64)
+
+    def from_ids(self, ids: np.ndarray) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        ids = np.asarray(ids, dtype=np.int64)
+        mask[ids[ids < self.size]] = True
+        return np.packbits(mask)
+
+    # Selections
+
+    def get(self, kind: str, *parts: str) -> np.ndarray:
+        """Bitset for a group, empty if the group doesn't exist."""
+        bitmap = self.bitmaps.get(_key(kind, *parts))
+        return self.empty() if bitmap is None else bitmap
+
+    def _resolve_meta_filter(self, meta_filter: dict[str, Any]) -> np.ndarray | None:
+        label_name = meta_filter.get("label_name")
+        name = meta_filter.get("name")
+        if not (label_name and name):
+            return None
+        value = meta_filter.get("value")
+        min_value = meta_filter.get("min")
+        max_value = meta_filter.get("max")
+        key = _key(AGG_META_PROPERTY, label_name, name)
+        if key in self.non_numeric:
+            return None
+        values = self.numeric.get(key)
+
+        if values is not None:
+            mask = ~np.isnan(values)
+            try:
+                if value is not None:
+                    mask &= values == float(value)
+                if min_value is not None:
+                    mask &= values >= float(min_value)
+                if max_value is not None:
+                    mask &= values <= float(max_value)
+            except (TypeError, ValueError):
+                return None
+            return np.packbits(mask)
+
+        if min_value is not None or max_value is not None:
+            return None
+        prefix = _key(AGG_META_PROPERTY, label_name, name, "")
+        matching = [b for k, b in self.bitmaps.items() if k.startswith(prefix)]
+        if not matching:
+            # Property not indexed (e.g. added after the index was built)
+            return None
+        if value is not None:
+            # Empty if no sentence has the value
+            return self.get(AGG_META_PROPERTY, label_name, name, str(value))
+        return self.union(*matching)
+
+    def resolve(self, selection: dict[str, Any]) -> np.ndarray | None:
+        """
+        Resolves a selection dict (as passed to DatabaseManager.get_sents)
+        to sorted sentence ids. The names in subfolders and in
+        text_categories are ORed; meta_properties filters and different keys
+        are ANDed. Returns None if the selection can't be answered from the
+        index, in which case the caller should fall back to SQL.
+        """
+        parts = []
+        for key, value in selection.items():
+            if key == "ids":
+                parts.append(self.from_ids(value))
+                continue
+            if not value:
+                continue
+            if key in ("subfolders", "text_categories"):
+                kind = AGG_SUBFOLDER if key == "subfolders" else AGG_TEXT_CATEGORY
+                names = [value] if isinstance(value, str) else value
+                parts.append(self.union(*(self.get(kind, n) for n in names)))
+            elif key == "meta_properties":
+                filters = [value] if isinstance(value, dict) else value
+                for meta_filter in filters:
+                    bitmap = self._resolve_meta_filter(meta_filter)
+                    if bitmap is None:
+                        return None
+                    parts.append(bitmap)
+            else:
+                return None
+        return self.to_ids(self.intersect(*parts))
@@ -0,0 +1,92 @@
+"""LRU cache of corpus selection results (sentence id arrays)."""
+
+from collections import OrderedDict
+import json
+from typing import Any
+
+import numpy as np
+
+
+def canonicalize_selection(selection: dict[str, Any]) -> str:
+    """
+    Returns a string key for a selection dict (as passed to
+    DatabaseManager.get_sents) that doesn't depend on key/filter order or on
+    whether single values are given as strings or lists.
+    """
+    canonical = {}
+    for key, value in selection.items():
+        # Id filters come from earlier lookups and aren't cached
+        if key == "ids" or not value:
+            continue
+        if key in ("meta_properties", "entities"):
+            filters = [value] if isinstance(value, dict) else value
+            value = sorted(
+                json.dumps(
+                    {k: v for k, v in f.items() if k != "meta_prop"},
+                    sort_keys=True,
+                    default=str,
+                )
+                for f in filters
+            )
+        elif isinstance(value, (str, int, float)):
+            value = [str(value)]
+        else:
+            value = sorted(str(v) for v in value)
+        canonical[key] = value
+    return json.dumps(canonical, sort_keys=True)
+
+
+class SelectionCache:
+    """
+    Least-recently-used cache of sentence id arrays keyed by canonicalized
+    selection and the corpus database generation, which is bumped whenever
+    the corpus is (re)processed so stale entries are never returned.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, int], np.ndarray] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, selection: dict[str, Any], generation: int) -> np.ndarray | None:
+        key = (canonicalize_selection(selection), generation)
+        ids = self.entries.get(key)
+        if ids is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return ids
+
+    def put(self, selection: dict[str, Any], generation: int, ids: np.ndarray) -> None:
+        if ids.nbytes > self.max_bytes:
+            return
+        key = (canonicalize_selection(selection), generation)
+        if key in self.entries:
+            self.size -= self.entries.pop(key).nbytes
+        # Cached arrays are shared between callers
+        ids.setflags(write=False)
+        self.entries[key] = ids
+        self.size += ids.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
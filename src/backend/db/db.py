@@ -1,37 +1,137 @@
+from contextlib import ExitStack, contextmanager
+from itertools import count, groupby
+import json
+import os
 import sqlite3
 import numpy as np
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
 import pickle
 
+from backend.db.annotations import AnnotationTables
+from backend.db.batch import SentenceBatch, intern, intern_lists
+from backend.db.vocab import Vocabulary
+from backend.utils.functions import iter_chunks
+
+# Value lists longer than this are loaded into a temporary table and joined
+# instead of being inlined as IN (?, ?, ...) parameters.
+MAX_INLINE_PARAMS = 64
+# Sentence ids per query when streaming a selection by id. Each chunk is a
+# range (if its ids are consecutive) or an inlined IN list, within SQLite's
+# default limit of 999 parameters, so no temp table is written.
+ID_CHUNK_SIZE = 500
+
+# Column expressions available to iter_sents. Text categories and tiers are
+# aggregated in SQL so records can be built without per-row queries.
+SENT_RECORD_COLUMNS = {
+    "id": "s.id",
+    "sentence": "s.sentence",
+    "file_path": "s.file_path",
+    "embedding": "s.embedding",
+    "group_id": "s.group_id",
+    "word_count": "s.word_count",
+    "tokens": "s.token_ids",
+    "text_categories": """(
+        SELECT group_concat(tc_.name, char(31)) FROM text_categories tc_
+        WHERE tc_.sentence_id = s.id
+    )""",
+    "sent_tiers": """(
+        SELECT json_group_object(st_.name, st_.tier) FROM sent_tiers st_
+        WHERE st_.sentence_id = s.id
+    )""",
+}
+
+
+def normalize_entity(text: str) -> str:
+    """Entity text as matched by entity filters (case and spacing folded)."""
+    return " ".join(text.split()).casefold()
+
+
+# Kinds of groups in the aggregate_counts table
+AGG_TOTAL = "total"
+AGG_SUBFOLDER = "subfolder"
+AGG_TEXT_CATEGORY = "text_category"
+AGG_META_PROPERTY = "meta_property"
+
+
+def _is_number(value: Any) -> bool:
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _sum_word_counts(word_counts: Iterable[int | None]) -> int | None:
+    """Total of word counts, None if any of them is unknown."""
+    word_counts = list(word_counts)
+    if any(word_count is None for word_count in word_counts):
+        return None
+    return sum(word_counts)  # type: ignore
+
+
+def _bin_groups(
+    groups: list[tuple[Any, np.ndarray, int | None]], numbers: list[float], bins: int
+) -> list[tuple[float, np.ndarray, int | None]]:
+    """Merges groups (see get_meta_property_groups) into equal-width bins."""
+    low, high = numbers[0], numbers[-1]
+    width = (high - low) / bins or 1.0
+    binned = {}
+    for number, (_, ids, word_count) in zip(numbers, groups):
+        bin_i = min(int((number - low) / width), bins - 1)
+        binned.setdefault(bin_i, []).append((ids, word_count))
+    return [
+        (
+            low + (bin_i + 0.5) * width,
+            # A file has one value per meta property, so the ids are disjoint
+            np.sort(np.concatenate([ids for ids, _ in members])),
+            _sum_word_counts(word_count for _, word_count in members),
+        )
+        for bin_i, members in sorted(binned.items())
+    ]
+
 
 class DatabaseManager:
     """
     Class for managing database of corpus content.
 
-    Creates 5 tables:
+    Creates 7 tables:
 
-    - Sentences (with file path, embeddings and group id)
+    - Sentences (with file path, embeddings, group id, word count and token
+        ids)
     - Text categories (linked to sentences by id)
     - Meta properties (linked to sentences by file path)
     - Sentence tiers (linked to sentences by id)
     - Subfolders (linked to sentences by file path)
+    - Aggregate counts (sentence, word and file counts for the whole corpus,
+        each subfolder, text category and meta property value, updated as
+        files are inserted)
+    - Vocabulary (token strings of the token ids)
 
     """
 
     def __init__(self, db_path: Path) -> None:
         self.db_path = db_path
+        self._temp_table_ids = count()
+        self._free_temp_tables = []
 
     def setup(self) -> None:
         if self.db_path.is_file():
             self.db_path.unlink()
         self.connect()
-        self._make_tables()
 
     def connect(self) -> None:
         self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
+        self._free_temp_tables = []
+        # Adds any tables missing from databases made by older versions
+        self._make_tables()
+        self.vocabulary = Vocabulary(self.get_vocabulary())
+        # Number of vocabulary tokens in the vocabulary table. Tokens added
+        # elsewhere (see iter_token_batches) are saved with the next file.
+        self._saved_vocabulary_size = len(self.vocabulary)
+        self.annotation_tables = AnnotationTables(self.get_annotation_labels())
 
     def _make_tables(self) -> None:
         self.cursor.execute("""
@@ -40,9 +140,25 @@ class DatabaseManager:
                 sentence TEXT NOT NULL,
                 file_path TEXT NOT NULL,
                 embedding BLOB,
-                group_id INTEGER
+                group_id INTEGER,
+                word_count INTEGER,
+                token_ids BLOB,
+                annotations BLOB
             )
         """)
+        # Columns added after the table was first released
+        columns = {
+            row["name"] for row in self.cursor.execute("PRAGMA table_info(sentences)")
+        }
+        for column, column_type in (
+            ("word_count", "INTEGER"),
+            ("token_ids", "BLOB"),
+            ("annotations", "BLOB"),
+        ):
+            if column not in columns:
+                self.cursor.execute(
+                    f"ALTER TABLE sentences ADD COLUMN {column} {column_type}"
+                )
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS text_categories (
                 sentence_id INTEGER,
@@ -75,6 +191,43 @@ class DatabaseManager:
             UNIQUE(file_path, subfolder) 
         )
         """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS aggregate_counts (
+                kind TEXT NOT NULL,
+                label_name TEXT NOT NULL DEFAULT '',
+                name TEXT NOT NULL DEFAULT '',
+                value TEXT NOT NULL DEFAULT '',
+                sent_count INTEGER NOT NULL DEFAULT 0,
+                word_count INTEGER NOT NULL DEFAULT 0,
+                file_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, label_name, name, value)
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS vocabulary (
+                id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL UNIQUE
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS annotation_labels (
+                field TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                PRIMARY KEY (field, id)
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                sentence_id INTEGER NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                text TEXT NOT NULL,
+                norm TEXT NOT NULL,
+                FOREIGN KEY (sentence_id) REFERENCES sentences(id)
+            )
+        """)
         # Add indices
         self.cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_file_path ON sentences(file_path);
@@ -88,6 +241,19 @@ class DatabaseManager:
         self.cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_sentence_id_sent_tiers ON sent_tiers(sentence_id);
     """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_meta_properties_name_value
+            ON meta_properties(label_name, name, value);
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_entities_sentence_id ON entities(sentence_id);
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_entities_type_norm ON entities(type, norm);
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_entities_norm ON entities(norm);
+        """)
 
         self.connection.commit()
 
@@ -97,22 +263,76 @@ class DatabaseManager:
     def _deserialize_embedding(self, embedding_blob: bytes) -> np.ndarray:
         return pickle.loads(embedding_blob)
 
+    @contextmanager
+    def _temp_values(self, values: Iterable[Any]) -> Iterator[str]:
+        """
+        Loads values into a temporary table and yields its name. Tables are
+        pooled and emptied on exit rather than dropped, since DROP TABLE fails
+        while other statements on the connection are still reading.
+        """
+        if self._free_temp_tables:
+            table = self._free_temp_tables.pop()
+        else:
+            table = f"temp_values_{next(self._temp_table_ids)}"
+            self.connection.execute(
+                f"CREATE TEMP TABLE {table} (value PRIMARY KEY) WITHOUT ROWID"
+            )
+        # The writes open a transaction, which is committed on exit unless
+        # one was already open (e.g. during ingest)
+        in_transaction = self.connection.in_transaction
+        try:
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?)",
+                ((value,) for value in values),
+            )
+            yield table
+        finally:
+            self.connection.execute(f"DELETE FROM {table}")
+            if not in_transaction:
+                self.connection.commit()
+            self._free_temp_tables.append(table)
+
+    def _in_clause(
+        self, column: str, values: Iterable[Any], stack: ExitStack
+    ) -> tuple[str, list[Any]]:
+        """
+        Returns a "column IN (...)" condition and its parameters. Large value
+        lists are joined through a temp table that lives as long as stack.
+        """
+        values = list(values)
+        if len(values) <= MAX_INLINE_PARAMS:
+            return f"{column} IN ({','.join(['?'] * len(values))})", values
+        table = stack.enter_context(self._temp_values(values))
+        return f"{column} IN (SELECT value FROM {table})", []
+
     def insert_file_entry(self, entry: dict[str, Any]) -> None:
+        label_counts = self.annotation_tables.sizes()
         for sd in entry["sent_dicts"]:
             if sd.get("embedding"):
                 embedding_entry = self._serialize_embedding(sd["embedding"])
             else:
                 embedding_entry = None
+            if sd.get("tokens") is not None:
+                token_ids = self.vocabulary.encode(sd["tokens"]).tobytes()
+            else:
+                token_ids = None
+            if sd.get("annotations") is not None:
+                annotations = self.annotation_tables.encode(sd["annotations"]).tobytes()
+            else:
+                annotations = None
             self.cursor.execute(
                 """
-            INSERT INTO sentences (sentence, file_path, embedding, group_id)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO sentences (sentence, file_path, embedding, group_id, word_count, token_ids, annotations)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
                 (
                     sd["sentence"],
                     str(entry["file_path"]),
                     embedding_entry,
                     sd.get("group_id"),
+                    sd.get("word_count"),
+                    token_ids,
+                    annotations,
                 ),
             )
 
@@ -174,8 +394,182 @@ class DatabaseManager:
                 (str(entry["file_path"]), subfolder),
             )
 
+        self._update_aggregate_counts(entry)
+        self.cursor.executemany(
+            "INSERT INTO vocabulary (id, token) VALUES (?, ?)",
+            enumerate(
+                self.vocabulary.tokens[self._saved_vocabulary_size :],
+                self._saved_vocabulary_size,
+            ),
+        )
+        self._saved_vocabulary_size = len(self.vocabulary)
+        for field, labels in self.annotation_tables.labels().items():
+            self.cursor.executemany(
+                "INSERT INTO annotation_labels (field, id, label) VALUES (?, ?, ?)",
+                (
+                    (field, label_id, label)
+                    for label_id, label in enumerate(
+                        labels[label_counts[field] :], label_counts[field]
+                    )
+                ),
+            )
+
+        self.connection.commit()
+
+    def _update_aggregate_counts(self, entry: dict[str, Any]) -> None:
+        """Adds the counts for a file entry to aggregate_counts."""
+        sent_count = len(entry["sent_dicts"])
+        word_count = sum(sd.get("word_count") or 0 for sd in entry["sent_dicts"])
+        # (kind, label_name, name, value) -> [sent_count, word_count, file_count]
+        counts = {(AGG_TOTAL, "", "", ""): [sent_count, word_count, 1]}
+        for subfolder in entry["subfolders"]:
+            counts[(AGG_SUBFOLDER, "", subfolder, "")] = [sent_count, word_count, 1]
+        for property in entry["meta_properties"]:
+            if property["value"] is None:
+                continue
+            key = (
+                AGG_META_PROPERTY,
+                property["label_name"],
+                property["name"],
+                str(property["value"]),
+            )
+            counts[key] = [sent_count, word_count, 1]
+        for sd in entry["sent_dicts"]:
+            for name in sd["text_categories"]:
+                key = (AGG_TEXT_CATEGORY, "", name, "")
+                counts.setdefault(key, [0, 0, 1])
+                counts[key][0] += 1
+                counts[key][1] += sd.get("word_count") or 0
+
+        self.cursor.executemany(
+            """
+            INSERT INTO aggregate_counts
+                (kind, label_name, name, value, sent_count, word_count, file_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (kind, label_name, name, value) DO UPDATE SET
+                sent_count = sent_count + excluded.sent_count,
+                word_count = word_count + excluded.word_count,
+                file_count = file_count + excluded.file_count
+            """,
+            [(*key, *values) for key, values in counts.items()],
+        )
+
+    def get_vocabulary(self) -> list[str]:
+        """Token strings, indexed by token id."""
+        self.cursor.execute("SELECT token FROM vocabulary ORDER BY id")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_annotation_labels(self) -> dict[str, list[str]]:
+        """Labels of each annotation field, indexed by label id."""
+        self.cursor.execute(
+            "SELECT field, label FROM annotation_labels ORDER BY field, id"
+        )
+        return {
+            field: [row[1] for row in rows]
+            for field, rows in groupby(self.cursor.fetchall(), key=lambda row: row[0])
+        }
+
+    def has_annotations(self) -> bool:
+        self.cursor.execute(
+            "SELECT 1 FROM sentences WHERE annotations IS NOT NULL LIMIT 1"
+        )
+        return self.cursor.fetchone() is not None
+
+    def iter_annotations(
+        self, batch_size: int = 1000
+    ) -> Iterator[tuple[np.ndarray, list[bytes]]]:
+        """
+        Yields (sentence ids, encoded annotations) chunks in id order (see
+        AnnotationTables.encode). Sentences without annotations have none.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT id, annotations FROM sentences ORDER BY id")
+            while rows := cursor.fetchmany(batch_size):
+                yield (
+                    np.array([row[0] for row in rows], dtype=np.int64),
+                    [row[1] or b"" for row in rows],
+                )
+        finally:
+            cursor.close()
+
+    def insert_entities(self, rows: Iterable[tuple[int, int, int, str, str]]) -> None:
+        """
+        Adds entities as (sentence id, start, end, type, text) rows, with
+        start and end character offsets into the sentence.
+        """
+        self.cursor.executemany(
+            """
+            INSERT INTO entities (sentence_id, start, end, type, text, norm)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (sentence_id, start, end, entity_type, text, normalize_entity(text))
+                for sentence_id, start, end, entity_type, text in rows
+            ),
+        )
         self.connection.commit()
 
+    def has_entities(self) -> bool:
+        self.cursor.execute("SELECT 1 FROM entities LIMIT 1")
+        return self.cursor.fetchone() is not None
+
+    def get_entity_types(self) -> list[str]:
+        self.cursor.execute("SELECT DISTINCT type FROM entities ORDER BY type")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def count_entities(
+        self, ids: Iterable[int] | None = None
+    ) -> list[tuple[str, str, int]]:
+        """
+        (text, type, count) of the entities in sentences ids (all sentences
+        if None), most common first.
+        """
+        with ExitStack() as stack:
+            query = "SELECT e.text, e.type, COUNT(*) AS n FROM entities e"
+            params = []
+            if ids is not None:
+                condition, params = self._in_clause(
+                    "e.sentence_id", (int(i) for i in ids), stack
+                )
+                query += f" WHERE {condition}"
+            query += " GROUP BY e.text, e.type ORDER BY n DESC, e.text"
+            cursor = self.connection.cursor()
+            stack.callback(cursor.close)
+            cursor.execute(query, tuple(params))
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def get_aggregate_counts(self, kind: str) -> dict[Any, dict[str, int]]:
+        """
+        Returns precomputed counts for one kind of group (AGG_TOTAL,
+        AGG_SUBFOLDER, AGG_TEXT_CATEGORY or AGG_META_PROPERTY).
+
+        Keys are the group name, except for AGG_TOTAL (key "total") and
+        AGG_META_PROPERTY ((label_name, name, value) tuples). Values are dicts
+        with sent_count, word_count and file_count.
+        """
+        self.cursor.execute(
+            """
+            SELECT label_name, name, value, sent_count, word_count, file_count
+            FROM aggregate_counts WHERE kind = ?
+            """,
+            (kind,),
+        )
+        counts = {}
+        for row in self.cursor.fetchall():
+            if kind == AGG_TOTAL:
+                key = AGG_TOTAL
+            elif kind == AGG_META_PROPERTY:
+                key = (row["label_name"], row["name"], row["value"])
+            else:
+                key = row["name"]
+            counts[key] = {
+                "sent_count": row["sent_count"],
+                "word_count": row["word_count"],
+                "file_count": row["file_count"],
+            }
+        return counts
+
     def _fetch_text_categories(self, sentence_id: int) -> list[str]:
         self.cursor.execute(
             """
@@ -213,16 +607,16 @@ class DatabaseManager:
     ) -> list[dict[str, Any]] | dict[str, Any]:
         if type(file_path_s) is set:
             meta_properties = {}
-            self.cursor.execute(
-                f"""
-                SELECT file_path, label_name, name, value
-                FROM meta_properties
-                WHERE file_path IN ({','.join(['?'] * len(file_path_s))})
-                """,
-                tuple(file_path_s),
-            )
-            meta_properties = {}
-            for row in self.cursor.fetchall():
+            with self._temp_values(file_path_s) as table:
+                self.cursor.execute(
+                    f"""
+                    SELECT mp.file_path, mp.label_name, mp.name, mp.value
+                    FROM {table} t
+                    JOIN meta_properties mp ON mp.file_path = t.value
+                    """
+                )
+                rows = self.cursor.fetchall()
+            for row in rows:
                 file_path = row["file_path"]
                 meta_properties.setdefault(file_path, [])
                 meta_prop = self.pack_meta_props(row)
@@ -242,6 +636,123 @@ class DatabaseManager:
                 meta_properties.append(self.pack_meta_props(row))
             return meta_properties
 
+    def get_max_sent_id(self) -> int:
+        self.cursor.execute("SELECT MAX(id) FROM sentences")
+        return self.cursor.fetchone()[0] or 0
+
+    def iter_group_sent_ids(
+        self, kind: str
+    ) -> Iterator[tuple[tuple[str, ...], np.ndarray]]:
+        """
+        Yields (group key, sorted sentence ids) for every subfolder
+        (AGG_SUBFOLDER), text category (AGG_TEXT_CATEGORY) or meta property
+        value (AGG_META_PROPERTY). Keys are (name,) or (label_name, name,
+        value) for meta properties.
+        """
+        if kind == AGG_SUBFOLDER:
+            query = """
+                SELECT sf.subfolder, s.id
+                FROM subfolders sf JOIN sentences s ON s.file_path = sf.file_path
+                ORDER BY sf.subfolder, s.id
+            """
+        elif kind == AGG_TEXT_CATEGORY:
+            query = """
+                SELECT name, sentence_id FROM text_categories
+                ORDER BY name, sentence_id
+            """
+        elif kind == AGG_META_PROPERTY:
+            query = """
+                SELECT mp.label_name, mp.name, mp.value, s.id
+                FROM meta_properties mp
+                JOIN sentences s ON s.file_path = mp.file_path
+                WHERE mp.value IS NOT NULL
+                ORDER BY mp.label_name, mp.name, mp.value, s.id
+            """
+        else:
+            raise ValueError(f"Unknown group kind {kind}")
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query)
+            for key, rows in groupby(cursor, key=lambda row: tuple(row)[:-1]):
+                yield key, np.fromiter((row[-1] for row in rows), dtype=np.int64)
+        finally:
+            cursor.close()
+
+    def get_meta_property_values(self, label_name: str, name: str) -> list[Any]:
+        """Distinct (non-null) values of a meta property."""
+        self.cursor.execute(
+            """
+            SELECT DISTINCT value FROM meta_properties
+            WHERE label_name = ? AND name = ? AND value IS NOT NULL
+            """,
+            (label_name, name),
+        )
+        return [row["value"] for row in self.cursor.fetchall()]
+
+    def get_meta_property_groups(
+        self,
+        label_name: str,
+        name: str,
+        bins: int | None = None,
+        max_values: int | None = None,
+    ) -> list[tuple[Any, np.ndarray, int | None]]:
+        """
+        Sentences grouped by the value of a meta property, in a single query
+        ordered by value (using the meta property index).
+
+        Args:
+            label_name (str)
+            name (str)
+            bins (int | None, optional): If given, numeric values are grouped
+                into this many equal-width bins, labelled by their midpoint.
+                Empty bins are left out. Defaults to None.
+            max_values (int | None, optional): If given (and bins isn't),
+                numeric values are binned into max_values bins when there are
+                more distinct values than that. Defaults to None.
+
+        Returns:
+            list[tuple[Any, np.ndarray, int | None]]: (value, sorted sentence
+                ids, word count) for each value, in numeric order if all
+                values are numbers. The word count is None if some of the
+                sentences have none stored (databases from older versions),
+                so callers count the words themselves.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT mp.value, s.id, s.word_count
+                FROM meta_properties mp
+                JOIN sentences s ON s.file_path = mp.file_path
+                WHERE mp.label_name = ? AND mp.name = ? AND mp.value IS NOT NULL
+                ORDER BY mp.value, s.id
+                """,
+                (label_name, name),
+            )
+            groups = []
+            for value, rows in groupby(cursor, key=lambda row: row[0]):
+                rows = list(rows)
+                ids = np.array([row[1] for row in rows], dtype=np.int64)
+                word_count = _sum_word_counts(row[2] for row in rows)
+                groups.append((value, ids, word_count))
+        finally:
+            cursor.close()
+        if not groups:
+            return groups
+        try:
+            numbers = [float(value) for value, _, _ in groups]
+        except ValueError:
+            if bins:
+                raise ValueError(f"Can't bin non-numeric values of {label_name}-{name}")
+            return groups
+        order = sorted(range(len(groups)), key=numbers.__getitem__)
+        groups = [groups[i] for i in order]
+        if not bins and max_values and len(groups) > max_values:
+            bins = max_values
+        if bins:
+            return _bin_groups(groups, [numbers[i] for i in order], bins)
+        return groups
+
     def pack_meta_props(self, row: sqlite3.Row) -> dict[str, Any]:
         return {
             "label_name": row["label_name"],
@@ -249,40 +760,28 @@ class DatabaseManager:
             "value": row["value"],
         }
 
-    def get_sents(
+    def _build_sents_query(
         self,
+        select: str,
+        stack: ExitStack,
         subfolders: list[str] | str | None = None,
         file_paths: Path | list[Path] | None = None,
         text_categories: list[str] | str | None = None,
         meta_properties: dict[str, Any] | list[dict[str, Any]] | None = None,
-        include_embeddings: bool = False,
-        include_meta_properties: bool = True,
-    ) -> dict[str, Any]:
+        entities: dict[str, Any] | list[dict[str, Any]] | None = None,
+        ids: Iterable[int] | None = None,
+    ) -> tuple[str, list[Any]]:
         """
-        Retrieves sentences based on any combination of filters: named_subfolder,
-            file_path, text_category, and meta_property.
-        Args:
-            named_subfolder (list[str] | str, optional): Filter by subfolder(s).
-                Defaults to None.
-            file_path (list[Path] | Path, optional): Filter by file path(s).
-                Defaults to None.
-            text_category (list[str] | str, optional): Filter by text
-                category(ies). Defaults to None.
-            meta_property (dict[str, Any], optional): Filter by meta property
-                (e.g., label_name, name, value). Defaults to None.
-            include_embeddings (bool, optional): Whether to include embeddings
-                 in the results. Defaults to False.
-            include_meta_properties (bool, optional): Whether to include meta
-                properties in the results. Defaults to True.
+        Builds the filtered sentence query shared by get_sents and iter_sents.
+        See get_sents for the filter args. Temp tables used by the query are
+        registered with stack, so the query must run before stack closes.
 
         Returns:
-            dict[str, Any]: A dictionary containing 'sent_dicts' (list of
-            sentences with file_path and embeddings) and 'meta_properties' (if
-            requested).
+            tuple[str, list[Any]]: Query string and query parameters.
         """
         # Build query and parameters
-        query = """
-            SELECT s.id, s.sentence, s.file_path, s.embedding, s.group_id
+        query = f"""
+            SELECT {select}
             FROM sentences s
             """
         query_params = []
@@ -293,27 +792,44 @@ class DatabaseManager:
         if subfolders:
             if isinstance(subfolders, str):
                 subfolders = [subfolders]
-            placeholders = ",".join(["?"] * len(subfolders))
             joins.append("JOIN subfolders sf ON s.file_path = sf.file_path")
-            conditions.append(f"sf.subfolder IN ({placeholders})")
-            query_params.extend(subfolders)
+            condition, params = self._in_clause("sf.subfolder", subfolders, stack)
+            conditions.append(condition)
+            query_params.extend(params)
 
         # Handle file_path filtering
         if file_paths:
             if isinstance(file_paths, Path):
                 file_paths = [file_paths]
-            placeholders = ",".join(["?"] * len(file_paths))
-            conditions.append(f"s.file_path IN ({placeholders})")
-            query_params.extend(str(p) for p in file_paths)
+            condition, params = self._in_clause(
+                "s.file_path", (str(p) for p in file_paths), stack
+            )
+            conditions.append(condition)
+            query_params.extend(params)
+
+        # Handle sentence id filtering
+        if ids is not None:
+            ids = np.unique(np.fromiter(ids, dtype=np.int64))
+            if len(ids) and ids[-1] - ids[0] + 1 == len(ids):
+                # Consecutive ids (e.g. the whole corpus)
+                conditions.append("s.id BETWEEN ? AND ?")
+                query_params.extend([int(ids[0]), int(ids[-1])])
+            elif len(ids) <= ID_CHUNK_SIZE:
+                conditions.append(f"s.id IN ({','.join(['?'] * len(ids))})")
+                query_params.extend(ids.tolist())
+            else:
+                condition, params = self._in_clause("s.id", ids.tolist(), stack)
+                conditions.append(condition)
+                query_params.extend(params)
 
         # Handle text_category filtering
         if text_categories:
             if isinstance(text_categories, str):
                 text_categories = [text_categories]
-            placeholders = ",".join(["?"] * len(text_categories))
             joins.append("JOIN text_categories tc ON s.id = tc.sentence_id")
-            conditions.append(f"tc.name IN ({placeholders})")
-            query_params.extend(text_categories)
+            condition, params = self._in_clause("tc.name", text_categories, stack)
+            conditions.append(condition)
+            query_params.extend(params)
 
         # Handle meta_property filtering (label_name, name, value)
         if meta_properties:
@@ -340,17 +856,45 @@ class DatabaseManager:
                         conditions.append(f"{alias}.value = ?")
                         query_params.append(str(value))
 
-                    # Handle range filtering (min and max)
+                    # Handle range filtering (min and max). Numeric bounds
+                    # compare the values as numbers, as the bitmap index
+                    # does, and others (e.g. dates) as text.
+                    column = f"{alias}.value"
+                    bounds = [b for b in (min_value, max_value) if b is not None]
+                    if bounds and all(_is_number(b) for b in bounds):
+                        column = f"CAST({alias}.value AS REAL)"
+                        min_value = None if min_value is None else float(min_value)
+                        max_value = None if max_value is None else float(max_value)
                     if min_value is not None and max_value is not None:
-                        conditions.append(f"{alias}.value BETWEEN ? AND ?")
+                        conditions.append(f"{column} BETWEEN ? AND ?")
                         query_params.extend([min_value, max_value])
                     elif min_value is not None:
-                        conditions.append(f"{alias}.value >= ?")
+                        conditions.append(f"{column} >= ?")
                         query_params.append(min_value)
                     elif max_value is not None:
-                        conditions.append(f"{alias}.value <= ?")
+                        conditions.append(f"{column} <= ?")
                         query_params.append(max_value)
 
+        # Handle entity filtering (any of type and/or normalized text)
+        if entities:
+            if isinstance(entities, dict):
+                entities = [entities]
+            entity_conditions = []
+            for entity in entities:
+                parts = []
+                if entity.get("type"):
+                    parts.append("e.type = ?")
+                    query_params.append(entity["type"])
+                if entity.get("text"):
+                    parts.append("e.norm = ?")
+                    query_params.append(normalize_entity(entity["text"]))
+                entity_conditions.append(" AND ".join(parts) or "1")
+            conditions.append(
+                "s.id IN (SELECT e.sentence_id FROM entities e WHERE "
+                + " OR ".join(f"({c})" for c in entity_conditions)
+                + ")"
+            )
+
         # Combine joins and conditions
         if joins:
             query += " " + " ".join(joins)
@@ -358,28 +902,247 @@ class DatabaseManager:
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
 
-        # Execute query
-        self.cursor.execute(query, tuple(query_params))
-        rows = self.cursor.fetchall()
+        return query, query_params
 
-        results = {"sent_dicts": []}
-        for row in rows:
-            sent_dict = self._fetch_sent_dict(
-                row, include_embeddings=include_embeddings
-            )
+    def get_sents(
+        self,
+        subfolders: list[str] | str | None = None,
+        file_paths: Path | list[Path] | None = None,
+        text_categories: list[str] | str | None = None,
+        meta_properties: dict[str, Any] | list[dict[str, Any]] | None = None,
+        entities: dict[str, Any] | list[dict[str, Any]] | None = None,
+        include_embeddings: bool = False,
+        include_meta_properties: bool = True,
+    ) -> dict[str, Any]:
+        """
+        Retrieves sentences based on any combination of filters: named_subfolder,
+            file_path, text_category, and meta_property.
+        Args:
+            named_subfolder (list[str] | str, optional): Filter by subfolder(s).
+                Defaults to None.
+            file_path (list[Path] | Path, optional): Filter by file path(s).
+                Defaults to None.
+            text_category (list[str] | str, optional): Filter by text
+                category(ies). Defaults to None.
+            meta_property (dict[str, Any], optional): Filter by meta property
+                (e.g., label_name, name, value). Defaults to None.
+            entities (dict[str, Any] | list[dict[str, Any]], optional): Filter
+                by named entity (type and/or text, matched case-insensitively).
+                Sentences with any of the entities are kept. Only available
+                if entities were extracted at ingest. Defaults to None.
+            include_embeddings (bool, optional): Whether to include embeddings
+                 in the results. Defaults to False.
+            include_meta_properties (bool, optional): Whether to include meta
+                properties in the results. Defaults to True.
 
-            if include_embeddings and row["embedding"]:
-                sent_dict["embedding"] = self._deserialize_embedding(row["embedding"])
+        Returns:
+            dict[str, Any]: A dictionary containing 'sent_dicts' (list of
+            sentences with file_path and embeddings) and 'meta_properties' (if
+            requested).
+        """
+        columns = ("file_path", "group_id", "text_categories", "sent_tiers")
+        if include_embeddings:
+            columns += ("embedding",)
+        batch = SentenceBatch.concat(
+            self.iter_sent_batches(
+                subfolders=subfolders,
+                file_paths=file_paths,
+                text_categories=text_categories,
+                meta_properties=meta_properties,
+                entities=entities,
+                columns=columns,
+            )
+        )
 
+        results = {"sent_dicts": []}
+        for sent_dict in batch.records():
+            sent_dict["file_path"] = Path(sent_dict["file_path"])
             results["sent_dicts"].append(sent_dict)
 
         if include_meta_properties:
             # Collect file_paths for meta_property fetching
-            file_paths = {row["file_path"] for row in rows}  # type: ignore
+            file_paths = set(batch.file_table or [])  # type: ignore
             results["meta_properties"] = self._fetch_meta_properties(file_paths)  # type: ignore
 
         return results
 
+    def iter_sents(
+        self,
+        subfolders: list[str] | str | None = None,
+        file_paths: Path | list[Path] | None = None,
+        text_categories: list[str] | str | None = None,
+        meta_properties: dict[str, Any] | list[dict[str, Any]] | None = None,
+        entities: dict[str, Any] | list[dict[str, Any]] | None = None,
+        ids: Iterable[int] | None = None,
+        columns: tuple[str, ...] = ("sentence",),
+        batch_size: int = 1000,
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Same as iter_sent_batches, but yields a sent_dict for each sentence
+        (see SentenceBatch.records). file_path is left as a string.
+        """
+        for batch in self.iter_sent_batches(
+            subfolders=subfolders,
+            file_paths=file_paths,
+            text_categories=text_categories,
+            meta_properties=meta_properties,
+            entities=entities,
+            ids=ids,
+            columns=columns,
+            batch_size=batch_size,
+        ):
+            yield from batch.records()
+
+    def iter_sent_batches(
+        self,
+        subfolders: list[str] | str | None = None,
+        file_paths: Path | list[Path] | None = None,
+        text_categories: list[str] | str | None = None,
+        meta_properties: dict[str, Any] | list[dict[str, Any]] | None = None,
+        entities: dict[str, Any] | list[dict[str, Any]] | None = None,
+        ids: Iterable[int] | None = None,
+        columns: tuple[str, ...] = ("sentence",),
+        batch_size: int = 1000,
+        ordered: bool = False,
+    ) -> Iterator[SentenceBatch]:
+        """
+        Streaming version of get_sents. Rows are read with fetchmany on a
+        dedicated cursor, so memory use doesn't depend on the size of the
+        selection. Selections by id are read in chunks of sorted ids (see
+        ID_CHUNK_SIZE).
+
+        Args:
+            (filters): Same as get_sents, plus ids (sentence ids, e.g. from
+                get_sent_ids).
+            columns (tuple[str, ...], optional): Keys of SENT_RECORD_COLUMNS
+                to include in each batch. id and sentence are always
+                included. Defaults to ("sentence",).
+            batch_size (int, optional): Rows per fetchmany call and batch.
+                Defaults to 1000.
+            ordered (bool, optional): Whether to sort sentences by id.
+                Defaults to False.
+
+        Yields:
+            Iterator[SentenceBatch]
+        """
+        unknown = set(columns) - SENT_RECORD_COLUMNS.keys()
+        if unknown:
+            raise ValueError(f"Unknown sentence columns: {', '.join(unknown)}")
+        columns = tuple(dict.fromkeys(("id", "sentence", *columns)))
+        select = ", ".join(f"{SENT_RECORD_COLUMNS[c]} AS {c}" for c in columns)
+        if ids is None:
+            id_chunks = [None]
+        else:
+            ids = np.unique(np.fromiter(ids, dtype=np.int64))
+            id_chunks = [
+                ids[start : start + ID_CHUNK_SIZE]
+                for start in range(0, len(ids), ID_CHUNK_SIZE)
+            ]
+
+        def iter_rows() -> Iterator[sqlite3.Row]:
+            for chunk_ids in id_chunks:
+                with ExitStack() as stack:
+                    query, query_params = self._build_sents_query(
+                        select,
+                        stack,
+                        subfolders=subfolders,
+                        file_paths=file_paths,
+                        text_categories=text_categories,
+                        meta_properties=meta_properties,
+                        entities=entities,
+                        ids=chunk_ids,
+                    )
+                    # Chunks are in id order, so sorting each one is enough
+                    if ordered:
+                        query += " ORDER BY s.id"
+                    cursor = self.connection.cursor()
+                    stack.callback(cursor.close)
+                    cursor.execute(query, tuple(query_params))
+                    while rows := cursor.fetchmany(batch_size):
+                        yield from rows
+
+        for rows in iter_chunks(iter_rows(), batch_size):
+            yield self._pack_sent_batch(rows, columns)
+
+    def get_sent_ids(
+        self,
+        subfolders: list[str] | str | None = None,
+        file_paths: Path | list[Path] | None = None,
+        text_categories: list[str] | str | None = None,
+        meta_properties: dict[str, Any] | list[dict[str, Any]] | None = None,
+        entities: dict[str, Any] | list[dict[str, Any]] | None = None,
+        ids: Iterable[int] | None = None,
+    ) -> np.ndarray:
+        """
+        Same filters as iter_sents. Returns the sorted ids of matching
+        sentences.
+        """
+        with ExitStack() as stack:
+            query, query_params = self._build_sents_query(
+                "DISTINCT s.id",
+                stack,
+                subfolders=subfolders,
+                file_paths=file_paths,
+                text_categories=text_categories,
+                meta_properties=meta_properties,
+                entities=entities,
+                ids=ids,
+            )
+            cursor = self.connection.cursor()
+            stack.callback(cursor.close)
+            cursor.execute(query + " ORDER BY s.id", tuple(query_params))
+            return np.fromiter((row[0] for row in cursor), dtype=np.int64)
+
+    def _pack_sent_batch(
+        self, rows: list[sqlite3.Row], columns: tuple[str, ...]
+    ) -> SentenceBatch:
+        batch = SentenceBatch(
+            ids=np.array([row["id"] for row in rows], dtype=np.int64),
+            sentences=[row["sentence"] for row in rows],
+        )
+        if "file_path" in columns:
+            batch.file_table, batch.file_index = intern(
+                row["file_path"] for row in rows
+            )
+        if "text_categories" in columns:
+            (
+                batch.category_table,
+                batch.category_offsets,
+                batch.category_index,
+            ) = intern_lists(
+                row["text_categories"].split("\x1f") if row["text_categories"] else []
+                for row in rows
+            )
+        if "word_count" in columns:
+            batch.word_counts = np.array(
+                [row["word_count"] or 0 for row in rows], dtype=np.int32
+            )
+        if "group_id" in columns:
+            batch.group_ids = np.array(
+                [-1 if row["group_id"] is None else row["group_id"] for row in rows],
+                dtype=np.int64,
+            )
+        if "embedding" in columns and all(row["embedding"] for row in rows):
+            batch.embeddings = np.array(
+                [self._deserialize_embedding(row["embedding"]) for row in rows],
+                dtype=np.float32,
+            )
+        # Sentences from older versions have no token ids, and are left to be
+        # tokenized with the vocabulary (see iter_token_batches)
+        if "tokens" in columns and all(row["tokens"] is not None for row in rows):
+            batch.set_tokens(
+                [np.frombuffer(row["tokens"], dtype=np.int32) for row in rows],
+                self.vocabulary,
+            )
+        elif "tokens" in columns:
+            batch.vocabulary = self.vocabulary
+        if "sent_tiers" in columns:
+            batch.sent_tiers = [
+                json.loads(row["sent_tiers"]) if row["sent_tiers"] else {}
+                for row in rows
+            ]
+        return batch
+
     def get_sents_by_named_subfolder(
         self,
         subfolder: str | list[str],
@@ -394,15 +1157,16 @@ class DatabaseManager:
             subfolder = [subfolder]  # Ensure subfolder is a list
 
         # Prepare the query
-        placeholders = ",".join(["?"] * len(subfolder))
-        query = f"""
-            SELECT s.id, s.sentence, s.file_path, s.embedding, s.group_id
-            FROM sentences s
-            JOIN subfolders sf ON s.file_path = sf.file_path
-            WHERE sf.subfolder IN ({placeholders})
-        """
-        self.cursor.execute(query, tuple(subfolder))
-        rows = self.cursor.fetchall()
+        with ExitStack() as stack:
+            condition, params = self._in_clause("sf.subfolder", subfolder, stack)
+            query = f"""
+                SELECT s.id, s.sentence, s.file_path, s.embedding, s.group_id
+                FROM sentences s
+                JOIN subfolders sf ON s.file_path = sf.file_path
+                WHERE {condition}
+            """
+            self.cursor.execute(query, tuple(params))
+            rows = self.cursor.fetchall()
 
         results = {"sent_dicts": []}
         for row in rows:
@@ -467,6 +1231,16 @@ class DatabaseManager:
 
         return results
 
+    def _path_prefix_range(self, folder_path: Path) -> tuple[str, str]:
+        """
+        Returns (low, high) such that low <= file_path < high holds exactly
+        for stored paths under folder_path. Paths are compared as text, so
+        this can use the file_path indices.
+        """
+        prefix = os.path.join(str(folder_path), "")
+        high = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return prefix, high
+
     def get_sents_by_folder(
         self,
         folder_path: Path,
@@ -477,20 +1251,16 @@ class DatabaseManager:
         Same args and return type as get_sents_by_file_path except that
         meta_properties is a dictionary with file_path keys.
         """
-        file_paths = set(str(file) for file in folder_path.rglob("*") if file.is_file())
-
-        # If no files are found in the folder, return an empty result
-        if not file_paths:
-            return {"sent_dicts": [], "meta_properties": {}}
+        low, high = self._path_prefix_range(folder_path)
 
-        # Fetch the sentences for the specified file_paths
+        # Single range scan over idx_file_path; the filesystem isn't touched,
+        # so results reflect the corpus as it was processed.
         query = """
             SELECT s.id, s.sentence, s.file_path, s.embedding, s.group_id
             FROM sentences s
-            WHERE s.file_path IN ({})
-        """.format(",".join(["?"] * len(file_paths)))
-
-        self.cursor.execute(query, tuple(file_paths))
+            WHERE s.file_path >= ? AND s.file_path < ?
+        """
+        self.cursor.execute(query, (low, high))
         rows = self.cursor.fetchall()
 
         results = {"sent_dicts": []}
@@ -505,7 +1275,19 @@ class DatabaseManager:
             results["sent_dicts"].append(sent_dict)
 
         if include_meta_properties:
-            results["meta_properties"] = self._fetch_meta_properties(file_paths)  # type: ignore
+            self.cursor.execute(
+                """
+                SELECT file_path, label_name, name, value
+                FROM meta_properties
+                WHERE file_path >= ? AND file_path < ?
+                """,
+                (low, high),
+            )
+            meta_properties = {}
+            for row in self.cursor.fetchall():
+                meta_properties.setdefault(row["file_path"], [])
+                meta_properties[row["file_path"]].append(self.pack_meta_props(row))
+            results["meta_properties"] = meta_properties  # type: ignore
 
         return results
 
@@ -589,23 +1371,25 @@ class DatabaseManager:
         """
         query_params = [label_name, name]
 
-        # Handle value range for numeric labels
-        if value_range:
-            query += " AND CAST(l.value AS REAL) BETWEEN ? AND ?"
-            query_params.extend(value_range)
-        elif multiple_values:
-            query += f" AND l.value IN ({','.join(['?']*len(multiple_values))})"
-            query_params.extend(multiple_values)
-        else:
-            # Handle None value case
-            if value is None:
-                query += " AND l.value IS NULL"
+        with ExitStack() as stack:
+            # Handle value range for numeric labels
+            if value_range:
+                query += " AND CAST(l.value AS REAL) BETWEEN ? AND ?"
+                query_params.extend(value_range)
+            elif multiple_values:
+                condition, params = self._in_clause("l.value", multiple_values, stack)
+                query += f" AND {condition}"
+                query_params.extend(params)
             else:
-                query += " AND l.value = ?"
-                query_params.append(str(value))
-
-        self.cursor.execute(query, tuple(query_params))
-        rows = self.cursor.fetchall()
+                # Handle None value case
+                if value is None:
+                    query += " AND l.value IS NULL"
+                else:
+                    query += " AND l.value = ?"
+                    query_params.append(str(value))
+
+            self.cursor.execute(query, tuple(query_params))
+            rows = self.cursor.fetchall()
 
         file_paths = {row["file_path"] for row in rows}
 
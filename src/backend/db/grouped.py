@@ -0,0 +1,54 @@
+"""Union of several corpus selections, for evaluating them in one pass."""
+
+from copy import copy
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from backend.db.batch import SentenceBatch
+
+
+class GroupedSelection:
+    """
+    Union of several selections (groups), where each sentence is tagged with
+    the indices of the groups it belongs to.
+    """
+
+    def __init__(self, group_ids: list[np.ndarray]) -> None:
+        """
+        Args:
+            group_ids (list[np.ndarray]): Sorted sentence ids for each group.
+        """
+        self.n_groups = len(group_ids)
+        if group_ids:
+            self.ids = np.unique(np.concatenate(group_ids))
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+        # Row i has the groups of the sentence with id self.ids[i]
+        self.membership = np.zeros((len(self.ids), self.n_groups), dtype=bool)
+        for i, ids in enumerate(group_ids):
+            self.membership[np.searchsorted(self.ids, ids), i] = True
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def group_sizes(self) -> np.ndarray:
+        return self.membership.sum(axis=0)
+
+    def subset(self, ids: np.ndarray) -> "GroupedSelection":
+        """Same selection restricted to sorted sentence ids."""
+        keep = np.isin(self.ids, ids, assume_unique=True)
+        subset = copy(self)
+        subset.ids = self.ids[keep]
+        subset.membership = self.membership[keep]
+        return subset
+
+    def tag(self, batches: Iterable[SentenceBatch]) -> Iterator[SentenceBatch]:
+        """
+        Sets the group membership of sentence batches from this selection.
+        Sentences can come in any order.
+        """
+        for batch in batches:
+            positions = np.searchsorted(self.ids, batch.ids)
+            yield batch.with_groups(self.membership[positions])
@@ -0,0 +1,394 @@
+"""
+Flat, memory-mapped stores of per-sentence data, exported from the database
+after processing for scan-heavy tasks.
+
+Each store is a data file with the rows of all sentences laid out one after
+another in sentence id order, and an offsets array indexed by sentence id:
+the row of sentence i is data[offsets[i]:offsets[i + 1]] (empty for ids
+that aren't in the database).
+"""
+
+import json
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from backend.db.annotations import ANNOTATION_DTYPE, AnnotationTables
+from backend.db.batch import SentenceBatch
+from backend.db.db import DatabaseManager
+from backend.db.grouped import GroupedSelection
+from backend.db.vocab import Vocabulary
+from backend.utils.ngrams import (
+    NGramCodec,
+    NGramCounter,
+    NGramIds,
+    get_windows,
+    sum_counts,
+)
+
+
+class RaggedStore:
+    """Variable-length rows indexed by sentence id."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        self.data = data
+        # int64, length max sentence id + 2
+        self.offsets = offsets
+
+    @property
+    def size(self) -> int:
+        return len(self.offsets) - 1
+
+    def row(self, sentence_id: int) -> np.ndarray:
+        return self.data[self.offsets[sentence_id] : self.offsets[sentence_id + 1]]
+
+    def spans(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(starts, ends) of the rows of ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        return self.offsets[ids], self.offsets[ids + 1]
+
+    def gather_index(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(position in data of each item of the rows of ids, row offsets)."""
+        starts, ends = self.spans(ids)
+        lengths = ends - starts
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        index = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return index, offsets
+
+    def gather(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rows of sentences ids as (flat items, offsets), in the same form as
+        SentenceBatch.tokens.
+        """
+        index, offsets = self.gather_index(ids)
+        return np.asarray(self.data[index]), offsets
+
+    @staticmethod
+    def write(
+        data_path: Path,
+        offsets_path: Path,
+        size: int,
+        rows: Iterable[tuple[np.ndarray, list[bytes]]],
+        itemsize: int = 1,
+    ) -> None:
+        """
+        Args:
+            data_path (Path)
+            offsets_path (Path)
+            size (int): Max sentence id + 1.
+            rows (Iterable[tuple[np.ndarray, list[bytes]]]): (ids, encoded
+                rows) chunks, in ascending id order.
+            itemsize (int, optional): Bytes per item of the data type, since
+                offsets are in items. Defaults to 1.
+        """
+        lengths = np.zeros(size, dtype=np.int64)
+        last_id = -1
+        with data_path.open("wb") as f:
+            for ids, encoded in rows:
+                if len(ids) and ids[0] <= last_id:
+                    raise ValueError("Rows must be in ascending sentence id order")
+                f.write(b"".join(encoded))
+                lengths[ids] = [len(row) // itemsize for row in encoded]
+                if len(ids):
+                    last_id = ids[-1]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(offsets_path, offsets)
+
+    @staticmethod
+    def _map(data_path: Path, dtype: type) -> np.ndarray:
+        # np.memmap can't map empty files
+        if data_path.stat().st_size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(data_path, dtype=dtype, mode="r")
+
+
+class TextStore(RaggedStore):
+    """UTF-8 encoded sentence text in one memory-mapped buffer."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        super().__init__(data, offsets)
+        # Slices of a memoryview don't copy
+        self.buffer = memoryview(data)
+
+    @classmethod
+    def build(
+        cls, db: DatabaseManager, data_path: Path, offsets_path: Path
+    ) -> "TextStore":
+        rows = (
+            (batch.ids, [sentence.encode("utf-8") for sentence in batch.sentences])
+            for batch in db.iter_sent_batches(columns=(), ordered=True)
+        )
+        cls.write(data_path, offsets_path, db.get_max_sent_id() + 1, rows)
+        return cls.load(data_path, offsets_path)
+
+    @classmethod
+    def load(cls, data_path: Path, offsets_path: Path) -> "TextStore":
+        offsets = np.load(offsets_path, mmap_mode="r")
+        return cls(cls._map(data_path, np.uint8), offsets)
+
+    def scan(self, ids: np.ndarray) -> Iterator[memoryview]:
+        """Yields the UTF-8 bytes of each sentence in ids, without copying."""
+        starts, ends = self.spans(ids)
+        buffer = self.buffer
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield buffer[start:end]
+
+    def get(self, sentence_id: int) -> str:
+        start, end = self.offsets[sentence_id : sentence_id + 2]
+        return str(self.buffer[start:end], "utf-8")
+
+    def iter_batches(
+        self, ids: np.ndarray, batch_size: int = 1000
+    ) -> Iterator[SentenceBatch]:
+        """Yields SentenceBatches with only ids and sentences."""
+        ids = np.asarray(ids, dtype=np.int64)
+        for i in range(0, len(ids), batch_size):
+            chunk = ids[i : i + batch_size]
+            sentences = [str(view, "utf-8") for view in self.scan(chunk)]
+            yield SentenceBatch(ids=chunk, sentences=sentences)
+
+
+class TokenStore(RaggedStore):
+    """Token ids (int32) of each sentence, with their vocabulary."""
+
+    def __init__(
+        self, data: np.ndarray, offsets: np.ndarray, vocabulary: Vocabulary
+    ) -> None:
+        super().__init__(data, offsets)
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def build(
+        cls, db: DatabaseManager, data_path: Path, offsets_path: Path
+    ) -> "TokenStore":
+        rows = (
+            (batch.ids, [batch.token_ids(i).tobytes() for i in range(len(batch))])
+            for batch in db.iter_sent_batches(columns=("tokens",), ordered=True)
+        )
+        size = db.get_max_sent_id() + 1
+        cls.write(data_path, offsets_path, size, rows, np.dtype(np.int32).itemsize)
+        return cls.load(data_path, offsets_path, db.vocabulary)
+
+    @classmethod
+    def load(
+        cls, data_path: Path, offsets_path: Path, vocabulary: Vocabulary
+    ) -> "TokenStore":
+        offsets = np.load(offsets_path, mmap_mode="r")
+        return cls(cls._map(data_path, np.int32), offsets, vocabulary)
+
+    def add_tokens(self, batch: SentenceBatch) -> SentenceBatch:
+        batch.tokens, batch.token_offsets = self.gather(batch.ids)
+        batch.vocabulary = self.vocabulary
+        return batch
+
+
+class NGramIndex(RaggedStore):
+    """
+    N-gram ids (int32) of each sentence, for one n. N-gram ids index
+    windows, the token ids of each distinct n-gram in the corpus, so the
+    n-gram counts of a selection are the counts of the ids of its sentences.
+    """
+
+    # Sentences read at a time when building and counting
+    CHUNK_SIZE = 200_000
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        offsets: np.ndarray,
+        windows: np.ndarray,
+        vocabulary: Vocabulary,
+    ) -> None:
+        super().__init__(data, offsets)
+        # (n-grams x n) token ids, indexed by n-gram id
+        self.windows = windows
+        self.vocabulary = vocabulary
+
+    @property
+    def n(self) -> int:
+        return self.windows.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    @classmethod
+    def build(
+        cls,
+        token_store: TokenStore,
+        n: int,
+        data_path: Path,
+        offsets_path: Path,
+        windows_path: Path,
+    ) -> "NGramIndex":
+        """
+        Builds the index from the token store in two passes: the first
+        collects the distinct n-grams and assigns their ids, the second
+        writes the ids of each sentence's n-grams.
+        """
+        chunks = [
+            np.arange(start, min(start + cls.CHUNK_SIZE, token_store.size))
+            for start in range(0, token_store.size, cls.CHUNK_SIZE)
+        ]
+        counter = NGramCounter(NGramCodec(n, len(token_store.vocabulary)))
+        for ids in chunks:
+            counter.add(get_windows(*token_store.gather(ids), n)[0])
+        keys, _ = counter.counted()
+        codec = counter.codec
+        ngram_ids = NGramIds(keys)
+
+        def iter_rows():
+            for ids in chunks:
+                windows, sent_index = get_windows(*token_store.gather(ids), n)
+                row_ids = ngram_ids.lookup(codec.encode(windows))
+                lengths = np.bincount(sent_index, minlength=len(ids))
+                rows = np.split(row_ids, np.cumsum(lengths)[:-1])
+                yield ids, [row.tobytes() for row in rows]
+
+        size = token_store.size
+        itemsize = np.dtype(np.int32).itemsize
+        cls.write(data_path, offsets_path, size, iter_rows(), itemsize)
+        np.save(windows_path, codec.decode(ngram_ids.keys))
+        return cls.load(data_path, offsets_path, windows_path, token_store.vocabulary)
+
+    @classmethod
+    def load(
+        cls,
+        data_path: Path,
+        offsets_path: Path,
+        windows_path: Path,
+        vocabulary: Vocabulary,
+    ) -> "NGramIndex":
+        offsets = np.load(offsets_path, mmap_mode="r")
+        windows = np.load(windows_path)
+        return cls(cls._map(data_path, np.int32), offsets, windows, vocabulary)
+
+    def count(self, grouped: GroupedSelection) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        N-gram counts of each group, as (ids of the n-grams that occur in the
+        group, their counts (int64)).
+        """
+        keys_l, counts_l = [], []
+        for start in range(0, len(grouped), self.CHUNK_SIZE):
+            ids = grouped.ids[start : start + self.CHUNK_SIZE]
+            membership = grouped.membership[start : start + self.CHUNK_SIZE]
+            ngram_ids, offsets = self.gather(ids)
+            index, groups = np.nonzero(np.repeat(membership, np.diff(offsets), axis=0))
+            # N-grams of every group are counted at once, keyed by group
+            keys, counts = sum_counts(groups * len(self) + ngram_ids[index])
+            keys_l.append(keys)
+            counts_l.append(counts)
+        if keys_l:
+            keys, counts = sum_counts(np.concatenate(keys_l), np.concatenate(counts_l))
+        else:
+            keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        groups, ngram_ids = np.divmod(keys, len(self))
+        bounds = np.searchsorted(groups, np.arange(grouped.n_groups + 1))
+        return [
+            (ngram_ids[start:end], counts[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+
+class AnnotationStore(RaggedStore):
+    """
+    Token annotations (ANNOTATION_DTYPE records) of each sentence, aligned
+    with the token ids of the TokenStore, and their label tables.
+    """
+
+    # Sentences read at a time when counting
+    CHUNK_SIZE = 200_000
+
+    def __init__(
+        self, data: np.ndarray, offsets: np.ndarray, tables: AnnotationTables
+    ) -> None:
+        super().__init__(data, offsets)
+        self.tables = tables
+
+    @classmethod
+    def build(
+        cls,
+        db: DatabaseManager,
+        data_path: Path,
+        offsets_path: Path,
+        labels_path: Path,
+    ) -> "AnnotationStore":
+        size = db.get_max_sent_id() + 1
+        rows = db.iter_annotations()
+        cls.write(data_path, offsets_path, size, rows, ANNOTATION_DTYPE.itemsize)
+        labels_path.write_text(json.dumps(db.annotation_tables.labels()))
+        return cls.load(data_path, offsets_path, labels_path)
+
+    @classmethod
+    def load(
+        cls, data_path: Path, offsets_path: Path, labels_path: Path
+    ) -> "AnnotationStore":
+        offsets = np.load(offsets_path, mmap_mode="r")
+        tables = AnnotationTables(json.loads(labels_path.read_text()))
+        return cls(cls._map(data_path, ANNOTATION_DTYPE), offsets, tables)
+
+    def gather_field(
+        self, ids: np.ndarray, field: str
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Same as gather, for one field of the records."""
+        index, offsets = self.gather_index(ids)
+        return np.asarray(self.data[field][index]), offsets
+
+    def sentence_counts(
+        self, ids: np.ndarray, field: str, labels: str | Iterable[str]
+    ) -> np.ndarray:
+        """
+        Number of tokens of each sentence of ids with any of the labels for
+        field (see AnnotationTables.label_mask).
+        """
+        values, offsets = self.gather_field(ids, field)
+        hits = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(self.tables.label_mask(field, labels)[values], out=hits[1:])
+        return hits[offsets[1:]] - hits[offsets[:-1]]
+
+    def count(
+        self, grouped: GroupedSelection, fields: tuple[str, ...]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Token counts of each group by the combination of their labels for
+        fields (e.g. ("lemma", "pos")).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (label ids of the combinations that
+                occur (combinations x fields), their counts in each group
+                (groups x combinations, int64))
+        """
+        sizes = [max(len(self.tables[field]), 1) for field in fields]
+        n_codes = int(np.prod(sizes))
+        keys_l, counts_l = [], []
+        for start in range(0, len(grouped), self.CHUNK_SIZE):
+            ids = grouped.ids[start : start + self.CHUNK_SIZE]
+            membership = grouped.membership[start : start + self.CHUNK_SIZE]
+            index, offsets = self.gather_index(ids)
+            records = np.asarray(self.data[index])
+            # Combination of each token's labels, in mixed radix
+            codes = np.zeros(len(records), dtype=np.int64)
+            for field, size in zip(fields, sizes):
+                codes = codes * size + records[field]
+            token_index, groups = np.nonzero(
+                np.repeat(membership, np.diff(offsets), axis=0)
+            )
+            keys, counts = sum_counts(groups * n_codes + codes[token_index])
+            keys_l.append(keys)
+            counts_l.append(counts)
+        if not keys_l:
+            return np.empty((0, len(fields)), dtype=np.int64), np.zeros(
+                (grouped.n_groups, 0), dtype=np.int64
+            )
+        keys, counts = sum_counts(np.concatenate(keys_l), np.concatenate(counts_l))
+        groups, codes = np.divmod(keys, n_codes)
+        distinct, columns = np.unique(codes, return_inverse=True)
+        group_counts = np.zeros((grouped.n_groups, len(distinct)), dtype=np.int64)
+        group_counts[groups, columns] = counts
+        label_ids = np.empty((len(distinct), len(fields)), dtype=np.int64)
+        remaining = distinct
+        for i in range(len(fields) - 1, -1, -1):
+            remaining, label_ids[:, i] = np.divmod(remaining, sizes[i])
+        return label_ids, group_counts
@@ -0,0 +1,324 @@
+"""
+Trigram posting index over sentence text, for pre-filtering regex searches.
+
+The index maps every trigram (3 consecutive bytes of the UTF-8 text, with
+ASCII letters lowercased) to the sorted ids of the sentences containing it.
+A regex is analysed with the re parser for literal text that any match must
+contain (see trigram_query), and only sentences with all of the required
+trigrams are candidates for the full regex. Patterns without such literals
+(e.g. "\\d+") can't be pre-filtered.
+"""
+
+from pathlib import Path
+import re
+
+try:
+    # Private modules of re, so every pattern falls back to a full scan if
+    # they change
+    from re import _parser as sre_parse  # type: ignore
+    from re._constants import (  # type: ignore
+        ASSERT,
+        ASSERT_NOT,
+        AT,
+        BRANCH,
+        IN,
+        LITERAL,
+        MAX_REPEAT,
+        MIN_REPEAT,
+        POSSESSIVE_REPEAT,
+        RANGE,
+        SUBPATTERN,
+    )
+except ImportError:
+    sre_parse = None
+
+import numpy as np
+
+from backend.db.stores import TextStore
+from backend.utils.ngrams import sum_counts
+
+# Max strings in the set of exact strings a regex node can match, beyond
+# which only its required trigrams are kept
+MAX_EXACT = 16
+# Max size of a character class expanded to its characters
+MAX_CLASS = 8
+# Max clauses of a trigram query, when alternatives are combined
+MAX_CLAUSES = 64
+# ASCII letters that also match non-ASCII characters case-insensitively
+# (e.g. "k" and the Kelvin sign), so aren't literals under re.IGNORECASE
+UNICODE_FOLDED = set("iksIKS")
+
+# A query is a list of clauses, each a set of trigrams of which a matching
+# sentence contains at least one. An empty list matches every sentence.
+TrigramQuery = list[frozenset[bytes]]
+
+
+def _lower_ascii(data: np.ndarray) -> np.ndarray:
+    upper = (data >= ord("A")) & (data <= ord("Z"))
+    data[upper] += ord("a") - ord("A")
+    return data
+
+
+def _pack(data: np.ndarray) -> np.ndarray:
+    """Packs each window of 3 bytes into an int32 key."""
+    data = data.astype(np.int32)
+    return (data[:-2] << 16) | (data[1:-1] << 8) | data[2:]
+
+
+def _trigrams(text: str) -> list[bytes]:
+    data = text.encode("utf-8").translate(_ASCII_LOWER)
+    return [data[i : i + 3] for i in range(len(data) - 2)]
+
+
+_ASCII_LOWER = bytes.maketrans(
+    bytes(range(ord("A"), ord("Z") + 1)), bytes(range(ord("a"), ord("z") + 1))
+)
+
+
+class TrigramIndex:
+    # Sentences read at a time when building
+    CHUNK_SIZE = 100_000
+
+    def __init__(
+        self, keys: np.ndarray, offsets: np.ndarray, postings: np.ndarray
+    ) -> None:
+        # Sorted distinct trigrams, packed into int32
+        self.keys = keys
+        # postings[offsets[i]:offsets[i + 1]] are the sorted ids (int32) of the
+        # sentences containing keys[i]
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def build(cls, text_store: TextStore) -> "TrigramIndex":
+        pairs_l = []
+        for start in range(0, text_store.size, cls.CHUNK_SIZE):
+            end = min(start + cls.CHUNK_SIZE, text_store.size)
+            offsets = np.asarray(text_store.offsets[start : end + 1])
+            data = np.array(text_store.data[offsets[0] : offsets[-1]])
+            if len(data) < 3:
+                continue
+            keys = _pack(_lower_ascii(data))
+            # Sentence id of each byte. Windows across sentences are dropped.
+            byte_ids = np.repeat(np.arange(start, end), np.diff(offsets))
+            valid = byte_ids[:-2] == byte_ids[2:]
+            pairs = (keys[valid].astype(np.int64) << 32) | byte_ids[:-2][valid]
+            pairs_l.append(sum_counts(pairs)[0])
+        pairs = np.sort(np.concatenate(pairs_l)) if pairs_l else np.empty(0, np.int64)
+        pair_keys = (pairs >> 32).astype(np.int32)
+        starts = np.flatnonzero(np.diff(pair_keys, prepend=-1))
+        offsets = np.append(starts, len(pairs)).astype(np.int64)
+        return cls(pair_keys[starts], offsets, (pairs & 0xFFFFFFFF).astype(np.int32))
+
+    def save(self, keys_path: Path, offsets_path: Path, postings_path: Path) -> None:
+        np.save(keys_path, self.keys)
+        np.save(offsets_path, self.offsets)
+        np.save(postings_path, self.postings)
+
+    @classmethod
+    def load(
+        cls, keys_path: Path, offsets_path: Path, postings_path: Path
+    ) -> "TrigramIndex":
+        return cls(
+            np.load(keys_path),
+            np.load(offsets_path),
+            np.load(postings_path, mmap_mode="r"),
+        )
+
+    def _spans(self, trigrams: frozenset[bytes]) -> list[tuple[int, int]]:
+        """Posting spans of the trigrams that are in the index."""
+        keys = np.array(
+            [(t[0] << 16) | (t[1] << 8) | t[2] for t in trigrams], dtype=np.int32
+        )
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return [
+            (int(self.offsets[i]), int(self.offsets[i + 1])) for i in positions[found]
+        ]
+
+    def sentences(self, trigrams: frozenset[bytes]) -> np.ndarray:
+        """Sorted ids of the sentences containing any of the trigrams."""
+        postings = [self.postings[start:end] for start, end in self._spans(trigrams)]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        return sum_counts(np.concatenate(postings))[0].astype(np.int64)
+
+    def candidates(self, pattern: str) -> np.ndarray | None:
+        """
+        Sorted ids of the sentences that can match pattern, or None if the
+        pattern has no required literals.
+        """
+        query = trigram_query(pattern)
+        if not query:
+            return None
+
+        def size(clause: frozenset[bytes]) -> int:
+            return sum(end - start for start, end in self._spans(clause))
+
+        ids = None
+        # Smallest posting lists first, so the intersection shrinks quickly
+        for clause in sorted(query, key=size):
+            clause_ids = self.sentences(clause)
+            if ids is None:
+                ids = clause_ids
+            else:
+                ids = np.intersect1d(ids, clause_ids, assume_unique=True)
+            if not len(ids):
+                break
+        return ids
+
+
+def trigram_query(pattern: str) -> TrigramQuery:
+    """
+    Trigrams required by any match of pattern, as clauses (see
+    TrigramQuery). Empty if nothing is required, or if the pattern can't be
+    analysed.
+    """
+    if sre_parse is None:
+        return []
+    try:
+        parsed = sre_parse.parse(pattern)
+        ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+        exact, query = _analyse_sequence(list(parsed), ignore_case)
+    except Exception:
+        # Invalid pattern (reported by the full search) or unexpected parser
+        # output, e.g. from a newer Python
+        return []
+    return _simplify(query + _exact_query(exact))
+
+
+def _literal(code: int, ignore_case: bool) -> set[str] | None:
+    char = chr(code)
+    if ignore_case and (not char.isascii() or char in UNICODE_FOLDED):
+        return None
+    return {char}
+
+
+def _analyse_class(items: list, ignore_case: bool) -> set[str] | None:
+    """Characters of a character class, if it's small and only literals."""
+    chars = set()
+    for op, arg in items:
+        if op is LITERAL:
+            literal = _literal(arg, ignore_case)
+            if literal is None:
+                return None
+            chars |= literal
+        elif op is RANGE and arg[1] - arg[0] < MAX_CLASS:
+            for code in range(arg[0], arg[1] + 1):
+                literal = _literal(code, ignore_case)
+                if literal is None:
+                    return None
+                chars |= literal
+        else:
+            # NEGATE, CATEGORY (e.g. \d), large ranges, unknown opcodes
+            return None
+        if len(chars) > MAX_CLASS:
+            return None
+    return chars
+
+
+def _analyse(op, arg, ignore_case: bool) -> tuple[set[str] | None, TrigramQuery]:
+    """
+    Returns (set of the exact strings the node matches, or None if unknown,
+    query of trigrams the node requires).
+    """
+    if op is LITERAL:
+        return _literal(arg, ignore_case), []
+    if op is IN:
+        return _analyse_class(arg, ignore_case), []
+    if op in (AT, ASSERT, ASSERT_NOT):
+        # Zero-width
+        return {""}, []
+    if op is SUBPATTERN:
+        _, add_flags, del_flags, items = arg
+        if add_flags & re.IGNORECASE:
+            ignore_case = True
+        if del_flags & re.IGNORECASE:
+            ignore_case = False
+        return _analyse_sequence(list(items), ignore_case)
+    if op is BRANCH:
+        results = [_analyse_sequence(list(items), ignore_case) for items in arg[1]]
+        if all(exact is not None for exact, _ in results):
+            exact = set().union(*(exact for exact, _ in results))  # type: ignore
+            if len(exact) <= MAX_EXACT:
+                return exact, []
+        # A match contains the required trigrams of at least one alternative
+        query = None
+        for exact, branch_query in results:
+            branch_query = branch_query + _exact_query(exact)
+            query = branch_query if query is None else _or(query, branch_query)
+        return None, query or []
+    if op in (MAX_REPEAT, MIN_REPEAT, POSSESSIVE_REPEAT):
+        min_count, max_count, items = arg
+        if min_count == 0:
+            return None, []
+        exact, query = _analyse_sequence(list(items), ignore_case)
+        if exact is not None and min_count == max_count:
+            repeated = {""}
+            for _ in range(min_count):
+                repeated = _product(repeated, exact)
+                if repeated is None:
+                    break
+            else:
+                return repeated, query
+        return None, query + _exact_query(exact)
+    # ANY, NOT_LITERAL, CATEGORY, GROUPREF, unknown opcodes, ...
+    return None, []
+
+
+def _analyse_sequence(
+    items: list, ignore_case: bool
+) -> tuple[set[str] | None, TrigramQuery]:
+    """_analyse for a sequence of nodes."""
+    # Exact strings of the nodes since the last unknown node
+    run: set[str] | None = {""}
+    query: TrigramQuery = []
+    exact_throughout = True
+    for op, arg in items:
+        exact, node_query = _analyse(op, arg, ignore_case)
+        query += node_query
+        if exact is not None and run is not None:
+            product = _product(run, exact)
+            if product is not None:
+                run = product
+                continue
+        # Adjacent text is unknown, so the run so far only contributes its own
+        # trigrams
+        exact_throughout = False
+        query += _exact_query(run)
+        run = exact
+    if exact_throughout:
+        return run, query
+    return None, query + _exact_query(run)
+
+
+def _product(left: set[str], right: set[str]) -> set[str] | None:
+    if len(left) * len(right) > MAX_EXACT:
+        return None
+    return {a + b for a in left for b in right}
+
+
+def _exact_query(exact: set[str] | None) -> TrigramQuery:
+    """
+    Query for matching one of the exact strings. Clause k has the k-th
+    trigram of each string, so any of the strings satisfies every clause.
+    """
+    if not exact:
+        return []
+    trigrams_l = [_trigrams(s) for s in exact]
+    n_clauses = min(len(trigrams) for trigrams in trigrams_l)
+    return [frozenset(trigrams[k] for trigrams in trigrams_l) for k in range(n_clauses)]
+
+
+def _or(left: TrigramQuery, right: TrigramQuery) -> TrigramQuery:
+    """Query for matching either query (distributed into clauses)."""
+    if not left or not right:
+        return []
+    return _simplify([a | b for a in left for b in right])
+
+
+def _simplify(query: TrigramQuery) -> TrigramQuery:
+    """Drops duplicate clauses, keeping the most selective if too many."""
+    query = sorted(set(query), key=len)
+    return query[:MAX_CLAUSES]
@@ -0,0 +1,31 @@
+"""Token vocabulary, mapping token strings to integer ids."""
+
+from typing import Iterable
+
+import numpy as np
+
+
+class Vocabulary:
+    def __init__(self, tokens: Iterable[str] = ()) -> None:
+        # Token string of each id
+        self.tokens: list[str] = []
+        self.ids: dict[str, int] = {}
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def add(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tokens: Iterable[str]) -> np.ndarray:
+        """Token ids (int32), adding unknown tokens to the vocabulary."""
+        return np.array([self.add(token) for token in tokens], dtype=np.int32)
+
+    def decode(self, token_ids: Iterable[int]) -> list[str]:
+        return [self.tokens[token_id] for token_id in token_ids]
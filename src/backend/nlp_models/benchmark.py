@@ -0,0 +1,127 @@
+"""
+Benchmark of the inference runtimes (see runtime.RuntimeConfig): sentences
+per second of a model on the same sentences under each configuration, and
+how closely its outputs agree with those of the first configuration (fp32
+on the CPU), e.g. to weigh the speed of int8 quantization against its
+accuracy.
+
+Run from the src folder:
+
+    python -m backend.nlp_models.benchmark ner sentences.txt --limit 500
+
+where sentences.txt has one sentence per line.
+"""
+
+import argparse
+from pathlib import Path
+import time
+from typing import Any, Callable
+
+import numpy as np
+
+from backend.nlp_models.runtime import RuntimeConfig, resolve_device
+
+# Sentences run before timing, so one-off setup isn't counted
+WARMUP_SENTS = 16
+
+
+def default_configs() -> dict[str, RuntimeConfig]:
+    configs = {
+        "cpu fp32": RuntimeConfig(device="cpu", quantize=False),
+        "cpu int8": RuntimeConfig(device="cpu", quantize=True),
+        "cpu onnx fp32": RuntimeConfig(device="cpu", quantize=False, onnx=True),
+        "cpu onnx int8": RuntimeConfig(device="cpu", quantize=True, onnx=True),
+    }
+    if resolve_device("auto") != "cpu":
+        configs["gpu"] = RuntimeConfig(device="auto")
+    return configs
+
+
+def _get_runner(model: str, runtime: RuntimeConfig, batch_size: int) -> Callable:
+    """Loads the model and returns a function that runs it on sentences."""
+    if model == "ner":
+        from backend.nlp_models.ner import NERModel
+
+        ner_model = NERModel(runtime)
+        return lambda sents: ner_model.classify_sents(sents, batch_size=batch_size)
+    if model == "grammar":
+        from backend.nlp_models.grammar import GrammarlyModel
+
+        grammar_model = GrammarlyModel(runtime)
+        return lambda sents: grammar_model.pipe(sents, batch_size=batch_size)
+    if model == "embeddings":
+        from backend.nlp_models.semantic import SemanticModel
+
+        semantic_model = SemanticModel(runtime=runtime)
+        return lambda sents: semantic_model.model.encode(sents, batch_size=batch_size)
+    raise ValueError(f"Unknown model: {model}")
+
+
+def _agreement(model: str, reference: Any, outputs: Any) -> float:
+    """
+    Agreement of outputs with the reference outputs: the share of sentences
+    with the same entities (ner) or corrections (grammar), or the mean cosine
+    similarity of the embeddings.
+    """
+    if model == "embeddings":
+        reference, outputs = np.asarray(reference), np.asarray(outputs)
+        norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(outputs, axis=1)
+        return float(np.mean((reference * outputs).sum(axis=1) / norms))
+    if model == "ner":
+        # Raw token entities (see NERModel.classify_sents): label and span
+        reference, outputs = (
+            [
+                {(e["entity"], e["start"], e["end"]) for e in entities}
+                for entities in entities_l
+            ]
+            for entities_l in (reference, outputs)
+        )
+    return float(np.mean([a == b for a, b in zip(reference, outputs)]))
+
+
+def benchmark(
+    model: str,
+    sentences: list[str],
+    configs: dict[str, RuntimeConfig] | None = None,
+    batch_size: int = 8,
+) -> list[tuple[str, float | str, float | None]]:
+    """
+    Returns [(config name, sentences per second, agreement)] for model
+    ("ner", "grammar" or "embeddings"). Agreement is with the outputs of the
+    first configuration that runs (see _agreement). Configurations that
+    can't be loaded (e.g. ONNX without optimum) get the error instead.
+    """
+    results = []
+    reference = None
+    for name, runtime in (configs or default_configs()).items():
+        try:
+            run = _get_runner(model, runtime, batch_size)
+            run(sentences[:WARMUP_SENTS])
+            start = time.perf_counter()
+            outputs = run(sentences)
+            speed = len(sentences) / (time.perf_counter() - start)
+        except Exception as e:
+            results.append((name, f"{type(e).__name__}: {e}", None))
+            continue
+        if reference is None:
+            reference = outputs
+        results.append((name, speed, _agreement(model, reference, outputs)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("model", choices=("ner", "grammar", "embeddings"))
+    parser.add_argument("sentences", type=Path, help="One sentence per line")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    lines = args.sentences.read_text(encoding="utf-8").splitlines()
+    sentences = [line.strip() for line in lines if line.strip()][: args.limit]
+    print(f"{args.model}: {len(sentences)} sentences, batch size {args.batch_size}")
+    results = benchmark(args.model, sentences, batch_size=args.batch_size)
+    for name, result, agreement in results:
+        if isinstance(result, float):
+            print(f"{name:<16}{result:>10.1f} sentences/s{agreement:>10.1%} agreement")
+        else:
+            print(f"{name:<16}{result}")
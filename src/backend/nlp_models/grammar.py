@@ -1,10 +1,21 @@
+from collections import deque
+import json
+from multiprocessing import get_context
+from pathlib import Path
 import re
 from typing import Any
 
 from gramformer import Gramformer
 
 from tqdm import tqdm
-from transformers import pipeline
+
+from backend.db.batch import SentenceData, iter_batches
+from backend.nlp_models.runtime import (
+    RuntimeConfig,
+    available_cores,
+    load_pipeline,
+    resolve_device,
+)
 
 
 def filter_sent(sent: str) -> bool:
@@ -17,8 +28,9 @@ def filter_sent(sent: str) -> bool:
 class GramformerModel:
     """Used for parsing errors and corrections from Grammarly model."""
 
-    def __init__(self) -> None:
-        self.model = Gramformer(models=1, use_gpu=True)
+    def __init__(self, runtime: RuntimeConfig | None = None) -> None:
+        device = resolve_device((runtime or RuntimeConfig()).device)
+        self.model = Gramformer(models=1, use_gpu=device != "cpu")
 
     def correct(self, sentence: str) -> str:  # type: ignore
         for sent in self.model.correct(sentence, max_candidates=1):  # type: ignore
@@ -59,15 +71,14 @@ class GramformerModel:
 class GrammarlyModel:
     """Used for highlighting errors and correcting them."""
 
-    def __init__(self) -> None:
-        self.pipeline = pipeline(
+    def __init__(self, runtime: RuntimeConfig | None = None) -> None:
+        self.pipeline = load_pipeline(
             "text2text-generation",
-            model="grammarly/coedit-large",
-            device="cuda:0",
+            "grammarly/coedit-large",
+            runtime,
             truncation=True,
             max_length=256,
         )
-        assert self.pipeline.device.__str__() == "cuda:0"
 
     def __call__(self, text: str) -> str:
         prompt = f"Fix grammatical errors in this sentence: {text}"
@@ -91,41 +102,186 @@ class GrammarlyModel:
             yield prompt
 
 
+class GrammarCheckpoint:
+    """
+    Results of a grammar run written as they're found, so an interrupted run
+    can be resumed. Each line is the JSON of a chunk: the ids of the
+    sentences done and their result rows.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def load(self) -> tuple[set[int], list[tuple]]:
+        """(ids of the sentences done, result rows)."""
+        done_ids = set()
+        results = []
+        if not self.path.exists():
+            return done_ids, results
+        with self.path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partly written when the run was interrupted
+                    break
+                done_ids.update(chunk["ids"])
+                results.extend(tuple(row) for row in chunk["rows"])
+        return done_ids, results
+
+    def add(self, ids: list[int], rows: list[tuple]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps({"ids": ids, "rows": rows}) + "\n")
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+# ERRANT annotator of a parsing process, set by _init_parser
+_annotator = None
+
+
+def _init_parser() -> None:
+    global _annotator
+    import errant
+
+    _annotator = errant.load("en")
+
+
+def get_replacements(
+    annotator: Any, original: str, corrected: str
+) -> list[dict[str, str]]:
+    """
+    Replacement edits from original to corrected (as from
+    GramformerModel.highlight_and_parse_errors, without the highlighting).
+    """
+    edits = annotator.annotate(annotator.parse(original), annotator.parse(corrected))
+    return [
+        {"type": edit.type[2:], "edit": edit.c_str, "original": edit.o_str}
+        for edit in edits
+        if edit.o_str and edit.c_str
+    ]
+
+
+def _parse_chunk(pairs: list[tuple[str, str]]) -> list[list[dict[str, str]]]:
+    """Replacements of each (original, corrected) pair."""
+    return [
+        get_replacements(_annotator, original, corrected)
+        for original, corrected in pairs
+    ]
+
+
 class GrammarTask:
     "Main class"
 
-    def __init__(self) -> None:
-        self.gramformer = GramformerModel()
-        self.grammarly = GrammarlyModel()
+    # Sentences corrected at a time, sorted by length so the batches of the
+    # correction model need little padding. Each chunk is checkpointed.
+    CHUNK_SIZE = 512
+    # Max parsing processes, which run alongside the correction model
+    MAX_PARSE_PROCESSES = 4
+    # Chunks corrected ahead of the parsing processes
+    MAX_PENDING = 2
+
+    def __init__(self, runtime: RuntimeConfig | None = None) -> None:
+        self.grammarly = GrammarlyModel(runtime)
 
     def get_errors(
         self,
-        sent_dicts: list[dict[str, Any]],
+        sent_dicts: SentenceData,
         batch_size: int = 8,
+        resume: bool = True,
         frontend_connect: Any = None,
+        checkpoint_path: Path | None = None,
     ) -> list[tuple[str]]:
-        results = []
-        sent_dicts = list(sent_dicts)[:25]
-        original_sents = []
-        for sent_d in sent_dicts:
-            original_sents.append(sent_d["sentence"])
-        if frontend_connect:
-            frontend_connect.taskInfo.emit(
-                "Finding grammatical errors. This might take a while...", None
-            )
-        corrected_sents = self.grammarly.pipe(original_sents, batch_size=batch_size)
-        for original_sent, corrected_sent in zip(original_sents, corrected_sents):
-            error_ds = self.gramformer.highlight_and_parse_errors(
-                original_sent, corrected_sent
-            )
-            for i, error_d in enumerate(error_ds):
-                results.append(
-                    (
-                        error_d["type"],
-                        error_d["original"],
-                        error_d["edit"],
-                        original_sent,
-                        sent_dicts[i]["file_path"],
+        """
+        Corrects every sentence with the Grammarly model and parses the
+        replacements with ERRANT in a process pool, while the next chunk is
+        corrected.
+
+        Args:
+            sent_dicts (SentenceData): SentenceBatch(es) or sent_dicts, with
+                file paths.
+            batch_size (int, optional): Defaults to 8.
+            resume (bool, optional): Skip the sentences already done in the
+                checkpoint. Defaults to True.
+            frontend_connect (Any, optional): Defaults to None.
+            checkpoint_path (Path | None, optional): Where results are written
+                as they're found (see GrammarCheckpoint). Removed when the run
+                completes. Defaults to None.
+
+        Returns:
+            list[tuple[str]]: (error type, original, edited, sentence, file)
+                for each error.
+        """
+        checkpoint = GrammarCheckpoint(checkpoint_path) if checkpoint_path else None
+        done_ids, results = set(), []
+        if checkpoint:
+            if resume:
+                done_ids, results = checkpoint.load()
+            else:
+                checkpoint.remove()
+        n_done = len(done_ids)
+
+        def report() -> None:
+            if frontend_connect:
+                frontend_connect.taskInfo.emit(
+                    f"Finding grammatical errors ({n_done} sentences done)", None
+                )
+
+        report()
+        pending = deque()
+
+        def collect() -> None:
+            nonlocal n_done
+            async_result, ids, sentences, file_paths, n_chunk = pending.popleft()
+            rows = []
+            for sentence, file_path, error_ds in zip(
+                sentences, file_paths, async_result.get()
+            ):
+                for error_d in error_ds:
+                    rows.append(
+                        (
+                            error_d["type"],
+                            error_d["original"],
+                            error_d["edit"],
+                            sentence,
+                            file_path,
+                        )
                     )
+            results.extend(rows)
+            if checkpoint:
+                checkpoint.add(ids, rows)
+            n_done += n_chunk
+            report()
+
+        processes = max(1, min(self.MAX_PARSE_PROCESSES, available_cores() - 1))
+        # Forking from the GUI's threads isn't safe
+        with get_context("spawn").Pool(processes, initializer=_init_parser) as pool:
+            for batch in iter_batches(sent_dicts, self.CHUNK_SIZE):
+                # All of the chunk's new sentences are done once it's parsed,
+                # including those that were filtered out
+                new_ids = [int(i) for i in batch.ids if i not in done_ids]
+                if not new_ids:
+                    continue
+                index = [
+                    i
+                    for i, sentence in enumerate(batch.sentences)
+                    if batch.ids[i] not in done_ids and filter_sent(sentence)
+                ]
+                index.sort(key=lambda i: len(batch.sentences[i]))
+                sentences = [batch.sentences[i] for i in index]
+                corrected = self.grammarly.pipe(sentences, batch_size=batch_size)
+                async_result = pool.apply_async(
+                    _parse_chunk, (list(zip(sentences, corrected)),)
                 )
+                ids = [i for i in new_ids if i >= 0]
+                file_paths = [batch.file_path(i) for i in index]
+                pending.append((async_result, ids, sentences, file_paths, len(new_ids)))
+                if len(pending) > self.MAX_PENDING:
+                    collect()
+            while pending:
+                collect()
+        if checkpoint:
+            checkpoint.remove()
         return results
@@ -1,20 +1,44 @@
 from collections import Counter
-from typing import Any
-from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
+from typing import Any, Iterable, Iterator, NamedTuple
+
+from backend.db.batch import SentenceBatch, SentenceData, iter_batches
+from backend.nlp_models.runtime import RuntimeConfig, load_pipeline
+
+# Number of sentences passed to the classifier at a time (for sent_dicts)
+SENT_CHUNK_SIZE = 1000
+# Max tokens per classifier input, including special tokens
+MAX_LENGTH = 512
+# Tokens shared by consecutive windows of a sentence longer than MAX_LENGTH
+STRIDE = 64
+
+
+class _Piece(NamedTuple):
+    """A sentence, or a window of a long sentence, to classify."""
+
+    sent_index: int
+    # Characters of the sentence passed to the classifier
+    char_start: int
+    char_end: int
+    # Characters whose entities are taken from this piece (overlaps between
+    # windows are split at their middle token)
+    keep_start: int
+    keep_end: int
+    n_tokens: int
 
 
 class NERModel:
     """Named entity recognition"""
 
-    def __init__(self):
-        tokenizer = AutoTokenizer.from_pretrained(
-            "xlm-roberta-large-finetuned-conll03-english"
-        )
-        model = AutoModelForTokenClassification.from_pretrained(
-            "xlm-roberta-large-finetuned-conll03-english"
+    def __init__(self, runtime: RuntimeConfig | None = None):
+        self.classifier = load_pipeline(
+            "ner", "xlm-roberta-large-finetuned-conll03-english", runtime
         )
-        self.classifier = pipeline(
-            "ner", model=model, tokenizer=tokenizer, device="cuda:0"
+        tokenizer = self.classifier.tokenizer
+        self.tokenizer = tokenizer
+        # Tokens per piece, leaving room for the special tokens
+        self.max_tokens = (
+            min(tokenizer.model_max_length, MAX_LENGTH)
+            - tokenizer.num_special_tokens_to_add()
         )
 
     def get_entities(
@@ -36,9 +60,14 @@ class NERModel:
             return entities
 
     def combine_entities(self, entities: dict[int, Any]):
+        """
+        Combines the raw (subword) entities into words, as dicts of type,
+        word, and the start and end offsets of the word.
+        """
         combined_entities = []
         current_word = ""
         current_entity = ""
+        current_start = current_end = 0
 
         for i in range(len(entities)):
             entity = entities[i]
@@ -54,38 +83,207 @@ class NERModel:
                 # If not, save the current entity (if any) and start a new one
                 if current_word:
                     combined_entities.append(
-                        {"type": current_entity, "word": current_word}
+                        {
+                            "type": current_entity,
+                            "word": current_word,
+                            "start": current_start,
+                            "end": current_end,
+                        }
                     )
                 current_word = word.lstrip("▁")  # Start a new word
                 current_entity = entity_type  # Set the new entity type
+                current_start = entity["start"]
+            current_end = entity["end"]
 
         # Add the last combined entity if it exists
         if current_word:
-            combined_entities.append({"type": current_entity, "word": current_word})
+            combined_entities.append(
+                {
+                    "type": current_entity,
+                    "word": current_word,
+                    "start": current_start,
+                    "end": current_end,
+                }
+            )
 
         return combined_entities
 
+    def iter_entity_rows(
+        self,
+        batches: Iterable[SentenceBatch],
+        batch_size: int = 8,
+        frontend_connect: Any | None = None,
+        n_batches: int | None = None,
+    ) -> Iterator[list[tuple[int, int, int, str, str]]]:
+        """
+        Yields the entities of each batch of database sentences as (sentence
+        id, start, end, type, text) rows (see DatabaseManager.insert_entities).
+        n_batches (the number of batches, if known) is the progress total.
+        """
+        if frontend_connect:
+            frontend_connect.taskInfo.emit("Finding named entities.", n_batches)
+        for batch in batches:
+            if not len(batch):
+                continue
+            raw_entities_l = self.classify_sents(
+                batch.sentences,
+                batch_size=batch_size,
+                frontend_connect=frontend_connect,
+            )
+            yield [
+                (
+                    sentence_id,
+                    entity["start"],
+                    entity["end"],
+                    entity["type"],
+                    entity["word"],
+                )
+                for sentence_id, raw_entities in zip(batch.ids.tolist(), raw_entities_l)
+                for entity in self.combine_entities(raw_entities)
+            ]
+
+    def _get_pieces(self, sentences: list[str]) -> list[_Piece]:
+        """
+        Splits sentences into pieces that fit the model, as windows of
+        max_tokens tokens overlapping by STRIDE tokens for long sentences
+        (which the pipeline would otherwise truncate).
+        """
+        encodings = self.tokenizer(
+            sentences, add_special_tokens=False, return_offsets_mapping=True
+        )
+        step = self.max_tokens - STRIDE
+        pieces = []
+        for i, (sentence, offsets) in enumerate(
+            zip(sentences, encodings["offset_mapping"])
+        ):
+            n = len(offsets)
+            if not n:
+                continue
+            if n <= self.max_tokens:
+                pieces.append(_Piece(i, 0, len(sentence), 0, len(sentence), n))
+                continue
+            windows = []
+            start = 0
+            while True:
+                end = min(start + self.max_tokens, n)
+                windows.append((start, end))
+                if end == n:
+                    break
+                start += step
+            cuts = [offsets[start + STRIDE // 2][0] for start, _ in windows[1:]]
+            keep_starts = [0] + cuts
+            keep_ends = cuts + [len(sentence)]
+            for (start, end), keep_start, keep_end in zip(
+                windows, keep_starts, keep_ends
+            ):
+                pieces.append(
+                    _Piece(
+                        i,
+                        offsets[start][0],
+                        offsets[end - 1][1],
+                        keep_start,
+                        keep_end,
+                        end - start,
+                    )
+                )
+        return pieces
+
+    def classify_sents(
+        self,
+        sentences: list[str],
+        batch_size: int = 8,
+        frontend_connect: Any | None = None,
+    ) -> list[list[dict]]:
+        """
+        Raw entities of each sentence (as from get_entities with raw=True).
+
+        Pieces (see _get_pieces) are classified in order of token length, so
+        each batch needs little padding, and streamed through the pipeline.
+        Entities of the windows of a long sentence are merged back in order,
+        with offsets into the whole sentence. Progress is incremented once
+        per call, so callers set the task's total to their number of calls.
+        """
+        pieces = sorted(self._get_pieces(sentences), key=lambda piece: piece.n_tokens)
+        texts = (
+            sentences[piece.sent_index][piece.char_start : piece.char_end]
+            for piece in pieces
+        )
+        entities_l = [[] for _ in sentences]
+        # A generator is classified lazily, batch_size inputs at a time
+        outputs = self.classifier(texts, batch_size=batch_size)
+        for piece, raw_entities in zip(pieces, outputs):  # type: ignore
+            for entity in raw_entities:
+                start = entity["start"] + piece.char_start
+                if piece.keep_start <= start < piece.keep_end:
+                    entities_l[piece.sent_index].append(
+                        {
+                            **entity,
+                            "start": start,
+                            "end": entity["end"] + piece.char_start,
+                        }
+                    )
+        for entities in entities_l:
+            entities.sort(key=lambda entity: entity["start"])
+        if frontend_connect:
+            frontend_connect.increment.emit()
+        return entities_l
+
     def get_entities_from_sents(
         self,
-        sent_dicts: dict[str, Any],
+        sents: SentenceData,
         batch_size: int = 8,
         frontend_connect: Any | None = None,
     ):
-        model = NERModel()
-        sents = [sent_d["sentence"] for sent_d in sent_dicts]  # type: ignore
+        """
+        Args:
+            sents (SentenceData): SentenceBatch(es) or sent_dicts.
+        """
+        return self.get_entities_from_grouped_sents(
+            iter_batches(sents, SENT_CHUNK_SIZE),
+            1,
+            batch_size=batch_size,
+            frontend_connect=frontend_connect,
+        )[0]
+
+    def get_entities_from_grouped_sents(
+        self,
+        grouped_batches: Iterable[SentenceBatch],
+        n_groups: int,
+        batch_size: int = 8,
+        frontend_connect: Any | None = None,
+        n_batches: int | None = None,
+    ):
+        """
+        Counts entities for several selections (groups) in one pass.
+        grouped_batches have their group membership set, and are consumed
+        one at a time so that streamed selections don't have to be held in
+        memory. Each sentence is only classified once (see classify_sents).
+        n_batches (the number of batches, if known) is the progress total.
+        """
         if frontend_connect:
             frontend_connect.taskInfo.emit(
-                "Finding named entities. This might take a while...", None
+                "Finding named entities. This might take a while...", n_batches
+            )
+        counters = [Counter() for _ in range(n_groups)]
+        for batch in grouped_batches:
+            if not len(batch):
+                continue
+            raw_entities_l = self.classify_sents(
+                batch.sentences,
+                batch_size=batch_size,
+                frontend_connect=frontend_connect,
             )
-        entities = model.get_entities(sents, batch_size=batch_size)
-        if not entities:
-            return []
-        entity_type_tuples = [
-            (entity["word"], entity["type"])  # type: ignore
-            for entity in entities
-        ]
-        entities_counter = Counter(entity_type_tuples)
-        results = []
-        for (word, ent_type), count in entities_counter.most_common():
-            results.append((word, ent_type, count))
-        return results
+            for raw_entities, groups in zip(raw_entities_l, batch.iter_groups()):
+                entities = [
+                    (entity["word"], entity["type"])
+                    for entity in self.combine_entities(raw_entities)
+                ]
+                for group in groups:
+                    counters[group].update(entities)
+        results_l = []
+        for entities_counter in counters:
+            results = []
+            for (word, ent_type), count in entities_counter.most_common():
+                results.append((word, ent_type, count))
+            results_l.append(results)
+        return results_l
@@ -0,0 +1,175 @@
+"""
+Inference runtime for the transformer models (NER, grammar and sentence
+embeddings).
+
+Models run on the GPU if there is one and fall back to the CPU otherwise.
+On the CPU, torch's thread pools are sized to the available cores and the
+linear layers can optionally be quantized to int8 (dynamic quantization),
+which is usually 2-4x faster but can change results (see benchmark for the
+speed and agreement of each configuration). Models can also be
+exported to ONNX and run with onnxruntime, if optimum is installed.
+
+torch and the model libraries are imported when a model is loaded, so the
+config can be imported without them.
+"""
+
+import os
+from pathlib import Path
+import shutil
+from typing import Any
+
+from pydantic import BaseModel
+
+# Exported ONNX models, by model name
+ONNX_CACHE = Path.home() / ".cache" / "corpus_tools" / "onnx"
+
+
+class RuntimeConfig(BaseModel):
+    # "auto" (GPU if available), "cpu", "cuda", "cuda:1", ...
+    device: str = "auto"
+    # Threads used within an op on the CPU (0 for the number of cores)
+    intra_op_threads: int = 0
+    # Ops run in parallel on the CPU. The models run one op at a time, so
+    # more threads only compete with intra-op threads.
+    inter_op_threads: int = 1
+    # Dynamic int8 quantization of linear layers (CPU only). Faster, but
+    # results can differ from fp32.
+    quantize: bool = False
+    # Run with onnxruntime instead of torch (CPU only, needs optimum)
+    onnx: bool = False
+
+
+def resolve_device(device: str = "auto") -> str:
+    import torch
+
+    if device == "auto":
+        return "cuda:0" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        return "cpu"
+    return device
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_threads(runtime: RuntimeConfig) -> None:
+    import torch
+
+    torch.set_num_threads(runtime.intra_op_threads or available_cores())
+    try:
+        torch.set_num_interop_threads(runtime.inter_op_threads)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        pass
+
+
+def quantize_linear(model: Any) -> Any:
+    """Torch model with its linear layers dynamically quantized to int8."""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def prepare(runtime: RuntimeConfig | None) -> tuple[RuntimeConfig, str]:
+    """Returns (runtime, device), with threads configured for the CPU."""
+    runtime = runtime or RuntimeConfig()
+    device = resolve_device(runtime.device)
+    if device == "cpu":
+        configure_threads(runtime)
+    return runtime, device
+
+
+def _export_onnx(ort_class: Any, model_name: str, quantize: bool) -> Path:
+    """
+    Exports a model to ONNX (and quantizes it) once, returning the folder
+    it's saved in.
+    """
+    export_dir = ONNX_CACHE / model_name.replace("/", "--")
+    if not export_dir.exists():
+        model = ort_class.from_pretrained(model_name, export=True)
+        model.save_pretrained(export_dir)
+    if not quantize:
+        return export_dir
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_dir = export_dir.with_name(export_dir.name + "--int8")
+    if not quantized_dir.exists():
+        shutil.copytree(
+            export_dir, quantized_dir, ignore=shutil.ignore_patterns("*.onnx")
+        )
+        for onnx_path in export_dir.glob("*.onnx"):
+            quantize_dynamic(
+                onnx_path, quantized_dir / onnx_path.name, weight_type=QuantType.QInt8
+            )
+    return quantized_dir
+
+
+def _load_onnx(ort_class_name: str, model_name: str, quantize: bool) -> Any:
+    try:
+        import optimum.onnxruntime as ort
+    except ImportError:
+        raise ImportError(
+            "ONNX inference needs optimum: pip install optimum[onnxruntime]"
+        )
+    ort_class = getattr(ort, ort_class_name)
+    return ort_class.from_pretrained(_export_onnx(ort_class, model_name, quantize))
+
+
+def load_pipeline(
+    task: str,
+    model_name: str,
+    runtime: RuntimeConfig | None = None,
+    **pipeline_kwargs,
+) -> Any:
+    """
+    Transformers pipeline for "ner" or "text2text-generation", on the
+    runtime's device.
+    """
+    from transformers import (
+        AutoModelForSeq2SeqLM,
+        AutoModelForTokenClassification,
+        AutoTokenizer,
+        pipeline,
+    )
+
+    runtime, device = prepare(runtime)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if task == "ner":
+        model_class, ort_class_name = (
+            AutoModelForTokenClassification,
+            "ORTModelForTokenClassification",
+        )
+    else:
+        model_class, ort_class_name = AutoModelForSeq2SeqLM, "ORTModelForSeq2SeqLM"
+    if device == "cpu" and runtime.onnx:
+        model = _load_onnx(ort_class_name, model_name, runtime.quantize)
+    else:
+        model = model_class.from_pretrained(model_name)
+        if device == "cpu" and runtime.quantize:
+            model = quantize_linear(model)
+    return pipeline(
+        task, model=model, tokenizer=tokenizer, device=device, **pipeline_kwargs
+    )
+
+
+def load_sentence_transformer(
+    model_name: str, runtime: RuntimeConfig | None = None
+) -> Any:
+    """
+    SentenceTransformer on the runtime's device. ONNX models aren't
+    quantized here, since sentence-transformers exports them itself.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    runtime, device = prepare(runtime)
+    if device == "cpu" and runtime.onnx:
+        return SentenceTransformer(model_name, device=device, backend="onnx")
+    model = SentenceTransformer(model_name, device=device)
+    if device == "cpu" and runtime.quantize:
+        model = quantize_linear(model)
+    return model
@@ -1,8 +1,9 @@
 from collections import Counter
-from typing import Any
+from numpy import ndarray
+from sentence_transformers import util
 
-from numpy import ndarray, array
-from sentence_transformers import SentenceTransformer, util
+from backend.db.batch import SentenceBatch, SentenceData, iter_batches
+from backend.nlp_models.runtime import RuntimeConfig, load_sentence_transformer
 
 
 class SemanticModel:
@@ -11,8 +12,9 @@ class SemanticModel:
     def __init__(
         self,
         model_name: str = "msmarco-distilbert-base-v4",
+        runtime: RuntimeConfig | None = None,
     ) -> None:
-        self.model = SentenceTransformer(model_name)
+        self.model = load_sentence_transformer(model_name, runtime)
 
     def encode_sents(self, sents: list[str]) -> None:
         print("\nEncoding sentences. This might take a while...")
@@ -57,18 +59,24 @@ class SemanticModel:
     def query_sents_from_db(
         self,
         query: str | list[str],
-        sent_dicts: list[dict[str, Any]],
+        sents: SentenceData,
         top_n: int | None = 25,
     ) -> list[dict[str, str]]:
+        """
+        Args:
+            sents (SentenceData): SentenceBatch(es) or sent_dicts, with
+                embeddings and file paths.
+        """
         if type(query) is str:
             query = [query]
+        batch = SentenceBatch.concat(iter_batches(sents))
+        if batch.embeddings is None:
+            return []
         all_scores = []
-        embeds = [sent_d["embedding"] for sent_d in sent_dicts]
-        embeds = array(embeds)
         for query_str in query:
             query_embed = self.model.encode(query_str)
             query_scores = (
-                util.cos_sim(query_embed, embeds)[  # type: ignore
+                util.cos_sim(query_embed, batch.embeddings)[  # type: ignore
                     0
                 ]
                 .cpu()
@@ -79,8 +87,7 @@ class SemanticModel:
         counter = Counter({i: score for i, score in enumerate(max_scores)})
         results = []
         for i, score in counter.most_common(top_n):
-            sent_dict = sent_dicts[i]
             results.append(
-                {"sentence": sent_dict["sentence"], "file_path": sent_dict["file_path"]}
+                {"sentence": batch.sentences[i], "file_path": batch.file_path(i)}
             )
         return results
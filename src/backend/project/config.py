@@ -15,6 +15,7 @@ from backend.corpus.items import (
     TextCategory,
     CorpusItem,
 )
+from backend.nlp_models.runtime import RuntimeConfig
 from backend.utils.functions import is_quant
 from frontend.styles.colors import random_color_rgb
 
@@ -154,6 +155,22 @@ class Config(BaseSettings):
 
     status: dict[str, Any]
     corpus_config: CorpusConfig
+    # Memory budget for cached selection results (sentence id arrays)
+    selection_cache_mb: int = 64
+    # N-gram sizes indexed when the corpus is processed (see NGramIndex)
+    ngram_index_sizes: list[int] = [2, 3]
+    # Device and CPU settings of the transformer models
+    runtime: RuntimeConfig = Field(default_factory=RuntimeConfig)
+    # Whether to store the POS, lemma, morphology and dependency head of each
+    # word token when the corpus is processed (see AnnotationStore)
+    annotate_tokens: bool = False
+    # spaCy processes for tokenizing (and annotating) sentences at ingest, 0
+    # for the number of cores. More than 1 starts a pool of spawned processes
+    # (see SpacyModel.tokenize).
+    spacy_processes: int = 1
+    # Whether to run NER over all sentences when the corpus is processed,
+    # storing the entities for NER counts and entity filters
+    extract_entities: bool = False
 
     def save(self, path: Path) -> None:
         path.open("w").write(self.model_dump_json())
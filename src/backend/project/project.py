@@ -1,19 +1,57 @@
+import hashlib
 import json
 from pathlib import Path
 import shutil
-from typing import Any
+from typing import Any, Iterator
 
 
+import numpy as np
+
+from backend.db.batch import SentenceBatch
+from backend.db.bitmaps import BitmapIndex
+from backend.db.cache import SelectionCache, canonicalize_selection
+from backend.db.grouped import GroupedSelection
+from backend.db.stores import AnnotationStore, NGramIndex, TextStore, TokenStore
+from backend.db.trigrams import TrigramIndex
 from backend.db.db import DatabaseManager
 from backend.corpus.process.process_corpus import CorpusProcessor
 from backend.project.config import Config
-from backend.corpus.items import CorpusItem
+from backend.corpus.items import CorpusItem, MetaType
 
 
 class Paths:
     def __init__(self, project_folder: Path):
         self.project_folder = project_folder
         self.corpus_db = project_folder / "corpus.db"
+        self.bitmaps = project_folder / "bitmaps.npz"
+        self.sentence_text = project_folder / "sentences.bin"
+        self.sentence_offsets = project_folder / "sentence_offsets.npy"
+        self.tokens = project_folder / "tokens.bin"
+        self.token_offsets = project_folder / "token_offsets.npy"
+        self.annotations = (
+            project_folder / "annotations.bin",
+            project_folder / "annotation_offsets.npy",
+            project_folder / "annotation_labels.json",
+        )
+        self.checkpoints = project_folder / "checkpoints"
+        self.trigram_index = (
+            project_folder / "trigram_keys.npy",
+            project_folder / "trigram_offsets.npy",
+            project_folder / "trigram_postings.npy",
+        )
+
+    def task_checkpoint(self, task_name: str, selection: dict[str, Any]) -> Path:
+        """Checkpoint file of a resumable task on a selection."""
+        key = hashlib.sha1(canonicalize_selection(selection).encode()).hexdigest()
+        return self.checkpoints / f"{task_name}_{key[:16]}.jsonl"
+
+    def ngram_index(self, n: int) -> tuple[Path, Path, Path]:
+        """(data, offsets, windows) paths of the n-gram index for n."""
+        return (
+            self.project_folder / f"ngrams_{n}.bin",
+            self.project_folder / f"ngrams_{n}_offsets.npy",
+            self.project_folder / f"ngrams_{n}_windows.npy",
+        )
 
 
 class Project:
@@ -39,6 +77,7 @@ class Project:
             config_d = json.load(f)
         self.config = Config.model_validate(config_d)
         self.corpus_config = self.config.corpus_config
+        self.selection_cache = SelectionCache(self.config.selection_cache_mb * 2**20)
         if self.config.status["corpus_processed"]:
             self.load_db_manager()
 
@@ -93,17 +132,49 @@ class Project:
         self._save_config()
 
     def load_db_manager(self, new_db: bool = False):
+        self.selection_cache.clear()
         self.db = DatabaseManager(self.paths.corpus_db)
+        self.bitmaps = None
+        self.text_store = None
+        self.token_store = None
+        self.annotation_store = None
+        self.ngram_indexes: dict[int, NGramIndex] = {}
+        self.trigram_index = None
         if new_db:
             self.db.setup()
         else:
             self.db.connect()
+            if self.paths.bitmaps.is_file():
+                self.bitmaps = BitmapIndex.load(self.paths.bitmaps)
+            if self.paths.sentence_text.is_file():
+                self.text_store = TextStore.load(
+                    self.paths.sentence_text, self.paths.sentence_offsets
+                )
+            if self.paths.tokens.is_file():
+                self.token_store = TokenStore.load(
+                    self.paths.tokens, self.paths.token_offsets, self.db.vocabulary
+                )
+            if all(path.is_file() for path in self.paths.annotations):
+                self.annotation_store = AnnotationStore.load(*self.paths.annotations)
+            if all(path.is_file() for path in self.paths.trigram_index):
+                self.trigram_index = TrigramIndex.load(*self.paths.trigram_index)
+            for n in self.config.ngram_index_sizes:
+                paths = self.paths.ngram_index(n)
+                if all(path.is_file() for path in paths):
+                    self.ngram_indexes[n] = NGramIndex.load(*paths, self.db.vocabulary)
 
     def load_corpus_processor(self, new_db: bool = False) -> None:
         self.load_db_manager(new_db=new_db)
         if not self.corpus_config:
             raise ValueError("No corpus config provided")
-        self.corpus_processor = CorpusProcessor(self.corpus_config, self.db)  # type: ignore
+        self.corpus_processor = CorpusProcessor(
+            self.corpus_config,  # type: ignore
+            self.db,
+            self.config.runtime,
+            annotate=self.config.annotate_tokens,
+            spacy_processes=self.config.spacy_processes,
+            extract_entities=self.config.extract_entities,
+        )
 
     def process_corpus(
         self, add_embeddings: bool = True, frontend_connect: Any = None
@@ -122,14 +193,199 @@ class Project:
         Raises:
             ValueError: If no corpus config is provided.
         """
+        # Invalidates cached selection results from earlier processing
+        self.config.status["db_generation"] = self.db_generation + 1
+        # Checkpoints of interrupted tasks have the old sentence ids
+        shutil.rmtree(self.paths.checkpoints, ignore_errors=True)
         self.load_corpus_processor(new_db=True)
         self.corpus_processor.process_files(
             add_embeddings=add_embeddings, frontend_connect=frontend_connect
         )  # type: ignore
+        self.build_bitmaps()
+        self.build_stores()
         if not self.corpus_config:
             raise ValueError("No corpus config provided")
 
+    def build_bitmaps(self) -> None:
+        """Builds and saves the bitmap index used to resolve selections."""
+        quantitative = {
+            (meta_prop.label_name, meta_prop.name)
+            for meta_prop in self.corpus_config.get_meta_properties()  # type: ignore
+            if meta_prop.type is MetaType.QUANTITATIVE
+        }
+        self.bitmaps = BitmapIndex.build(self.db, quantitative)
+        self.bitmaps.save(self.paths.bitmaps)
+
+    def build_stores(self) -> None:
+        """
+        Exports sentence text, token ids and token annotations (if stored) to
+        memory-mapped stores, used instead of the database by tasks that only
+        scan sentences/tokens, and builds the text indexes: n-gram indexes for
+        the configured sizes and the trigram index for regexes.
+        """
+        self.text_store = TextStore.build(
+            self.db, self.paths.sentence_text, self.paths.sentence_offsets
+        )
+        self.token_store = TokenStore.build(
+            self.db, self.paths.tokens, self.paths.token_offsets
+        )
+        if self.db.has_annotations():
+            self.annotation_store = AnnotationStore.build(
+                self.db, *self.paths.annotations
+            )
+        else:
+            for path in self.paths.annotations:
+                path.unlink(missing_ok=True)
+            self.annotation_store = None
+        self.ngram_indexes = {
+            n: NGramIndex.build(self.token_store, n, *self.paths.ngram_index(n))
+            for n in self.config.ngram_index_sizes
+        }
+        self.trigram_index = TrigramIndex.build(self.text_store)
+        self.trigram_index.save(*self.paths.trigram_index)
+
+    @property
+    def db_generation(self) -> int:
+        return self.config.status.get("db_generation", 0)
+
+    def corpus_query_ids(self, query: dict[str, Any]) -> np.ndarray:
+        """
+        Returns the sorted sentence ids for a selection, from the selection
+        cache if the same selection was queried since the corpus was last
+        processed. Otherwise it's resolved with the bitmap index, or with SQL
+        for filters the index can't answer.
+        """
+        if not self.config.status["corpus_processed"]:
+            raise ValueError("Need to process corpus first")
+        ids = self.selection_cache.get(query, self.db_generation)
+        if ids is None:
+            if self.bitmaps:
+                ids = self.bitmaps.resolve(query)
+            if ids is None:
+                ids = self.db.get_sent_ids(**query)
+            self.selection_cache.put(query, self.db_generation, ids)
+        return ids
+
     def corpus_query(self, query: dict[str, Any]) -> dict[str, Any]:
         if not self.config.status["corpus_processed"]:
             raise ValueError("Need to process corpus first")
         return self.db.get_sents(**query)
+
+    def _iter_batches(
+        self, ids: np.ndarray, columns: tuple[str, ...]
+    ) -> Iterator[SentenceBatch]:
+        # Scans of only sentences and tokens are read from the stores
+        other_columns = set(columns) - {"id", "sentence"}
+        if self.text_store and not other_columns:
+            return self.text_store.iter_batches(ids)
+        if self.text_store and self.token_store and other_columns == {"tokens"}:
+            return map(self.token_store.add_tokens, self.text_store.iter_batches(ids))
+        return self.db.iter_sent_batches(ids=ids, columns=columns)
+
+    def iter_corpus_query(
+        self,
+        query: dict[str, Any],
+        columns: tuple[str, ...] = ("sentence", "file_path"),
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Streaming version of corpus_query, yielding sent_dicts (see
+        SentenceBatch.records). Matching ids are resolved through
+        corpus_query_ids.
+        """
+        for batch in self.iter_corpus_batches(query, columns):
+            yield from batch.records()
+
+    def iter_corpus_batches(
+        self,
+        query: dict[str, Any],
+        columns: tuple[str, ...] = ("sentence", "file_path"),
+    ) -> Iterator[SentenceBatch]:
+        """Same as iter_corpus_query, but yields SentenceBatches."""
+        return self._iter_batches(self.corpus_query_ids(query), columns)
+
+    def corpus_batch(
+        self,
+        query: dict[str, Any],
+        columns: tuple[str, ...] = ("sentence", "file_path"),
+    ) -> SentenceBatch:
+        """Whole selection as a single SentenceBatch."""
+        return SentenceBatch.concat(self.iter_corpus_batches(query, columns))
+
+    def grouped_selection(self, queries: list[dict[str, Any]]) -> GroupedSelection:
+        return GroupedSelection([self.corpus_query_ids(q) for q in queries])
+
+    def get_word_counts(self, ids: np.ndarray) -> np.ndarray | None:
+        """Word (token) count of each sentence, from the token store."""
+        if self.token_store is None:
+            return None
+        starts, ends = self.token_store.spans(ids)
+        return ends - starts
+
+    def get_group_counts(
+        self, grouped: GroupedSelection
+    ) -> list[dict[str, int]] | None:
+        """
+        Sentence and word counts of each group, from the token store (None
+        without it).
+        """
+        word_counts = self.get_word_counts(grouped.ids)
+        if word_counts is None:
+            return None
+        word_counts = word_counts @ grouped.membership
+        return [
+            {"sent_count": sent_count, "word_count": word_count}
+            for sent_count, word_count in zip(
+                grouped.group_sizes.tolist(), word_counts.tolist()
+            )
+        ]
+
+    def iter_grouped_corpus_query(
+        self,
+        queries: list[dict[str, Any]],
+        columns: tuple[str, ...] = ("sentence", "file_path"),
+    ) -> Iterator[SentenceBatch]:
+        """
+        Streams the union of several selections once, as SentenceBatches
+        whose groups are the queries each sentence matches.
+        """
+        return self.iter_grouped_batches(self.grouped_selection(queries), columns)
+
+    def iter_grouped_batches(
+        self,
+        grouped: GroupedSelection,
+        columns: tuple[str, ...] = ("sentence", "file_path"),
+    ) -> Iterator[SentenceBatch]:
+        """Same as iter_grouped_corpus_query, for a GroupedSelection."""
+        return grouped.tag(self._iter_batches(grouped.ids, columns))
+
+    def get_entity_types(self) -> list[str]:
+        """Types of the entities stored at ingest (empty if none were)."""
+        if not self.config.status["corpus_processed"]:
+            return []
+        return self.db.get_entity_types()
+
+    def count_entities(
+        self, queries: list[dict[str, Any]]
+    ) -> list[list[tuple[str, str, int]]] | None:
+        """
+        Entity counts of each selection from the entities stored at ingest
+        (see DatabaseManager.count_entities), or None if there are none.
+        """
+        if not self.db.has_entities():
+            return None
+        # Unfiltered selections are the whole corpus
+        return [
+            self.db.count_entities(
+                self.corpus_query_ids(query) if any(query.values()) else None
+            )
+            for query in queries
+        ]
+
+    def regex_candidates(self, pattern: str) -> np.ndarray | None:
+        """
+        Sorted ids of the sentences that can match pattern, from the trigram
+        index. None if all sentences need to be searched.
+        """
+        if self.trigram_index is None:
+            return None
+        return self.trigram_index.candidates(pattern)
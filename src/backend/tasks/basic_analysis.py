@@ -1,23 +1,121 @@
+from typing import Any
+
 from frontend.widgets.tables import SearchableTable
 from backend.nlp_models.grammar import GrammarTask
 from backend.nlp_models.ner import NERModel
-from backend.utils.nlp import get_n_grams_from_corpus, summary
+from backend.project.project import Project
+from backend.utils.nlp import (
+    get_lemmas_from_corpus,
+    get_lemmas_from_grouped_corpus,
+    get_lemmas_from_store,
+    get_n_grams_from_corpus,
+    get_n_grams_from_grouped_corpus,
+    get_n_grams_from_index,
+    summary,
+    summary_grouped,
+)
+
+
+def get_indexed_n_grams(
+    project: Project,
+    selections: list[dict[str, Any]],
+    n=2,
+    ignore_stopword_pairs=True,
+    approximate=False,
+    memory_budget_mb=64,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, int]]] | None:
+    """
+    N-grams of the selections from the project's n-gram index, or None if n
+    isn't indexed. Indexed counts are always exact, so approximate and
+    memory_budget_mb are ignored.
+    """
+    index = project.ngram_indexes.get(n)
+    if index is None:
+        return None
+    return get_n_grams_from_index(
+        index,
+        project.grouped_selection(selections),
+        ignore_stopword_pairs=ignore_stopword_pairs,
+        frontend_connect=frontend_connect,
+    )
+
+
+def get_stored_lemmas(
+    project: Project,
+    selections: list[dict[str, Any]],
+    content_words_only=False,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, str, int]]] | None:
+    """
+    Lemmas of the selections from the project's stored token annotations,
+    or None if the corpus was processed without them.
+    """
+    if project.annotation_store is None:
+        return None
+    return get_lemmas_from_store(
+        project.annotation_store,
+        project.grouped_selection(selections),
+        content_words_only=content_words_only,
+        frontend_connect=frontend_connect,
+    )
 
 
+def get_stored_entities(
+    project: Project,
+    selections: list[dict[str, Any]],
+    batch_size: int = 8,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, str, int]]] | None:
+    """
+    Entity counts of the selections from the entities stored at ingest, or
+    None if the corpus was processed without them. batch_size is only used
+    when running the model.
+    """
+    if not project.db.has_entities():
+        return None
+    if frontend_connect:
+        frontend_connect.taskInfo.emit("Counting stored named entities.", None)
+    return project.count_entities(selections)
+
+
+# "grouped_func" (optional) evaluates all selections in one pass over their
+# union. It takes SentenceBatches with their group membership set and the
+# number of groups, and returns a list of results, one per selection.
+# "index_func" (optional) answers from precomputed project indexes. It takes the
+# project and the selections, and returns the same list, or None to fall back
+# to grouped_func/func.
+# "checkpoint" (optional) marks resumable tasks, whose func gets the path of a
+# checkpoint file for each selection.
 TASK_DICT = {
     "Summary": {
         "func": summary,
+        "grouped_func": summary_grouped,
         "tooltip": "Summary data",
         "display": lambda results: SearchableTable(["Feature", "Value"], results),
     },
     "N-grams": {
         "func": get_n_grams_from_corpus,
+        "grouped_func": get_n_grams_from_grouped_corpus,
+        "index_func": get_indexed_n_grams,
         "tooltip": "N-grams",
-        "display": lambda results: SearchableTable(["N-gram", "Count"], results),
+        "display": lambda results: SearchableTable(
+            # Approximate counts also have their error bound
+            ["N-gram", "Count", "Max undercount"][: len(results[0]) if results else 2],
+            results,
+        ),
+    },
+    "Lemmas": {
+        "func": get_lemmas_from_corpus,
+        "grouped_func": get_lemmas_from_grouped_corpus,
+        "index_func": get_stored_lemmas,
+        "tooltip": "Lemma and part of speech counts",
+        "display": lambda results: SearchableTable(["lemma", "POS", "count"], results),
     },
     "Grammar": {
         "class": GrammarTask,
         "func": GrammarTask.get_errors,
+        "checkpoint": True,
         "tooltip": "Errors and corrections using Grammarly",
         "display": lambda results: SearchableTable(
             ["error type", "original", "edited", "sentence", "file"], results
@@ -26,6 +124,8 @@ TASK_DICT = {
     "NER": {
         "class": NERModel,
         "func": NERModel.get_entities_from_sents,
+        "grouped_func": NERModel.get_entities_from_grouped_sents,
+        "index_func": get_stored_entities,
         "tooltip": "Named entity recognition",
         "display": lambda results: SearchableTable(["word", "type", "count"], results),
     },
@@ -1,77 +1,358 @@
 """Plotting functions."""
 
-from typing import Any, Callable
-import re
+import threading
+from typing import Any, Callable, Iterable, Iterator
 
+import numpy as np
 
-from backend.utils.nlp import SpacyModel
+from backend.db.batch import SentenceBatch, SentenceData, iter_batches
+from backend.db.grouped import GroupedSelection
+from backend.project.project import Project
+from backend.tasks.plot_workers import PlotCancelled, get_sent_func, sum_group_values
+from backend.utils.bootstrap import ValueCounts, group_intervals
+from backend.utils.nlp import iter_token_batches
 
+# Quantitative meta properties with more distinct values than this are
+# binned into this many x values
+MAX_X_VALUES = 50
+# Max points drawn for a line plot (see lttb)
+MAX_LINE_POINTS = 500
+# Max bars drawn for a bar plot, including the "Other" bar
+MAX_BARS = 30
+OTHER_LABEL = "Other"
 
-def regex(
-    sent_batches: dict[str, list[str]], pattern, per="total"
-) -> list[tuple[Any, int | float]]:
-    match_counts = []
-    model = SpacyModel()
-    for label, sents in sent_batches.items():
-        sent_count = 0
-        word_count = 0
-        match_count = 0
-        for sent in sents:
-            sent_count += 1
-            tokens = model.word_tokenize(sent)
-            word_count += len(tokens)
-            match_count += len(re.findall(pattern, sent))
-        if per == "per sentence":
-            value = match_count / sent_count
-        elif per == "per word":
-            value = match_count / word_count
-        else:
-            value = match_count
+
+def get_value(
+    count: int | float,
+    sent_count: int,
+    word_count: int,
+    per: str = "total",
+) -> int | float:
+    if per == "per sentence":
+        return count / sent_count
+    elif per == "per word":
+        return count / word_count
+    return count
+
+
+def _get_group_values(
+    grouped_batches: SentenceData,
+    labels: list[Any],
+    sent_func: Callable[[str], int | float],
+    per: str = "total",
+    group_counts: list[dict[str, int]] | None = None,
+    value_counts: ValueCounts | None = None,
+) -> list[tuple]:
+    """
+    Evaluates sent_func once per sentence and adds the result to each of the
+    sentence's groups (one group per x value).
+
+    Args:
+        grouped_batches (SentenceData): SentenceBatches with their group
+            membership set (see GroupedSelection). Ungrouped sentences all
+            belong to the first group.
+        labels (list[Any]): x value of each group.
+        sent_func (Callable[[str], int | float]): Value of a sentence.
+        per (str, optional): Defaults to "total".
+        group_counts (list[dict[str, int]] | None, optional): Precomputed
+            sent_count and word_count of each group. If not given, word
+            counts are taken from the batches' token ids.
+        value_counts (ValueCounts | None, optional): If given, sentence
+            values are added to it and the plot values have bootstrap
+            intervals (see _to_plot_values). Defaults to None.
+    """
+    n_groups = len(labels)
+    counts = np.zeros(n_groups)
+    sent_counts = np.zeros(n_groups, dtype=np.int64)
+    word_counts = np.zeros(n_groups, dtype=np.int64)
+    batches = iter_batches(grouped_batches)
+    # Word counts of each sentence are needed for per word values, unless
+    # the group totals are given and there are no intervals
+    count_words = per == "per word" and (
+        group_counts is None or value_counts is not None
+    )
+    if count_words:
+        batches = iter_token_batches(batches)
+    for batch in batches:
+        masks = batch.group_masks()
+        values = np.array([sent_func(sent) for sent in batch.sentences], dtype=float)
+        counts += values @ masks
+        sent_counts += masks.sum(axis=0)
+        words = batch.token_lengths() if count_words else None
+        if words is not None:
+            word_counts += words @ masks
+        if value_counts is not None:
+            value_counts.add(values, words, masks)
+    if group_counts is None:
+        group_counts = [
+            {"sent_count": sent_count, "word_count": word_count}
+            for sent_count, word_count in zip(
+                sent_counts.tolist(), word_counts.tolist()
+            )
+        ]
+    return _to_plot_values(labels, counts, per, group_counts, value_counts)
+
+
+def _to_plot_values(
+    labels: list[Any],
+    counts: np.ndarray,
+    per: str,
+    group_counts: list[dict[str, int]],
+    value_counts: ValueCounts | None = None,
+) -> list[tuple]:
+    """
+    Returns (x, y) for each group, or (x, y, low, high) with the bootstrap
+    interval of y if value_counts is given.
+    """
+    plot_values = []
+    for label, count, counts_d in zip(labels, counts.tolist(), group_counts):
+        value = get_value(count, counts_d["sent_count"], counts_d["word_count"], per)
         try:
             label = float(label)
         except ValueError:
             pass
-        match_counts.append((label, value))
-    return match_counts
+        plot_values.append((label, value))
+    if value_counts is not None:
+        estimates = [value for _, value in plot_values]
+        intervals = group_intervals(value_counts, estimates, per)
+        plot_values = [
+            (label, value, low, high)
+            for (label, value), (low, high) in zip(plot_values, intervals)
+        ]
+    return plot_values
+
+
+def regex(
+    grouped_batches: SentenceData,
+    labels: list[Any],
+    pattern,
+    per="total",
+    group_counts: list[dict[str, int]] | None = None,
+    value_counts: ValueCounts | None = None,
+) -> list[tuple]:
+    """Number of matches of pattern. See _get_group_values."""
+    sent_func = get_sent_func("Regex", pattern)
+    return _get_group_values(
+        grouped_batches, labels, sent_func, per, group_counts, value_counts
+    )
 
 
 def custom(
-    sent_batches: dict[str, list[str]], code_str: str, per="total"
-) -> list[tuple[Any, int | float]]:
-    code: Callable = eval(f"lambda sentence: {code_str}")
-    counts = []
-    model = SpacyModel()
-    for label, sents in sent_batches.items():
-        sent_count = 0
-        word_count = 0
-        count = 0
-        for sent in sents:
-            sent_count += 1
-            tokens = model.word_tokenize(sent)
-            word_count += len(tokens)
-            result = code(sent)
-            if result is True:
-                count += 1
-            elif type(result) in (int, float):
-                count += result
-        if per == "per sentence":
-            value = count / sent_count
-        elif per == "per word":
-            value = count / word_count
-        else:
-            value = count
-        try:
-            label = float(label)
-        except ValueError:
-            pass
-        counts.append((label, value))
-    return counts
+    grouped_batches: SentenceData,
+    labels: list[Any],
+    code_str: str,
+    per="total",
+    group_counts: list[dict[str, int]] | None = None,
+    value_counts: ValueCounts | None = None,
+) -> list[tuple]:
+    """
+    Sum of code_str evaluated on each sentence (True counts as 1). See
+    _get_group_values.
+    """
+    sent_func = get_sent_func("Custom", code_str)
+    return _get_group_values(
+        grouped_batches, labels, sent_func, per, group_counts, value_counts
+    )
 
 
 def get_plot_values(
-    sent_batches: dict[str, Any], plot_d: dict[str, Any]
-) -> list[tuple[Any, int | float]]:
+    grouped_batches: SentenceData,
+    labels: list[Any],
+    plot_d: dict[str, Any],
+    group_counts: list[dict[str, int]] | None = None,
+) -> list[tuple]:
+    """
+    (x, y) values of a plot, or (x, y, low, high) if plot_d["intervals"] is
+    set (see _to_plot_values).
+    """
     func = regex if plot_d["y_type"] == "Regex" else custom
     target = plot_d["y_func"]
-    plot_values = func(sent_batches, target, plot_d["y_per"])
+    value_counts = ValueCounts(len(labels)) if plot_d.get("intervals") else None
+    plot_values = func(
+        grouped_batches, labels, target, plot_d["y_per"], group_counts, value_counts
+    )
     return plot_values
+
+
+def _until_cancelled(
+    batches: Iterable[SentenceBatch], cancel: threading.Event | None
+) -> Iterator[SentenceBatch]:
+    for batch in batches:
+        if cancel is not None and cancel.is_set():
+            raise PlotCancelled()
+        yield batch
+
+
+def get_project_plot_values(
+    project: Project,
+    group_ids: list[np.ndarray],
+    labels: list[Any],
+    plot_d: dict[str, Any],
+    group_counts: list[dict[str, int]] | None = None,
+    cancel: threading.Event | None = None,
+    frontend_connect: Any | None = None,
+) -> list[tuple]:
+    """
+    get_plot_values for groups of project sentences (sorted sentence ids of
+    each x value).
+
+    With the project's text and token stores, sentences are evaluated in
+    worker processes (see plot_workers, which also has the limits on custom
+    expressions) and missing sentence/word counts are taken from the token
+    store. Regexes are only run on the sentences the trigram index can't
+    rule out.
+
+    Projects without the stores (processed by older versions) are read
+    from the database in this thread, checking cancel between batches.
+    Custom expressions are rejected there, since they only run in the
+    limited workers.
+
+    Raises:
+        PlotCancelled: If cancel is set.
+        ValueError: For custom expressions without the stores.
+    """
+    grouped = GroupedSelection(group_ids)
+    if group_counts is None:
+        group_counts = project.get_group_counts(grouped)
+    if project.text_store is None or group_counts is None:
+        if plot_d["y_type"] != "Regex":
+            raise ValueError(
+                "Custom expressions need the project's sentence store. Process "
+                "the corpus again to build it."
+            )
+        # Token ids are only needed for word counts
+        columns = ("tokens",) if plot_d["y_per"] == "per word" else ()
+        grouped_batches = _until_cancelled(
+            project.iter_grouped_batches(grouped, columns), cancel
+        )
+        return get_plot_values(grouped_batches, labels, plot_d, group_counts)
+    value_counts = ValueCounts(len(labels)) if plot_d.get("intervals") else None
+    per_word = value_counts is not None and plot_d["y_per"] == "per word"
+    full = grouped
+    if plot_d["y_type"] == "Regex":
+        candidates = project.regex_candidates(plot_d["y_func"])
+        if candidates is not None:
+            grouped = grouped.subset(candidates)
+    counts = sum_group_values(
+        project.paths.sentence_text,
+        project.paths.sentence_offsets,
+        grouped,
+        plot_d["y_type"],
+        plot_d["y_func"],
+        token_offsets_path=project.paths.token_offsets,
+        cancel=cancel,
+        frontend_connect=frontend_connect,
+        value_counts=value_counts,
+        words=project.get_word_counts(grouped.ids) if per_word else None,
+        annotation_paths=project.paths.annotations
+        if project.annotation_store
+        else None,
+    )
+    if value_counts is not None and grouped is not full:
+        # Sentences ruled out by the trigram index have no matches
+        excluded = ~np.isin(full.ids, grouped.ids, assume_unique=True)
+        excluded_ids = full.ids[excluded]
+        value_counts.add(
+            np.zeros(len(excluded_ids)),
+            project.get_word_counts(excluded_ids) if per_word else None,
+            full.membership[excluded],
+        )
+    return _to_plot_values(labels, counts, plot_d["y_per"], group_counts, value_counts)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling: keeps the first and last
+    points and, from each of n_out - 2 equal buckets of the points between,
+    the one forming the largest triangle with the point kept from the
+    previous bucket and the mean of the next bucket. This keeps the peaks
+    and troughs that a regular stride would drop.
+
+    Args:
+        x (np.ndarray): Sorted x values.
+        y (np.ndarray)
+        n_out (int): Number of points to keep.
+
+    Returns:
+        np.ndarray: Sorted indices of the points kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # The last bucket is followed by the last point
+    edges = np.append(edges, n)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_x = x[end : edges[i + 2]].mean()
+        next_y = y[end : edges[i + 2]].mean()
+        a_x, a_y = x[keep[i]], y[keep[i]]
+        # Twice the triangle areas
+        areas = np.abs(
+            (a_x - next_x) * (y[start:end] - a_y)
+            - (a_x - x[start:end]) * (next_y - a_y)
+        )
+        keep[i + 1] = start + int(np.argmax(areas))
+    return keep
+
+
+def _is_numeric(labels: list[Any]) -> bool:
+    return all(isinstance(label, (int, float)) for label in labels)
+
+
+def reduce_plot_values(
+    plot_values: list[tuple],
+    plot_type: str = "line",
+    per: str = "total",
+    weights: list[int] | None = None,
+    max_points: int = MAX_LINE_POINTS,
+    max_bars: int = MAX_BARS,
+) -> list[tuple]:
+    """
+    Bounds the number of points drawn, so rendering cost doesn't grow with
+    the number of x values. Line plots are downsampled with lttb (in x
+    order, if x is numeric). Bar plots keep the max_bars - 1 highest bars in
+    their order, with the rest summed (or averaged, for per sentence/word
+    values) into one "Other" bar, which has no interval.
+
+    Args:
+        plot_values (list[tuple]): (x, y) or (x, y, low, high) values (see
+            get_plot_values).
+        plot_type (str, optional): "line" or "bar". Defaults to "line".
+        per (str, optional): How y values were computed (see get_value).
+            Defaults to "total".
+        weights (list[int] | None, optional): Sentence or word count of
+            each x value (as for per), to weight the average of the "Other"
+            bar. Defaults to None (unweighted).
+        max_points (int, optional): Defaults to MAX_LINE_POINTS.
+        max_bars (int, optional): Defaults to MAX_BARS.
+    """
+    if plot_type == "line":
+        if len(plot_values) <= max_points:
+            return plot_values
+        if _is_numeric([item[0] for item in plot_values]):
+            plot_values = sorted(plot_values, key=lambda item: item[0])
+            x = np.array([item[0] for item in plot_values], dtype=float)
+        else:
+            x = np.arange(len(plot_values), dtype=float)
+        y = np.array([item[1] for item in plot_values], dtype=float)
+        return [plot_values[i] for i in lttb(x, y, max_points).tolist()]
+    if len(plot_values) <= max_bars:
+        return plot_values
+    y = np.array([item[1] for item in plot_values], dtype=float)
+    order = np.argsort(-y, kind="stable")
+    top = np.sort(order[: max_bars - 1])
+    rest = order[max_bars - 1 :]
+    if per == "total":
+        other = float(y[rest].sum())
+    elif weights is not None and sum(weights[i] for i in rest.tolist()):
+        rest_weights = np.array(weights, dtype=float)[rest]
+        other = float((y[rest] * rest_weights).sum() / rest_weights.sum())
+    else:
+        other = float(y[rest].mean())
+    # Padded with a NaN interval if the other bars have intervals
+    other_item = (OTHER_LABEL, other) + (np.nan,) * (len(plot_values[0]) - 2)
+    return [plot_values[i] for i in top.tolist()] + [other_item]
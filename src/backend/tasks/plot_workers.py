@@ -0,0 +1,384 @@
+"""
+Evaluation of plot y values (regex matches or custom expressions) over the
+sentences of a grouped selection, sharded across worker processes.
+
+Workers read sentences from the memory-mapped TextStore themselves, so only
+sentence ids are sent to them and the value of each sentence comes back, to
+be summed per group (and optionally counted for bootstrap intervals, see
+utils.bootstrap) in the calling process. The pattern/expression is compiled
+once per worker.
+
+Custom expressions are user code, so they're always run in the workers,
+with restricted builtins, a memory limit per worker and a time limit per
+chunk of sentences. This keeps slow or runaway expressions from freezing
+the app; it isn't a security boundary against deliberately hostile code.
+Expressions of words/chars (the word and character counts of each
+sentence) instead of sentence are evaluated on whole arrays. With the
+project's annotation store, these expressions can also count the tokens of
+each sentence by annotation without re-parsing it, e.g. pos("NOUN") / words,
+lemma("be"), dep("nsubj", "nsubjpass") or morph("Tense=Past").
+"""
+
+import ast
+import builtins
+from multiprocessing import TimeoutError as PoolTimeoutError, get_context
+import os
+from pathlib import Path
+import re
+import threading
+from types import CodeType, SimpleNamespace
+from typing import Any, Callable
+
+import numpy as np
+
+from backend.db.grouped import GroupedSelection
+from backend.db.annotations import ANNOTATION_FIELDS
+from backend.db.stores import AnnotationStore, TextStore
+from backend.utils.bootstrap import ValueCounts
+
+# Sentences per task sent to a worker
+CHUNK_SIZE = 10_000
+# Regexes on selections smaller than this are evaluated in the calling
+# process, since starting the workers would take longer
+MIN_PARALLEL_SENTS = 50_000
+# Seconds a chunk of sentences can take before the evaluation is stopped
+CHUNK_TIME_LIMIT = 30
+# Memory limit of each worker process (where supported)
+WORKER_MEMORY_MB = 2048
+# Seconds between checks for cancellation while waiting for workers
+POLL_INTERVAL = 0.2
+
+# Builtins available to custom expressions
+SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs",
+        "all",
+        "any",
+        "bool",
+        "dict",
+        "enumerate",
+        "filter",
+        "float",
+        "int",
+        "len",
+        "list",
+        "map",
+        "max",
+        "min",
+        "range",
+        "reversed",
+        "round",
+        "set",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+        "zip",
+    )
+}
+# The re functions and flags available to custom expressions as re.<name>.
+# Modules aren't exposed, since their attributes lead to other modules (e.g.
+# re.enum.sys.modules).
+SAFE_RE = SimpleNamespace(
+    **{
+        name: getattr(re, name)
+        for name in (
+            "search",
+            "match",
+            "fullmatch",
+            "findall",
+            "sub",
+            "subn",
+            "split",
+            "escape",
+            "IGNORECASE",
+            "I",
+            "MULTILINE",
+            "M",
+            "DOTALL",
+            "S",
+        )
+    }
+)
+# Array attributes that reach the file system or raw memory
+BLOCKED_ATTRIBUTES = {"tofile", "dump", "dumps", "ctypes", "base"}
+# Per-sentence arrays for vectorized expressions
+VECTOR_NAMES = {"words", "chars"}
+# Functions of vectorized expressions that count the tokens of each sentence
+# with the given labels (see AnnotationStore.sentence_counts)
+ANNOTATION_NAMES = set(ANNOTATION_FIELDS)
+
+# State of a worker process, set by _init_worker
+_worker: dict[str, Any] = {}
+
+
+class PlotCancelled(Exception):
+    pass
+
+
+def _parse_expression(code_str: str) -> tuple[ast.Expression, set[str]]:
+    """
+    Parses a custom expression, rejecting access to private/dunder names
+    (the usual way out of restricted builtins) and BLOCKED_ATTRIBUTES.
+    Returns (tree, names used).
+    """
+    tree = ast.parse(code_str.strip(), mode="eval")
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and (
+            node.attr.startswith("_") or node.attr in BLOCKED_ATTRIBUTES
+        ):
+            raise ValueError(f"Attribute {node.attr} isn't allowed")
+        if isinstance(node, ast.Name):
+            if node.id.startswith("_"):
+                raise ValueError(f"Name {node.id} isn't allowed")
+            names.add(node.id)
+    if "sentence" in names and names & ANNOTATION_NAMES:
+        raise ValueError(
+            f"{', '.join(sorted(names & ANNOTATION_NAMES))} can't be used with "
+            "sentence, only with words/chars"
+        )
+    return tree, names
+
+
+def compile_expression(code_str: str) -> tuple[CodeType, bool]:
+    """
+    Compiles a custom expression (see _parse_expression).
+
+    Returns:
+        tuple[CodeType, bool]: (code, whether the expression is vectorized,
+            i.e. uses words/chars or annotations and not sentence)
+    """
+    tree, names = _parse_expression(code_str)
+    vectorized = "sentence" not in names and bool(
+        names & (VECTOR_NAMES | ANNOTATION_NAMES)
+    )
+    return compile(tree, "<expression>", "eval"), vectorized
+
+
+def uses_annotations(code_str: str) -> bool:
+    """Whether a custom expression counts tokens by annotation."""
+    return bool(_parse_expression(code_str)[1] & ANNOTATION_NAMES)
+
+
+def _expression_env() -> dict[str, Any]:
+    return {"__builtins__": SAFE_BUILTINS, "re": SAFE_RE}
+
+
+def get_sent_func(y_type: str, target: str) -> Callable[[str], int | float]:
+    """
+    Value of a sentence for a plot: the number of matches of a regex, or a
+    custom expression of sentence (True counts as 1, other non-numbers as 0).
+    """
+    if y_type == "Regex":
+        compiled = re.compile(target)
+
+        def regex_func(sent: str) -> int:
+            return len(compiled.findall(sent))
+
+        return regex_func
+
+    code, _ = compile_expression(target)
+    # sentence is a global so it's visible inside comprehensions
+    env = _expression_env()
+
+    def custom_func(sent: str) -> int | float:
+        env["sentence"] = sent
+        result = eval(code, env)
+        if result is True:
+            return 1
+        elif type(result) in (int, float):
+            return result
+        return 0
+
+    return custom_func
+
+
+def _init_worker(
+    data_path: Path,
+    offsets_path: Path,
+    token_offsets_path: Path | None,
+    y_type: str,
+    target: str,
+    memory_mb: int | None = None,
+    annotation_paths: tuple[Path, Path, Path] | None = None,
+) -> None:
+    if memory_mb:
+        try:
+            import resource
+
+            # Heap only, since the memory-mapped stores can be large
+            limit = memory_mb * 2**20
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    _worker["text_store"] = TextStore.load(data_path, offsets_path)
+    if token_offsets_path is not None:
+        _worker["token_offsets"] = np.load(token_offsets_path, mmap_mode="r")
+    if annotation_paths is not None:
+        _worker["annotation_store"] = AnnotationStore.load(*annotation_paths)
+    _worker["vectorized"] = False
+    if y_type != "Regex":
+        _worker["code"], _worker["vectorized"] = compile_expression(target)
+    _worker["sent_func"] = get_sent_func(y_type, target)
+
+
+def _annotation_counter(
+    store: AnnotationStore, ids: np.ndarray, field: str
+) -> Callable[..., np.ndarray]:
+    def count(*labels: str) -> np.ndarray:
+        return store.sentence_counts(ids, field, labels)
+
+    return count
+
+
+def _eval_vectorized(ids: np.ndarray) -> np.ndarray:
+    env = _expression_env()
+    if "token_offsets" in _worker:
+        token_offsets = _worker["token_offsets"]
+        env["words"] = token_offsets[ids + 1] - token_offsets[ids]
+    if "annotation_store" in _worker:
+        store = _worker["annotation_store"]
+        for field in ANNOTATION_FIELDS:
+            env[field] = _annotation_counter(store, ids, field)
+    data, offsets = _worker["text_store"].gather(ids)
+    # Characters are the UTF-8 bytes that aren't continuation bytes
+    starts = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum((data & 0xC0) != 0x80, out=starts[1:])
+    env["chars"] = starts[offsets[1:]] - starts[offsets[:-1]]
+    result = np.asarray(eval(_worker["code"], env), dtype=float)
+    return np.broadcast_to(result, ids.shape)
+
+
+def _eval_chunk(chunk: tuple[int, np.ndarray]) -> tuple[int, np.ndarray]:
+    """Values of the sentences of a (start, ids) chunk, with its start."""
+    start, ids = chunk
+    if _worker["vectorized"]:
+        return start, np.array(_eval_vectorized(ids))
+    sent_func = _worker["sent_func"]
+    values = np.fromiter(
+        (sent_func(str(view, "utf-8")) for view in _worker["text_store"].scan(ids)),
+        dtype=float,
+        count=len(ids),
+    )
+    return start, values
+
+
+def _next_result(
+    results: Any, cancel: threading.Event | None
+) -> tuple[int, np.ndarray]:
+    """Waits for the next chunk result, within the time limit."""
+    waited = 0.0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise PlotCancelled()
+        try:
+            return results.next(timeout=POLL_INTERVAL)
+        except PoolTimeoutError:
+            waited += POLL_INTERVAL
+            if waited > CHUNK_TIME_LIMIT:
+                raise TimeoutError(
+                    f"Evaluating {CHUNK_SIZE} sentences took over "
+                    f"{CHUNK_TIME_LIMIT} seconds"
+                )
+
+
+def sum_group_values(
+    data_path: Path,
+    offsets_path: Path,
+    grouped: GroupedSelection,
+    y_type: str,
+    target: str,
+    token_offsets_path: Path | None = None,
+    processes: int | None = None,
+    cancel: threading.Event | None = None,
+    frontend_connect: Any | None = None,
+    value_counts: ValueCounts | None = None,
+    words: np.ndarray | None = None,
+    annotation_paths: tuple[Path, Path, Path] | None = None,
+) -> np.ndarray:
+    """
+    Sums of the sentence values (see get_sent_func) of each group.
+
+    Args:
+        data_path (Path): TextStore data file.
+        offsets_path (Path): TextStore offsets file.
+        grouped (GroupedSelection)
+        y_type (str): "Regex" or "Custom".
+        target (str): Regex or expression.
+        token_offsets_path (Path | None, optional): TokenStore offsets file,
+            for the word counts of vectorized expressions. Defaults to None.
+        processes (int | None, optional): Number of worker processes.
+            Defaults to the number of CPUs.
+        cancel (threading.Event | None, optional): Set to stop the evaluation
+            (raises PlotCancelled). Defaults to None.
+        frontend_connect (Any | None, optional): Gets a progress increment
+            for each chunk of sentences evaluated. Defaults to None.
+        value_counts (ValueCounts | None, optional): If given, the sentence
+            values are also added to it. Defaults to None.
+        words (np.ndarray | None, optional): Word count of each sentence of
+            grouped, added to value_counts with the values. Defaults to None.
+        annotation_paths (tuple[Path, Path, Path] | None, optional):
+            AnnotationStore files, for expressions that count tokens by
+            annotation. Defaults to None.
+
+    Raises:
+        PlotCancelled: If cancel is set.
+        TimeoutError: If a chunk takes over CHUNK_TIME_LIMIT seconds.
+    """
+    if y_type != "Regex":
+        # Checked here so syntax errors aren't reported from a worker
+        compile_expression(target)
+        if annotation_paths is None and uses_annotations(target):
+            raise ValueError(
+                "Token annotations aren't stored for this corpus. Enable "
+                "annotate_tokens and process the corpus again."
+            )
+    chunks = [
+        (i, grouped.ids[i : i + CHUNK_SIZE]) for i in range(0, len(grouped), CHUNK_SIZE)
+    ]
+    if frontend_connect:
+        frontend_connect.taskInfo.emit("Evaluating sentences", len(chunks))
+    processes = processes or os.cpu_count() or 1
+    totals = np.zeros(grouped.n_groups)
+
+    def add(start: int, values: np.ndarray) -> None:
+        membership = grouped.membership[start : start + len(values)]
+        totals[:] += values @ membership
+        if value_counts is not None:
+            chunk_words = None if words is None else words[start : start + len(values)]
+            value_counts.add(values, chunk_words, membership)
+        if frontend_connect:
+            frontend_connect.increment.emit()
+
+    if y_type == "Regex" and (processes == 1 or len(grouped) < MIN_PARALLEL_SENTS):
+        _init_worker(data_path, offsets_path, token_offsets_path, y_type, target)
+        try:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    raise PlotCancelled()
+                add(*_eval_chunk(chunk))
+        finally:
+            _worker.clear()
+        return totals
+    init_args = (
+        data_path,
+        offsets_path,
+        token_offsets_path,
+        y_type,
+        target,
+        WORKER_MEMORY_MB,
+        annotation_paths,
+    )
+    # Forking from the GUI's threads isn't safe
+    context = get_context("spawn")
+    # Leaving the block terminates the workers, including any still running
+    # after a timeout or cancellation
+    with context.Pool(
+        min(processes, len(chunks)) or 1, initializer=_init_worker, initargs=init_args
+    ) as pool:
+        results = pool.imap_unordered(_eval_chunk, chunks)
+        for _ in chunks:
+            add(*_next_result(results, cancel))
+    return totals
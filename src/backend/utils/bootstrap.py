@@ -0,0 +1,148 @@
+"""
+Bootstrap confidence intervals of plot values (see tasks.plot.get_value).
+
+A group's sentences are kept as counts of their distinct (value, word count)
+pairs, so memory depends on the number of distinct pairs and not on the
+number of sentences. Resampling n sentences with replacement is then a
+multinomial draw of n over the pairs, weighted by their counts, and all
+resamples are drawn and reduced as arrays.
+"""
+
+import numpy as np
+
+from backend.utils.ngrams import sum_counts
+
+# Bootstrap resamples per group
+N_RESAMPLES = 1000
+CONFIDENCE = 0.95
+# Max entries (resamples x distinct pairs) drawn at once
+MAX_DRAW_SIZE = 4_000_000
+# Number of pending (not yet counted) rows at which they're merged into the
+# counts
+MERGE_THRESHOLD = 1_000_000
+
+
+class ValueCounts:
+    """Counts of the distinct (value, word count) pairs of each group."""
+
+    def __init__(self, n_groups: int) -> None:
+        self.n_groups = n_groups
+        # Rows of (group, value, word count), and their counts
+        self.keys = np.empty((0, 3))
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending: list[np.ndarray] = []
+        self._pending_size = 0
+
+    def add(
+        self, values: np.ndarray, words: np.ndarray | None, membership: np.ndarray
+    ) -> None:
+        """
+        Args:
+            values (np.ndarray): Value of each sentence.
+            words (np.ndarray | None): Word count of each sentence (only
+                needed for per word values).
+            membership (np.ndarray): Group membership of each sentence
+                (sentences x groups, bool).
+        """
+        sent_index, groups = np.nonzero(membership)
+        if not len(sent_index):
+            return
+        keys = np.zeros((len(sent_index), 3))
+        keys[:, 0] = groups
+        keys[:, 1] = values[sent_index]
+        if words is not None:
+            keys[:, 2] = words[sent_index]
+        self._pending.append(keys)
+        self._pending_size += len(keys)
+        if self._pending_size > MERGE_THRESHOLD:
+            self._merge()
+
+    def _merge(self) -> None:
+        if not self._pending:
+            return
+        keys, counts = sum_counts(np.concatenate(self._pending))
+        self.keys, self.counts = sum_counts(
+            np.concatenate([self.keys, keys]), np.concatenate([self.counts, counts])
+        )
+        self._pending = []
+        self._pending_size = 0
+
+    def group(self, i: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(distinct values, their word counts, counts) of group i."""
+        self._merge()
+        in_group = self.keys[:, 0] == i
+        return (
+            self.keys[in_group, 1],
+            self.keys[in_group, 2],
+            self.counts[in_group],
+        )
+
+
+def bootstrap_interval(
+    values: np.ndarray,
+    words: np.ndarray,
+    counts: np.ndarray,
+    per: str = "total",
+    n_resamples: int = N_RESAMPLES,
+    confidence: float = CONFIDENCE,
+    rng: np.random.Generator | None = None,
+) -> tuple[float, float]:
+    """
+    Percentile bootstrap interval of a group's plot value, from the counts
+    of its distinct (value, word count) pairs (see ValueCounts).
+
+    Returns:
+        tuple[float, float]: (low, high), NaN for empty groups.
+    """
+    n = int(counts.sum())
+    if not n:
+        return np.nan, np.nan
+    rng = rng or np.random.default_rng()
+    probabilities = counts / n
+    block = max(1, MAX_DRAW_SIZE // len(counts))
+    stats = np.empty(n_resamples)
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+        draws = rng.multinomial(n, probabilities, size=size).astype(float)
+        totals = draws @ values
+        if per == "per sentence":
+            totals /= n
+        elif per == "per word":
+            word_totals = draws @ words
+            totals = np.divide(
+                totals, word_totals, out=np.zeros(size), where=word_totals > 0
+            )
+        stats[start : start + size] = totals
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(stats, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def group_intervals(
+    value_counts: ValueCounts,
+    estimates: list[float],
+    per: str = "total",
+    n_resamples: int = N_RESAMPLES,
+    confidence: float = CONFIDENCE,
+    seed: int | None = 0,
+) -> list[tuple[float, float]]:
+    """
+    bootstrap_interval of each group. Per word intervals are scaled to the
+    group's estimate, since the bootstrap uses token counts for words, which
+    can differ from the word counts the estimates were computed with.
+    """
+    rng = np.random.default_rng(seed)
+    intervals = []
+    for i, estimate in enumerate(estimates):
+        values, words, counts = value_counts.group(i)
+        low, high = bootstrap_interval(
+            values, words, counts, per, n_resamples, confidence, rng
+        )
+        if per == "per word" and len(counts):
+            sample_words = counts @ words
+            sample = (counts @ values) / sample_words if sample_words else 0.0
+            if sample:
+                scale = float(estimate / sample)
+                low, high = low * scale, high * scale
+        intervals.append((low, high))
+    return intervals
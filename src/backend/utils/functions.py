@@ -1,6 +1,7 @@
 from datetime import date
+from itertools import islice
 import re
-from typing import Any, Callable
+from typing import Any, Callable, Iterable, Iterator
 import inspect
 
 
@@ -14,6 +15,13 @@ def flatten_lists(nested_list: list):
     return flat_list
 
 
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yields lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
 def flatten_dict(d, parent_key="", sep="."):
     """
     Flattens an arbitrarily nested dictionary of dictionaries into a dictionary
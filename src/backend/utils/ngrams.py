@@ -0,0 +1,304 @@
+"""
+N-gram counting over token id arrays (see SentenceBatch.tokens).
+
+N-grams are taken as windows of token ids and packed into int64 keys (see
+NGramCodec). N-grams are buffered across batches and counted by sorting the
+keys, and the counts are merged into the totals in the same way.
+"""
+
+from typing import Iterable
+
+import numpy as np
+
+from backend.db.vocab import Vocabulary
+
+# Minimum bits per token id used for packing. With 20 bits, 3 token ids fit in
+# an int64, for vocabularies of up to 2**20 tokens.
+MIN_PACK_BITS = 20
+# Odd 64-bit constant for hashing multi-word keys
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# Number of pending (not yet counted) n-grams at which they're counted and
+# merged into the totals
+MERGE_THRESHOLD = 2_000_000
+
+
+def get_windows(
+    tokens: np.ndarray, token_offsets: np.ndarray, n: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (n-gram windows (n-grams x n token ids), sentence index of each
+    n-gram). N-grams don't cross sentence boundaries.
+    """
+    lengths = np.diff(token_offsets)
+    counts = np.clip(lengths - n + 1, 0, None)
+    cum_counts = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=cum_counts[1:])
+    # Position of the first token of each n-gram in tokens
+    starts = np.arange(cum_counts[-1]) + np.repeat(
+        token_offsets[:-1] - cum_counts[:-1], counts
+    )
+    windows = tokens[starts[:, None] + np.arange(n)]
+    sent_index = np.repeat(np.arange(len(counts)), counts)
+    return windows, sent_index
+
+
+def get_stopword_mask(vocabulary: Vocabulary, stop_words: Iterable[str]) -> np.ndarray:
+    """Whether each token id in vocabulary is a stopword (case-insensitive)."""
+    stop_words = set(stop_words)
+    return np.fromiter(
+        (token.lower() in stop_words for token in vocabulary.tokens),
+        dtype=bool,
+        count=len(vocabulary),
+    )
+
+
+class NGramCodec:
+    """
+    Converts n-gram windows to sortable keys and back. Token ids are packed
+    into int64 words, as many as fit in 63 bits. Keys are 1-d if an n-gram
+    fits in one word, otherwise (n-grams x words).
+    """
+
+    def __init__(self, n: int, vocabulary_size: int) -> None:
+        self.n = n
+        self.bits = max(MIN_PACK_BITS, vocabulary_size.bit_length())
+        self.per_word = 63 // self.bits
+        self.words = -(-n // self.per_word)
+
+    def fits(self, windows: np.ndarray) -> bool:
+        return not windows.size or windows.max() >> self.bits == 0
+
+    def widened(self) -> "NGramCodec":
+        """Codec for any int32 token id."""
+        return NGramCodec(self.n, 2**31 - 1)
+
+    def encode(self, windows: np.ndarray) -> np.ndarray:
+        keys = np.zeros((len(windows), self.words), dtype=np.int64)
+        for j in range(self.n):
+            word = j // self.per_word
+            keys[:, word] = (keys[:, word] << self.bits) | windows[:, j]
+        return keys[:, 0] if self.words == 1 else keys
+
+    def decode(self, keys: np.ndarray) -> np.ndarray:
+        keys = keys.reshape(len(keys), self.words).copy()
+        windows = np.empty((len(keys), self.n), dtype=np.int32)
+        mask = (1 << self.bits) - 1
+        for j in range(self.n - 1, -1, -1):
+            word = j // self.per_word
+            windows[:, j] = keys[:, word] & mask
+            keys[:, word] >>= self.bits
+        return windows
+
+
+def sum_counts(
+    keys: np.ndarray, counts: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sums the counts of equal keys (rows, for 2-d keys). Counts default to 1.
+    2-d keys may be int64 or float64 (NaNs are equal to each other).
+    Returns (distinct keys, counts).
+    """
+    if keys.ndim == 2:
+        # Rows are grouped by a 64-bit hash, checked for collisions below
+        hashes = np.zeros(len(keys), dtype=np.uint64)
+        for column in keys.T:
+            hashes = (hashes ^ column.view(np.uint64)) * HASH_MULTIPLIER
+        _, index, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        distinct = keys[index]
+        if not np.array_equal(distinct[inverse], keys, equal_nan=True):
+            return _sum_counts_exact(keys, counts)
+    elif counts is None:
+        return np.unique(keys, return_counts=True)
+    else:
+        distinct, inverse = np.unique(keys, return_inverse=True)
+    if counts is None:
+        summed = np.bincount(inverse.ravel(), minlength=len(distinct))
+    else:
+        summed = np.bincount(inverse.ravel(), weights=counts, minlength=len(distinct))
+    return distinct, summed.astype(np.int64)
+
+
+def _sum_counts_exact(
+    keys: np.ndarray, counts: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """sum_counts for 2-d keys with hash collisions."""
+    distinct, inverse = np.unique(keys, axis=0, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=counts, minlength=len(distinct))
+    return distinct, summed.astype(np.int64)
+
+
+def top_k(
+    keys: np.ndarray, counts: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """The k keys with the highest counts, sorted by count (descending)."""
+    if len(counts) > k:
+        index = np.argpartition(-counts, k - 1)[:k]
+        keys, counts = keys[index], counts[index]
+    order = np.argsort(-counts, kind="stable")
+    return keys[order], counts[order]
+
+
+class NGramCounter:
+    """Exact n-gram counts."""
+
+    def __init__(self, codec: NGramCodec) -> None:
+        self.codec = codec
+        self.keys = codec.encode(np.empty((0, codec.n), dtype=np.int32))
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending: list[np.ndarray] = []
+        self._pending_size = 0
+
+    def add(self, windows: np.ndarray) -> None:
+        if not len(windows):
+            return
+        if not self.codec.fits(windows):
+            self._widen()
+        self._pending.append(self.codec.encode(windows))
+        self._pending_size += len(windows)
+        if self._pending_size > MERGE_THRESHOLD:
+            self._merge()
+
+    def _merge(self) -> None:
+        if not self._pending:
+            return
+        keys, counts = sum_counts(np.concatenate(self._pending))
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+        self.keys, self.counts = sum_counts(keys, counts)
+        self._pending = []
+        self._pending_size = 0
+
+    def _widen(self) -> None:
+        """Repacks the keys, for token ids that don't fit the packing."""
+        self._merge()
+        windows = self.codec.decode(self.keys)
+        self.codec = self.codec.widened()
+        self.keys = self.codec.encode(windows)
+
+    def counted(self) -> tuple[np.ndarray, np.ndarray]:
+        """(distinct keys, counts) of all n-grams added."""
+        self._merge()
+        return self.keys, self.counts
+
+    def most_common(self, k: int) -> list[tuple[np.ndarray, int]]:
+        """[(n-gram token ids, count)] of the k most common n-grams."""
+        keys, counts = top_k(*self.counted(), k)
+        return list(zip(self.codec.decode(keys), counts.tolist()))
+
+
+class NGramSummary(NGramCounter):
+    """
+    Approximate n-gram counts in bounded memory (a mergeable Misra-Gries
+    summary). At most capacity n-grams are kept: when a merge exceeds it, the
+    (capacity + 1)-th largest count is subtracted from every count and
+    n-grams left with no count are dropped.
+
+    Counts are underestimates by at most error_bound, which is at most
+    (number of n-grams added) / (capacity + 1). Any n-gram more frequent than
+    error_bound is guaranteed to be kept.
+    """
+
+    def __init__(self, codec: NGramCodec, memory_budget: int) -> None:
+        """
+        Args:
+            codec (NGramCodec)
+            memory_budget (int): Approximate bytes for the summary and the
+                buffer of pending n-grams (half each).
+        """
+        super().__init__(codec)
+        self.memory_budget = memory_budget
+        self.error_bound = 0
+        self.total = 0
+        self._set_capacity()
+
+    def _set_capacity(self) -> None:
+        key_bytes = self.codec.words * np.dtype(np.int64).itemsize
+        # Summary entries are a key and a count
+        self.capacity = max(1, self.memory_budget // 2 // (key_bytes * 2))
+        self.pending_limit = max(1, self.memory_budget // 2 // key_bytes)
+
+    def add(self, windows: np.ndarray) -> None:
+        if not len(windows):
+            return
+        if not self.codec.fits(windows):
+            self._widen()
+            self._set_capacity()
+        self.total += len(windows)
+        for start in range(0, len(windows), self.pending_limit):
+            chunk = windows[start : start + self.pending_limit]
+            self._pending.append(self.codec.encode(chunk))
+            self._pending_size += len(chunk)
+            if self._pending_size >= self.pending_limit:
+                self._merge()
+
+    def _merge(self) -> None:
+        super()._merge()
+        if len(self.counts) > self.capacity:
+            threshold = np.partition(self.counts, -(self.capacity + 1))[
+                -(self.capacity + 1)
+            ]
+            self.counts = self.counts - threshold
+            keep = self.counts > 0
+            self.keys, self.counts = self.keys[keep], self.counts[keep]
+            self.error_bound += int(threshold)
+
+
+class NGramIds:
+    """
+    Assigns ids 0..m-1 to m distinct n-gram keys and looks up the ids of
+    keys. Multi-word keys are folded one word at a time into the rank of the
+    words so far, so every lookup is a 1-d searchsorted.
+    """
+
+    def __init__(self, keys: np.ndarray) -> None:
+        """
+        Args:
+            keys (np.ndarray): Distinct keys (see NGramCodec).
+        """
+        keys = keys.reshape(len(keys), -1)
+        # Sorted values searched at each step
+        self.tables: list[np.ndarray] = []
+        folded = None
+        for column in keys.T:
+            values = np.unique(column)
+            self.tables.append(values)
+            ranks = np.searchsorted(values, column)
+            if folded is None:
+                folded = ranks
+            else:
+                folded = folded * len(values) + ranks
+                folded_values = np.unique(folded)
+                self.tables.append(folded_values)
+                folded = np.searchsorted(folded_values, folded)
+        # Keys in id order
+        self.keys = np.empty_like(keys)
+        self.keys[folded] = keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Ids (int32) of keys, which must all be known."""
+        keys = keys.reshape(len(keys), -1)
+        tables = iter(self.tables)
+        folded = None
+        for column in keys.T:
+            values = next(tables)
+            ranks = _search_sorted(values, column)
+            if folded is None:
+                folded = ranks
+            else:
+                folded = _search_sorted(next(tables), folded * len(values) + ranks)
+        return folded.astype(np.int32)  # type: ignore
+
+
+def _search_sorted(values: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """
+    np.searchsorted for many unordered needles, which is several times faster
+    on sorted needles (sequential instead of random memory access).
+    """
+    order = np.argsort(needles)
+    positions = np.empty(len(needles), dtype=np.int64)
+    positions[order] = np.searchsorted(values, needles[order])
+    return positions
@@ -1,11 +1,26 @@
 """Misc NLP-related"""
 
+from collections import Counter, deque
+from multiprocessing import get_context
 import spacy
-from collections import Counter
-from typing import Any
-from nltk import ngrams, word_tokenize
+from typing import Any, Iterable, Iterator
+import numpy as np
 from nltk.corpus import stopwords
 
+from backend.db.batch import SentenceBatch, SentenceData, iter_batches
+from backend.db.grouped import GroupedSelection
+from backend.db.stores import AnnotationStore, NGramIndex
+from backend.db.vocab import Vocabulary
+from backend.utils.functions import iter_chunks
+from backend.utils.ngrams import (
+    NGramCodec,
+    NGramCounter,
+    NGramSummary,
+    get_stopword_mask,
+    get_windows,
+    top_k,
+)
+
 
 class SpacyModel:
     def __init__(self) -> None:
@@ -22,60 +37,393 @@ class SpacyModel:
     def word_count(self, sentence: str) -> int:
         return len(self.word_tokenize(sentence))
 
+    def pipe(
+        self,
+        sentences: Iterable[str],
+        annotate: bool = False,
+        batch_size: int = 256,
+    ) -> Iterator[Any]:
+        """
+        nlp.pipe over sentences. Word tokens only need the tokenizer, so the
+        other components only run if annotate is set (except NER, which
+        annotations don't use).
+        """
+        disable = [
+            name for name in self.nlp.pipe_names if not annotate or name == "ner"
+        ]
+        return self.nlp.pipe(sentences, disable=disable, batch_size=batch_size)
 
-# N-Grams
+    def tokenize(
+        self, sentences: Iterable[str], annotate: bool = False, n_process: int = 1
+    ) -> Iterator[tuple[list[str], dict[str, list[Any]] | None]]:
+        """
+        (word tokens, annotations if annotate is set) of each sentence, in
+        order (see doc_words and annotations).
+
+        With n_process > 1, chunks of sentences are processed by a pool of
+        spawned processes, each loading its own model. spaCy's own
+        multiprocessing (nlp.pipe's n_process) forks, which isn't safe from
+        the GUI's threads.
+        """
+        if n_process <= 1:
+            for doc in self.pipe(sentences, annotate=annotate):
+                yield self.doc_words(doc), self.annotations(doc) if annotate else None
+            return
+        context = get_context("spawn")
+        # Leaving the block (also when the generator is closed) terminates
+        # the workers
+        with context.Pool(n_process, initializer=_init_tokenize_worker) as pool:
+            pending = deque()
+            for chunk in iter_chunks(sentences, TOKENIZE_CHUNK_SIZE):
+                pending.append(pool.apply_async(_tokenize_chunk, (chunk, annotate)))
+                if len(pending) >= n_process * TOKENIZE_CHUNKS_PER_PROCESS:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+    @staticmethod
+    def doc_words(doc: Any) -> list[str]:
+        """Same as word_tokenize, for a parsed sentence."""
+        return [token.text for token in doc if token.is_alpha]
+
+    @staticmethod
+    def annotations(doc: Any) -> dict[str, list[Any]]:
+        """
+        POS, dependency label and head, morphology and lemma of each word
+        token of a parsed sentence (see AnnotationTables.encode).
+        """
+        words = [token for token in doc if token.is_alpha]
+        positions = {token.i: position for position, token in enumerate(words)}
+        return {
+            "pos": [token.pos_ for token in words],
+            "dep": [token.dep_ for token in words],
+            "head": [positions.get(token.head.i, -1) for token in words],
+            "morph": [str(token.morph) for token in words],
+            "lemma": [token.lemma_ for token in words],
+        }
+
+
+# The single tokenizer used for word counts, token ids and n-grams. Sentences
+# are tokenized with it at ingest, so this is only loaded for sentences that
+# don't come from the database.
+_spacy_model = None
+
+
+def get_spacy_model() -> SpacyModel:
+    global _spacy_model
+    if _spacy_model is None:
+        _spacy_model = SpacyModel()
+    return _spacy_model
+
+
+# Sentences sent to a tokenizing worker process at a time
+TOKENIZE_CHUNK_SIZE = 1000
+# Chunks queued per worker process, bounding the sentences read ahead
+TOKENIZE_CHUNKS_PER_PROCESS = 2
+
+
+def _init_tokenize_worker() -> None:
+    get_spacy_model()
 
 
-def get_n_grams_from_sentence(sentence, n=2):
-    tokens = word_tokenize(sentence)
-    return list(ngrams(tokens, n))
+def _tokenize_chunk(
+    sentences: list[str], annotate: bool
+) -> list[tuple[list[str], dict[str, list[Any]] | None]]:
+    return list(get_spacy_model().tokenize(sentences, annotate=annotate))
+
+
+def iter_token_batches(batches: Iterable[SentenceBatch]) -> Iterator[SentenceBatch]:
+    """
+    Yields batches with token ids, tokenizing the sentences of any batch
+    without them. Database batches are encoded with (and extend) the
+    database vocabulary, so all batches share one id space. Batches without a
+    vocabulary share a new one.
+    """
+    new_vocabulary = Vocabulary()
+    for batch in batches:
+        if batch.tokens is None:
+            vocabulary = batch.vocabulary
+            if vocabulary is None:
+                vocabulary = new_vocabulary
+            model = get_spacy_model()
+            token_ids_l = [
+                vocabulary.encode(model.word_tokenize(sentence))
+                for sentence in batch.sentences
+            ]
+            batch.set_tokens(token_ids_l, vocabulary)
+        yield batch
+
+
+# N-Grams
 
 
 def get_n_grams_from_corpus(
-    sent_dicts: list[dict[str, Any]],
+    sents: SentenceData,
     n=2,
     ignore_stopword_pairs=True,
+    approximate=False,
+    memory_budget_mb=64,
     frontend_connect: Any | None = None,
-) -> list[tuple[str, int]]:
+) -> list[tuple[str, int]] | list[tuple[str, int, int]]:
+    """
+    Args:
+        sents (SentenceData): SentenceBatch(es) or sent_dicts.
+        n (int, optional): Defaults to 2.
+        ignore_stopword_pairs (bool, optional): Whether to skip n-grams of
+            only stopwords. Defaults to True.
+        approximate (bool, optional): Whether to count n-grams approximately
+            within memory_budget_mb (see NGramSummary), for large corpora
+            and n. Defaults to False.
+        memory_budget_mb (int, optional): Memory for approximate counts.
+            Defaults to 64.
+
+    Returns:
+        list[tuple[str, int]] | list[tuple[str, int, int]]: The 1000 most
+            common n-grams and their counts. Approximate results also have
+            the maximum amount each count is under the true count.
+    """
+    return get_n_grams_from_grouped_corpus(
+        iter_batches(sents),
+        1,
+        n=n,
+        ignore_stopword_pairs=ignore_stopword_pairs,
+        approximate=approximate,
+        memory_budget_mb=memory_budget_mb,
+        frontend_connect=frontend_connect,
+    )[0]
+
+
+def get_n_grams_from_grouped_corpus(
+    grouped_batches: Iterable[SentenceBatch],
+    n_groups: int,
+    n=2,
+    ignore_stopword_pairs=True,
+    approximate=False,
+    memory_budget_mb=64,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, int]]] | list[list[tuple[str, int, int]]]:
+    """
+    Same as get_n_grams_from_corpus for several selections (groups) in one
+    pass. grouped_batches have their group membership set (see
+    GroupedSelection), and each sentence's n-grams are computed once for all
+    of its groups. N-grams are counted as token id arrays (see
+    backend.utils.ngrams) and only converted to strings for the results.
+    The memory budget is shared by the groups.
+    """
     if ignore_stopword_pairs:
         stop_words = set(stopwords.words("english"))
     if frontend_connect:
         frontend_connect.taskInfo.emit("Getting n-grams.", None)
-    n_grams = Counter()
-    for sent_d in sent_dicts:
-        sent_n_grams = get_n_grams_from_sentence(sent_d["sentence"], n=n)
-        for n_gram in sent_n_grams:
-            if ignore_stopword_pairs and stop_words.issuperset(
-                [x.lower() for x in n_gram]
-            ):
-                continue
-            n_gram = " ".join(n_gram)
-            n_grams[n_gram] += 1
+    counters = None
+    vocabulary = None
+    stop_mask = np.empty(0, dtype=bool)
+    for batch in iter_token_batches(grouped_batches):
+        vocabulary = batch.vocabulary
+        if counters is None:
+            codec = NGramCodec(n, len(vocabulary))  # type: ignore
+            if approximate:
+                memory_budget = memory_budget_mb * 2**20 // n_groups
+                counters = [NGramSummary(codec, memory_budget) for _ in range(n_groups)]
+            else:
+                counters = [NGramCounter(codec) for _ in range(n_groups)]
+        windows, sent_index = get_windows(batch.tokens, batch.token_offsets, n)  # type: ignore
+        if ignore_stopword_pairs:
+            if len(stop_mask) != len(vocabulary):  # type: ignore
+                stop_mask = get_stopword_mask(vocabulary, stop_words)  # type: ignore
+            keep = ~stop_mask[windows].all(axis=1)
+            windows, sent_index = windows[keep], sent_index[keep]
+        masks = batch.group_masks()
+        for group, counter in enumerate(counters):
+            counter.add(windows[masks[sent_index, group]])
 
-    return n_grams.most_common(1000)
+    results = []
+    for counter in counters or [None] * n_groups:
+        if counter is None:
+            results.append([])
+            continue
+        group_results = []
+        for n_gram, count in counter.most_common(1000):
+            n_gram_str = " ".join(vocabulary.decode(n_gram))  # type: ignore
+            if approximate:
+                group_results.append((n_gram_str, count, counter.error_bound))  # type: ignore
+            else:
+                group_results.append((n_gram_str, count))
+        results.append(group_results)
+    return results
+
+
+def get_n_grams_from_index(
+    index: NGramIndex,
+    grouped: GroupedSelection,
+    ignore_stopword_pairs=True,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, int]]]:
+    """
+    Same as get_n_grams_from_grouped_corpus (exact counts), from the
+    precomputed n-gram ids of the selected sentences instead of their tokens.
+    """
+    if frontend_connect:
+        frontend_connect.taskInfo.emit("Getting n-grams from index.", None)
+    if ignore_stopword_pairs:
+        stop_mask = get_stopword_mask(index.vocabulary, stopwords.words("english"))
+        stop_ngrams = stop_mask[index.windows].all(axis=1)
+    results = []
+    for ngram_ids, counts in index.count(grouped):
+        if ignore_stopword_pairs:
+            keep = ~stop_ngrams[ngram_ids]
+            ngram_ids, counts = ngram_ids[keep], counts[keep]
+        ngram_ids, counts = top_k(ngram_ids, counts, 1000)
+        results.append(
+            [
+                (" ".join(index.vocabulary.decode(index.windows[ngram_id])), count)
+                for ngram_id, count in zip(ngram_ids.tolist(), counts.tolist())
+            ]
+        )
+    return results
+
+
+# Lemmas
+
+# Universal POS tags of content words
+CONTENT_POS = {"NOUN", "PROPN", "VERB", "ADJ", "ADV"}
+
+
+def get_lemmas_from_corpus(
+    sents: SentenceData,
+    content_words_only=False,
+    frontend_connect: Any | None = None,
+) -> list[tuple[str, str, int]]:
+    """
+    Args:
+        sents (SentenceData): SentenceBatch(es) or sent_dicts.
+        content_words_only (bool, optional): Whether to only count nouns,
+            verbs, adjectives and adverbs. Defaults to False.
+
+    Returns:
+        list[tuple[str, str, int]]: The 1000 most common (lemma, POS) pairs
+            of the word tokens and their counts.
+    """
+    return get_lemmas_from_grouped_corpus(
+        iter_batches(sents),
+        1,
+        content_words_only=content_words_only,
+        frontend_connect=frontend_connect,
+    )[0]
+
+
+def get_lemmas_from_grouped_corpus(
+    grouped_batches: Iterable[SentenceBatch],
+    n_groups: int,
+    content_words_only=False,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, str, int]]]:
+    """
+    Same as get_lemmas_from_corpus for several groups in one pass (see
+    get_n_grams_from_grouped_corpus). Sentences are parsed here, so
+    get_lemmas_from_store is much faster for corpora with stored
+    annotations.
+    """
+    if frontend_connect:
+        frontend_connect.taskInfo.emit("Getting lemmas.", None)
+    model = get_spacy_model()
+    counters = [Counter() for _ in range(n_groups)]
+    for batch in iter_batches(grouped_batches):
+        docs = model.pipe(batch.sentences, annotate=True)
+        for doc, groups in zip(docs, batch.iter_groups()):
+            annotations = model.annotations(doc)
+            pairs = [
+                (lemma, pos)
+                for lemma, pos in zip(annotations["lemma"], annotations["pos"])
+                if not content_words_only or pos in CONTENT_POS
+            ]
+            for group in groups.tolist():
+                counters[group].update(pairs)
+    return [
+        [(lemma, pos, count) for (lemma, pos), count in counter.most_common(1000)]
+        for counter in counters
+    ]
+
+
+def get_lemmas_from_store(
+    store: AnnotationStore,
+    grouped: GroupedSelection,
+    content_words_only=False,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, str, int]]]:
+    """
+    Same as get_lemmas_from_grouped_corpus, from the stored annotations of
+    the selected sentences instead of parsing them.
+    """
+    if frontend_connect:
+        frontend_connect.taskInfo.emit("Getting lemmas from annotations.", None)
+    label_ids, counts_l = store.count(grouped, ("lemma", "pos"))
+    if content_words_only:
+        content = store.tables.label_mask("pos", CONTENT_POS)
+        counts_l[:, ~content[label_ids[:, 1]]] = 0
+    lemmas = store.tables["lemma"].tokens
+    pos_labels = store.tables["pos"].tokens
+    results = []
+    for counts in counts_l:
+        index, counts = top_k(np.flatnonzero(counts), counts[counts > 0], 1000)
+        results.append(
+            [
+                (lemmas[lemma_id], pos_labels[pos_id], count)
+                for (lemma_id, pos_id), count in zip(
+                    label_ids[index].tolist(), counts.tolist()
+                )
+            ]
+        )
+    return results
 
 
 def summary(
-    sent_dicts: list[dict[str, Any]],
+    sents: SentenceData,
     frontend_connect: Any | None = None,
 ) -> list[tuple[str, str | int | float]]:
-    sent_count = 0
-    word_count = 0
-    word_types = set()
+    """
+    Args:
+        sents (SentenceData): SentenceBatch(es) or sent_dicts.
+    """
+    return summary_grouped(iter_batches(sents), 1, frontend_connect=frontend_connect)[0]
+
+
+def summary_grouped(
+    grouped_batches: Iterable[SentenceBatch],
+    n_groups: int,
+    frontend_connect: Any | None = None,
+) -> list[list[tuple[str, str | int | float]]]:
+    """
+    Same as summary for several groups in one pass (see
+    get_n_grams_from_grouped_corpus).
+    """
+    sent_counts = np.zeros(n_groups, dtype=np.int64)
+    word_counts = np.zeros(n_groups, dtype=np.int64)
+    word_types_l = [set() for _ in range(n_groups)]
     if frontend_connect:
         frontend_connect.taskInfo.emit("Getting summary data.", None)
-    for sent_dict in sent_dicts:
-        sent_count += 1
-        tokens = word_tokenize(sent_dict["sentence"])
-        word_count += len(tokens)
-        word_types.update(tokens)
-    if sent_count:
-        average_sent_length = round(word_count / sent_count, 2)
-    else:
-        average_sent_length = "N/A"
-    return [
-        ("sentence count", sent_count),
-        ("word tokens", word_count),
-        ("word types", len(word_types)),
-        ("mlu", average_sent_length),
-    ]
+    for batch in iter_token_batches(grouped_batches):
+        masks = batch.group_masks()
+        lengths = batch.token_lengths()
+        sent_counts += masks.sum(axis=0)
+        word_counts += lengths @ masks
+        for group in range(n_groups):
+            # Token ids of the sentences in the group
+            group_tokens = batch.tokens[np.repeat(masks[:, group], lengths)]  # type: ignore
+            word_types_l[group].update(np.unique(group_tokens).tolist())
+    results = []
+    for sent_count, word_count, word_types in zip(
+        sent_counts.tolist(), word_counts.tolist(), word_types_l
+    ):
+        if sent_count:
+            average_sent_length = round(word_count / sent_count, 2)
+        else:
+            average_sent_length = "N/A"
+        results.append(
+            [
+                ("sentence count", sent_count),
+                ("word tokens", word_count),
+                ("word types", len(word_types)),
+                ("mlu", average_sent_length),
+            ]
+        )
+    return results
@@ -56,43 +56,64 @@ class TaskThread(QThread):
         self.selections = selections
         self.progress_backend = ProgressBackend()
         self.progress_backend.taskInfo.connect(self.taskInfo)
+        self.progress_backend.increment.connect(self.increment)
 
     def run(self):
-        sent_dicts_l = []
-        for selection in self.selections:
-            sent_dicts = self.project.corpus_query(selection)["sent_dicts"]
-            sent_dicts_l.append(sent_dicts)
-
         for task_name, task_dict in self.tasks_dict.items():
             task_results = {"task_name": task_name, "results_and_selections": []}
-            if class_ := task_dict.get("class"):
-                obj = class_()
-
-                def func(sent_dicts):
-                    return task_dict["func"](
-                        obj,
-                        sent_dicts,
+            try:
+                results_l = None
+                if index_func := task_dict.get("index_func"):
+                    # Precomputed indexes, if they cover the task's arguments
+                    results_l = index_func(
+                        self.project,
+                        self.selections,
                         **task_dict["args"],
                         frontend_connect=self.progress_backend,
                     )
-            else:
-
-                def func(sent_dicts):
-                    return task_dict["func"](
-                        sent_dicts,
+                # Class tasks get the instance (on the configured runtime) as
+                # the first argument. Models are only loaded if needed.
+                obj_args = ()
+                if results_l is None and task_dict.get("class"):
+                    obj_args = (task_dict["class"](self.project.config.runtime),)
+                grouped_func = task_dict.get("grouped_func")
+                if results_l is None and grouped_func:
+                    # One pass over the union of the selections
+                    grouped_batches = self.project.iter_grouped_corpus_query(
+                        self.selections, columns=("sentence",)
+                    )
+                    results_l = grouped_func(
+                        *obj_args,
+                        grouped_batches,
+                        len(self.selections),
                         **task_dict["args"],
                         frontend_connect=self.progress_backend,
                     )
-
-            for sent_dicts in sent_dicts_l:
-                try:
-                    results = func(sent_dicts)
+                elif results_l is None:
+                    results_l = []
+                    for selection in self.selections:
+                        # Sentences are streamed from the database, so only
+                        # one chunk of records is held in memory at a time.
+                        sent_dicts = self.project.iter_corpus_query(selection)
+                        kwargs = {}
+                        if task_dict.get("checkpoint"):
+                            kwargs["checkpoint_path"] = (
+                                self.project.paths.task_checkpoint(task_name, selection)
+                            )
+                        results = task_dict["func"](
+                            *obj_args,
+                            sent_dicts,
+                            **task_dict["args"],
+                            **kwargs,
+                            frontend_connect=self.progress_backend,
+                        )
+                        results_l.append(results)
+                for results, selection in zip(results_l, self.selections):
                     results_and_selection = {"results": results, "selection": selection}
                     task_results["results_and_selections"].append(results_and_selection)
-                except Exception as e:
-                    error_message = f"{type(e).__name__}: {str(e)}"
-                    task_results = {"error": error_message, "task_name": task_name}
-                    break
+            except Exception as e:
+                error_message = f"{type(e).__name__}: {str(e)}"
+                task_results = {"error": error_message, "task_name": task_name}
 
             self.task_results.emit(task_results)
         self.complete.emit()
@@ -137,6 +158,7 @@ class BasicAnalysisWidget(QWidget):
 
         self.task_thread = TaskThread(self.project, tasks_dict, self.selections)
         self.task_thread.taskInfo.connect(self.task_widget.progress_widget.load_task)
+        self.task_thread.increment.connect(self.task_widget.progress_widget.increment)
         self.task_thread.task_results.connect(self.load_task_results)
         self.task_thread.complete.connect(self.on_tasks_complete)
         self.task_thread.start()
@@ -6,6 +6,7 @@ corpus.
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QVBoxLayout, QWidget
 
+from backend.db.db import AGG_META_PROPERTY
 from backend.corpus.items import (
     CorpusItem,
     Folder,
@@ -38,6 +39,13 @@ class Overview(QWidget):
 
     def add_widgets(self):
         clear_layout(self.content_layout)
+        # Per-value counts for meta properties, precomputed at ingest
+        meta_counts = {}
+        if self.project.config.status["corpus_processed"]:
+            agg_counts = self.project.db.get_aggregate_counts(AGG_META_PROPERTY)
+            for (label_name, name, value), counts in agg_counts.items():
+                meta_counts.setdefault((label_name, name), {})
+                meta_counts[(label_name, name)][value] = counts
         for prop_name in ("subfolders", "text_categories", "meta_properties"):
             data = {}
             if prop_name == "meta_properties":
@@ -46,7 +54,9 @@ class Overview(QWidget):
                 ).items():
                     for name, item in properties_d.items():
                         data[(parent_name, name)] = CorpusOverviewItem(
-                            item, name=f"{parent_name}-{name}"
+                            item,
+                            name=f"{parent_name}-{name}",
+                            value_counts=meta_counts.get((parent_name, name)),
                         )
             else:
                 for name, item in getattr(
@@ -60,7 +70,12 @@ class Overview(QWidget):
 
 
 class CorpusOverviewItem(QWidget):
-    def __init__(self, item: CorpusItem, name: str | None = None) -> None:
+    def __init__(
+        self,
+        item: CorpusItem,
+        name: str | None = None,
+        value_counts: dict[str, dict[str, int]] | None = None,
+    ) -> None:
         super().__init__()
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -86,8 +101,20 @@ class CorpusOverviewItem(QWidget):
                 "parent label": item.label_name,
                 "type": item.type.name.lower(),  # type: ignore
             }
+            if value_counts:
+                data["sentence count"] = sum(
+                    d["sent_count"] for d in value_counts.values()
+                )
             if item.type is MetaType.QUANTITATIVE:
                 data.update({"value range": f"{item.min} - {item.max}"})
+            elif value_counts:
+                values = {
+                    f"{value} ({value_counts[value]['sent_count']} sentences)"
+                    if value in value_counts
+                    else value
+                    for value in item.cat_values  # type: ignore
+                }
+                data.update({"values": values})
             else:
                 data.update({"values": item.cat_values})  # type: ignore
             info_layout.addWidget(KeyValueTable(data))
@@ -10,7 +10,10 @@ Main components:
 - Results tab
 """
 
+import threading
 from typing import Any, Callable
+
+import numpy as np
 from PySide6.QtCore import QThread, Qt, Signal, qDebug
 from PySide6.QtWidgets import (
     QButtonGroup,
@@ -24,21 +27,28 @@ from PySide6.QtWidgets import (
     QWidget,
 )
 
-from backend.tasks.plot import get_plot_values
-from backend.corpus.items import MetaProperty
+from backend.db.db import AGG_SUBFOLDER, AGG_TEXT_CATEGORY
+from backend.tasks.plot import (
+    MAX_X_VALUES,
+    get_project_plot_values,
+    reduce_plot_values,
+)
+from backend.tasks.plot_workers import PlotCancelled
+from backend.corpus.items import MetaProperty, MetaType
 from frontend.project import ProjectWrapper as Project
 from frontend.styles.colors import Colors
 from frontend.utils.functions import clear_layout, get_widgets
 from frontend.widgets.corpus_selection import CorpusSelectionWidget
 from frontend.widgets.layouts import HScrollSection, MainColumn, VSplitter
 from frontend.widgets.plot import ImageDisplayWidget, plot_graph
-from frontend.widgets.progress import ProgressWidget
+from frontend.widgets.progress import ProgressBackend, ProgressWidget
 from frontend.widgets.small import (
     Button,
     CheckBox,
     CorpusLabel,
     ErrorDisplay,
     LargeHeading,
+    NumberEntryWidget,
     RadioButton,
     RadioButtonWithWidget,
 )
@@ -49,6 +59,7 @@ from frontend.widgets.tables import (
 
 class TaskThread(QThread):
     taskInfo = Signal(str, int)
+    increment = Signal()
     complete = Signal(dict)
 
     def __init__(
@@ -59,48 +70,95 @@ class TaskThread(QThread):
         super().__init__()
         self.project = project
         self.plot_d = plot_d
+        self.progress_backend = ProgressBackend()
+        self.progress_backend.taskInfo.connect(self.taskInfo)
+        self.progress_backend.increment.connect(self.increment)
+        self.cancel_event = threading.Event()
 
-    def run(self):
-        sent_batches = {}
+    def cancel(self):
+        self.cancel_event.set()
+
+    def get_groups(
+        self,
+    ) -> tuple[str, list[Any], list[np.ndarray], list[dict[str, int]] | None]:
+        """
+        Returns (x label, x values, sorted sentence ids of each x value,
+        sentence and word counts of each x value if precomputed).
+        """
+        labels = []
+        group_ids = []
+        # Sentence and word counts per x value, read from the aggregate counts
+        group_counts = []
         if self.plot_d["x_type"] == "Subfolders":
             x_label = "Subfolder"
+            counts = self.project.db.get_aggregate_counts(AGG_SUBFOLDER)
             for path in self.plot_d["x_values"]:
-                sent_batches[path.name] = [
-                    sd["sentence"]
-                    for sd in self.project.db.get_sents_by_named_subfolder(path.name)[
-                        "sent_dicts"
-                    ]
-                ]
+                labels.append(path.name)
+                group_ids.append(
+                    self.project.corpus_query_ids({"subfolders": path.name})
+                )
+                group_counts.append(counts.get(path.name))
         elif self.plot_d["x_type"] == "Text":
             x_label = "Text category"
+            counts = self.project.db.get_aggregate_counts(AGG_TEXT_CATEGORY)
             for text_cat_name in self.plot_d["x_values"]:
-                sent_batches[text_cat_name] = [
-                    sd["sentence"]
-                    for sd in self.project.db.get_sents_by_text_category(text_cat_name)[
-                        "sent_dicts"
-                    ]
-                ]
-        elif self.plot_d["x_type"] == "Meta":
+                labels.append(text_cat_name)
+                group_ids.append(
+                    self.project.corpus_query_ids({"text_categories": text_cat_name})
+                )
+                group_counts.append(counts.get(text_cat_name))
+        else:
             label_name, name = self.plot_d["x_values"][0]
             x_label = f"{label_name}-{name}"
-            query_result = self.project.db.get_all_sents()
-            for sent_d in query_result["sent_dicts"]:  # type: ignore
-                meta_props = query_result["meta_properties"][  # type: ignore
-                    sent_d["file_path"].__str__()
-                ]
-
-                for meta_prop in meta_props:
-                    if (
-                        meta_prop["label_name"] == label_name
-                        and meta_prop["name"] == name
-                    ):
-                        if meta_prop["value"] in (552, "552"):
-                            break
-                        sent_batches.setdefault(meta_prop["value"], [])
-                        sent_batches[meta_prop["value"]].append(sent_d["sentence"])
-                        break
+            meta_props = self.project.corpus_config.get_meta_properties(as_dict=True)
+            meta_prop = meta_props.get((label_name, name))  # type: ignore
+            # Numeric values are binned into the chosen number of bins, or if
+            # there are too many to plot, unless the property is categorical
+            bins = max_values = None
+            if meta_prop is None or meta_prop.type is not MetaType.CATEGORICAL:
+                bins = self.plot_d.get("x_bins")
+                max_values = MAX_X_VALUES
+            # Sentences of every value (or bin of values) in one query
+            for value, ids, word_count in self.project.db.get_meta_property_groups(
+                label_name, name, bins=bins, max_values=max_values
+            ):
+                labels.append(value)
+                group_ids.append(ids)
+                # Unknown word counts are taken from the token store instead
+                group_counts.append(
+                    None
+                    if word_count is None
+                    else {"sent_count": len(ids), "word_count": word_count}
+                )
+        if any(d is None for d in group_counts):
+            return x_label, labels, group_ids, None
+        return x_label, labels, group_ids, group_counts
+
+    def run(self):
         try:
-            plot_values = get_plot_values(sent_batches, self.plot_d)
+            # One group of sentences per x value. All groups are evaluated in
+            # a single pass over the union of their sentences.
+            x_label, labels, group_ids, group_counts = self.get_groups()
+            plot_values = get_project_plot_values(
+                self.project,
+                group_ids,
+                labels,
+                self.plot_d,
+                group_counts,
+                cancel=self.cancel_event,
+                frontend_connect=self.progress_backend,
+            )
+            weights = None
+            if group_counts is not None and self.plot_d["y_per"] != "total":
+                key = (
+                    "sent_count"
+                    if self.plot_d["y_per"] == "per sentence"
+                    else "word_count"
+                )
+                weights = [d[key] for d in group_counts]
+            plot_values = reduce_plot_values(
+                plot_values, self.plot_d["plot_type"], self.plot_d["y_per"], weights
+            )
             results = {
                 "plot_values": plot_values,
                 "x_label": x_label,
@@ -109,6 +167,8 @@ class TaskThread(QThread):
                 "y_type": self.plot_d["y_type"],
                 "plot_type": self.plot_d["plot_type"],
             }
+        except PlotCancelled:
+            results = {}
         except Exception as e:
             error_message = f"{type(e).__name__}: {str(e)}"
             results = {"error": error_message, "y_type": self.plot_d["y_type"]}
@@ -146,6 +206,10 @@ class PlotTab(QWidget):
         self.plot_widget.progress_widget.show()
 
         self.task_thread = TaskThread(self.project, self.plot_widget.plot_d)
+        progress_widget = self.plot_widget.progress_widget
+        self.task_thread.taskInfo.connect(progress_widget.load_task)
+        self.task_thread.increment.connect(progress_widget.increment)
+        progress_widget.cancel_button.clicked.connect(self.task_thread.cancel)
         self.task_thread.complete.connect(self.on_task_complete)
         self.task_thread.start()
 
@@ -163,6 +227,9 @@ class PlotTab(QWidget):
             plot_display_widget = ImageDisplayWidget(image)
             self.results.add_tab(plot_display_widget, results["y_type"])
         self.task_thread.quit()
+        self.plot_widget.progress_widget.cancel_button.clicked.disconnect(
+            self.task_thread.cancel
+        )
         self.plot_widget.progress_widget.hide()
         # self.plot_widget.tasks_finished_label.show()
         self.plot_widget.plot_button.setEnabled(True)
@@ -241,6 +308,7 @@ class PlotWidget(MainColumn):
             "x_values": [],
             "y_func": [],
             "plot_type": self.plot_type_select.get_plot_type(),
+            "intervals": self.plot_type_select.intervals_checkbox.is_checked(),
         }
         for name, d in self.x_select.ref.items():  # type: ignore
             if d["radio_button"].isChecked():
@@ -248,6 +316,8 @@ class PlotWidget(MainColumn):
                 for item, checkbox in d["items_options"].content_ref.items():
                     if checkbox.is_checked():
                         self.plot_d["x_values"].append(item)
+                if name == "Meta" and (bins := self.x_select.get_bins()):
+                    self.plot_d["x_bins"] = bins
                 break
         for name, d in self.y_select.ref.items():  # type: ignore
             if d["radio_button"].isChecked():
@@ -288,6 +358,12 @@ class PlotTypeSelect(QWidget):
             if plot_type == "line":
                 radio_button.setChecked(True)
             self.radio_layout.addWidget(radio_button)
+        self.intervals_checkbox = CheckBox(
+            "95% confidence intervals",
+            tooltip="Bootstrap intervals of each value (bands or error bars)",
+        )
+        self.intervals_checkbox.check()
+        layout.addWidget(self.intervals_checkbox)
 
     def get_plot_type(self):
         for widget in get_widgets(self.radio_layout):
@@ -369,6 +445,15 @@ class XSelect(QWidget):
         self.x_choices_items_widget.setCurrentIndex(0)
         self.content_layout.addLayout(x_choices_layout)
         self.content_layout.addWidget(self.x_choices_items_widget)
+        # Equal-width bins of numeric meta property values (0 for a point per
+        # value, binned only if there are too many to plot)
+        self.bins_entry = NumberEntryWidget("Bins", default=0)
+        self.bins_entry.setToolTip(
+            "Number of equal-width bins of numeric values (0 for automatic)"
+        )
+        self.bins_entry.setContentsMargins(10, 10, 10, 0)
+        self.bins_entry.hide()
+        self.content_layout.addWidget(self.bins_entry)
         self.X_choices_group = QButtonGroup(x_choices_layout)
         self.X_choices_group.setExclusive(True)
 
@@ -376,8 +461,17 @@ class XSelect(QWidget):
         for entry in self.ref.values():
             if entry["radio_button"].isChecked():
                 self.x_choices_items_widget.setCurrentWidget(entry["items_options"])
+        self.bins_entry.setVisible(self.ref["Meta"]["radio_button"].isChecked())
         self.handle()
 
+    def get_bins(self) -> int | None:
+        """Number of bins entered for meta property values, or None."""
+        try:
+            bins = self.bins_entry.get_value()
+        except ValueError:
+            return None
+        return bins if bins > 0 else None
+
 
 class YSelect(QWidget):
     def __init__(self, project: Project, handle: Callable):
@@ -49,12 +49,10 @@ class SearchThread(QThread):
         if self.type == "semantic":
             if not self.search_model:
                 # sent_dicts = self.project.db.get_all_sents()['sent_dicts']
-                self.search_model = SemanticModel()
+                self.search_model = SemanticModel(runtime=self.project.config.runtime)
                 self.modelLoaded.emit(self.search_model)
-            sent_ds = self.project.db.get_all_sents(include_embeddings=True)[
-                "sent_dicts"
-            ]  # type: ignore
-            results = self.search_model.query_sents_from_db(self.query, sent_ds)
+            batch = self.project.corpus_batch({}, columns=("file_path", "embedding"))
+            results = self.search_model.query_sents_from_db(self.query, batch)
         else:
             results = []
         self.searchComplete.emit(results)
@@ -1,10 +1,18 @@
 """
 Widget that's used to select subset(s) of the corpus to analyze,
-    filtered by subfolder/text category/meta property values.
+    filtered by subfolder/text category/meta property values and named
+    entities (if they were extracted when the corpus was processed).
 """
 
 from PySide6.QtCore import Signal
-from PySide6.QtWidgets import QFrame, QLabel, QVBoxLayout, QWidget
+from PySide6.QtWidgets import (
+    QFrame,
+    QHBoxLayout,
+    QLabel,
+    QLineEdit,
+    QVBoxLayout,
+    QWidget,
+)
 from backend.corpus.items import LabelType, MetaType
 from frontend.project import ProjectWrapper as Project
 from frontend.styles.colors import Colors
@@ -14,6 +22,8 @@ from frontend.widgets.small import (
     Button,
     CheckBox,
     CorpusLabel,
+    DropDownMenu,
+    EntityFilter,
     MetaPropFilter,
     MetaPropertySelection,
 )
@@ -81,10 +91,55 @@ class CorpusSelectionWidget(MainColumn):
         self.filter_layout.setContentsMargins(10, 0, 10, 0)
         self.content_layout.addLayout(self.filter_layout)
 
+        self.entity_filter_layout = QVBoxLayout()
+        self.entity_filter_layout.setContentsMargins(10, 0, 10, 0)
+        entity_types = self.project.get_entity_types()
+        if entity_types:
+            self.add_entity_filter_widgets(entity_types)
+        self.content_layout.addLayout(self.entity_filter_layout)
+
         # Selection display
         self.display = CorpusSelectionDisplay()
         self.content_layout.addWidget(self.display)  # type: ignore
 
+    def add_entity_filter_widgets(self, entity_types: list[str]) -> None:
+        entity_layout = QHBoxLayout()
+        entity_layout.setContentsMargins(20, 0, 10, 0)
+        entity_layout.addWidget(QLabel("Entity filter:"))
+        self.entity_type_select = DropDownMenu()
+        self.entity_type_select.addItems(["Any type", *entity_types])
+        entity_layout.addWidget(self.entity_type_select)
+        self.entity_text_entry = QLineEdit()
+        self.entity_text_entry.setPlaceholderText("Entity text (optional)")
+        entity_layout.addWidget(self.entity_text_entry)
+        entity_layout.addWidget(
+            Button(
+                "Add Entity Filter",
+                tooltip="Add filter for sentences with a named entity",
+                connect=self.add_entity_filter,
+            )
+        )
+        entity_layout.addStretch()
+        self.content_layout.addLayout(entity_layout)
+
+    def add_entity_filter(self) -> None:
+        entity_type = None
+        if self.entity_type_select.currentIndex() > 0:
+            entity_type = self.entity_type_select.currentText()
+        text = self.entity_text_entry.text().strip() or None
+        self.entity_text_entry.clear()
+
+        def remove_filter():
+            filter_widget.setParent(None)
+            filter_widget.deleteLater()
+            self.update_selections_d()
+
+        filter_widget = EntityFilter(
+            [{"type": entity_type, "text": text}], remove_filter
+        )
+        self.entity_filter_layout.addWidget(filter_widget)
+        self.update_selections_d()
+
     def toggle_filter_button(self) -> None:
         if any(
             checkbox.is_checked()
@@ -136,6 +191,7 @@ class CorpusSelectionWidget(MainColumn):
             else:
                 self.selections_d[prop_name] = []
         self.selections_d["meta_prop_filters"] = get_widgets(self.filter_layout)
+        self.selections_d["entity_filters"] = get_widgets(self.entity_filter_layout)
         selections_update = self.display.show_selections(self.selections_d)
         self.selectionsUpdate.emit(selections_update)
 
@@ -148,15 +204,18 @@ class CorpusSelectionWidget(MainColumn):
                 for meta_prop_filter in self.selections_d["meta_prop_filters"] or [
                     None
                 ]:
-                    selection = {}
-                    if subfolder_item:
-                        selection["subfolders"] = subfolder_item.text()
-                    if text_cat_item:
-                        selection["text_categories"] = text_cat_item.text()
-                    if meta_prop_filter:
-                        selection["meta_properties"] = meta_prop_filter.filter_l
-                    if selection:
-                        selections.append(selection)
+                    for entity_filter in self.selections_d["entity_filters"] or [None]:
+                        selection = {}
+                        if subfolder_item:
+                            selection["subfolders"] = subfolder_item.text()
+                        if text_cat_item:
+                            selection["text_categories"] = text_cat_item.text()
+                        if meta_prop_filter:
+                            selection["meta_properties"] = meta_prop_filter.filter_l
+                        if entity_filter:
+                            selection["entities"] = entity_filter.filter_l
+                        if selection:
+                            selections.append(selection)
 
         return selections
 
@@ -182,22 +241,33 @@ class CorpusSelectionDisplay(HScrollSection):
                 for i3, meta_prop_filter in enumerate(
                     selection["meta_prop_filters"] or [None]
                 ):
-                    selection_frame = SelectionFrame()
-                    if subfolder_item:
-                        selection_frame.add_widget(subfolder_item.get_copy())
-                    if text_cat_item:
-                        selection_frame.add_widget(text_cat_item.get_copy())
-                    if meta_prop_filter:
-                        widget = CorpusLabel(
-                            text=f"filter {i3 + 1}",
-                            color=meta_prop_filter.color,
-                            tooltip=meta_prop_filter.toolTip(),
-                            id=meta_prop_filter.filter_l,  # type: ignore
-                            label_type=LabelType.META,
-                        )
-                        selection_frame.add_widget(widget)
-                    content[(i1, i2, i3)] = selection_frame
-                    self.last_selections.append(selection_frame)
+                    for i4, entity_filter in enumerate(
+                        selection.get("entity_filters") or [None]
+                    ):
+                        selection_frame = SelectionFrame()
+                        if subfolder_item:
+                            selection_frame.add_widget(subfolder_item.get_copy())
+                        if text_cat_item:
+                            selection_frame.add_widget(text_cat_item.get_copy())
+                        if meta_prop_filter:
+                            widget = CorpusLabel(
+                                text=f"filter {i3 + 1}",
+                                color=meta_prop_filter.color,
+                                tooltip=meta_prop_filter.toolTip(),
+                                id=meta_prop_filter.filter_l,  # type: ignore
+                                label_type=LabelType.META,
+                            )
+                            selection_frame.add_widget(widget)
+                        if entity_filter:
+                            widget = CorpusLabel(
+                                text=f"entity {i4 + 1}",
+                                color=entity_filter.color,
+                                tooltip=entity_filter.toolTip(),
+                                label_type=LabelType.META,
+                            )
+                            selection_frame.add_widget(widget)
+                        content[(i1, i2, i3, i4)] = selection_frame
+                        self.last_selections.append(selection_frame)
         self.add_content(content)
         if not any(v for v in selection.values()):
             self.clear()
@@ -1,12 +1,28 @@
-import seaborn as sns
-import matplotlib.pyplot as plt
-import pandas as pd
-import io
-from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 
 from PySide6.QtGui import QImage, QPixmap
 from PySide6.QtWidgets import QLabel, QVBoxLayout, QWidget
 
+# Size (inches) and resolution of rendered plots
+FIGURE_SIZE = (10, 8)
+DPI = 100
+
+# Agg canvas shared by all plots (see _get_canvas)
+_canvas: FigureCanvasAgg | None = None
+
+
+def _get_canvas() -> FigureCanvasAgg:
+    """
+    Returns the shared Agg canvas. Its figure is cleared and redrawn for
+    each plot, so figures aren't created (and left open) per plot.
+    """
+    global _canvas
+    if _canvas is None:
+        _canvas = FigureCanvasAgg(Figure(figsize=FIGURE_SIZE, dpi=DPI))
+    return _canvas
+
 
 def plot_graph(
     plot_values: list[tuple],
@@ -14,13 +30,17 @@ def plot_graph(
     title="Plot",
     x_label="X-axis",
     y_label="count",
-):
-    """Returns a PIL image of either a line or bar graph based on (x, y) tuples.
+) -> QImage:
+    """Returns a QImage of either a line or bar graph based on (x, y) tuples.
 
+    The graph is drawn on a reused Agg canvas and its RGBA buffer is copied
+    straight into the QImage, without encoding an image file.
 
     Args:
-        plot_values (list[tuple]): A list of (x, y) tuples where x and y are
-            numeric values.
+        plot_values (list[tuple]): A list of (x, y) tuples where y values are
+            numeric, or (x, y, low, high) tuples with confidence intervals,
+            drawn as a band for line graphs with numeric x and as error bars
+            otherwise. Numeric x values are sorted.
         plot_type (str, optional)
         title (str, optional)
         x_label (str, optional)
@@ -30,50 +50,70 @@ def plot_graph(
         ValueError: Invalid plot type specified.
 
     Returns:
-        image (PIL.image)
+        image (QImage)
     """
-
-    # Convert the list of tuples into a pandas DataFrame for easier plotting
-    df = pd.DataFrame(plot_values, columns=["x", "y"])
-
-    # num_x_ticks = len(df["x"])
-    # width = max(8, int(num_x_ticks / 1.5))
-    # figsize = (
-    #     width,
-    #     6,
-    # )
-    plt.figure(figsize=(10, 8))
-    plt.tight_layout()
-    # Create the plot based on the plot_type argument
+    if plot_type not in ("line", "bar"):
+        raise ValueError("Invalid plot_type. Use 'line' or 'bar'.")
+    numeric_x = all(isinstance(item[0], (int, float)) for item in plot_values)
+    if numeric_x:
+        plot_values = sorted(plot_values, key=lambda item: item[0])
+    x_values = [item[0] for item in plot_values]
+    y_values = [item[1] for item in plot_values]
+    intervals = None
+    if plot_values and len(plot_values[0]) == 4:
+        intervals = np.array([item[2:] for item in plot_values], dtype=float)
+
+    canvas = _get_canvas()
+    figure = canvas.figure
+    figure.clear()
+    ax = figure.add_subplot()
     if plot_type == "line":
-        sns.lineplot(data=df, x="x", y="y")
-    elif plot_type == "bar":
-        sns.barplot(data=df, x="x", y="y")
+        lines = ax.plot(x_values, y_values)
+        if intervals is not None and numeric_x:
+            ax.fill_between(
+                x_values,
+                intervals[:, 0],
+                intervals[:, 1],
+                color=lines[0].get_color(),
+                alpha=0.25,
+                linewidth=0,
+            )
+        elif intervals is not None:
+            ax.errorbar(
+                x_values, y_values, yerr=_error_lengths(y_values, intervals), fmt="none"
+            )
     else:
-        raise ValueError("Invalid plot_type. Use 'line' or 'bar'.")
+        # Bars are categorical, as in seaborn's barplot
+        x_values = [str(x) for x in x_values]
+        yerr = None
+        if intervals is not None:
+            yerr = _error_lengths(y_values, intervals)
+        ax.bar(x_values, y_values, yerr=yerr, capsize=4)
 
     # Set labels and title with bold, slightly larger font and padding
-    plt.xlabel(x_label, fontsize=14, fontweight="bold", labelpad=15)
-    plt.ylabel(y_label, fontsize=14, fontweight="bold", labelpad=15)
-    plt.title(title, fontsize=16, fontweight="bold", pad=20)
+    ax.set_xlabel(x_label, fontsize=14, fontweight="bold", labelpad=15)
+    ax.set_ylabel(y_label, fontsize=14, fontweight="bold", labelpad=15)
+    ax.set_title(title, fontsize=16, fontweight="bold", pad=20)
+    figure.tight_layout()
 
-    # Save the plot to a BytesIO buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    image = QImage(canvas.buffer_rgba(), width, height, QImage.Format.Format_RGBA8888)
+    # The canvas buffer is overwritten by the next plot
+    return image.copy()
 
-    # Read the image from the buffer using PIL
-    image = Image.open(buf)
 
-    # Return the image object
-    return image
+def _error_lengths(y_values: list[float], intervals: np.ndarray) -> np.ndarray:
+    """Intervals as (2 x points) lengths below and above y, 0 if missing."""
+    y = np.array(y_values, dtype=float)
+    lengths = np.array([y - intervals[:, 0], intervals[:, 1] - y])
+    return np.clip(np.nan_to_num(lengths), 0, None)
 
 
 class ImageDisplayWidget(QWidget):
-    def __init__(self, image):
+    def __init__(self, image: QImage):
         super().__init__()
 
-        # Store the filename
         self.image = image
 
         # Create a QVBoxLayout for the widget
@@ -88,31 +128,6 @@ class ImageDisplayWidget(QWidget):
         self.display_image()
 
     def display_image(self):
-        """Load and display the image from the filename."""
-        try:
-            # Open the image using PIL
-            # pil_image = Image.open(self.filename)
-
-            # Convert the PIL image to QImage
-            qimage = self.pil_to_qimage(self.image)
-
-            # Convert QImage to QPixmap and set it to the label
-            pixmap = QPixmap.fromImage(qimage)
-            self.image_label.setPixmap(pixmap)
-
-        except Exception as e:
-            print(f"Error loading image: {e}")
-
-    def pil_to_qimage(self, pil_image):
-        """Convert a PIL image to a QImage."""
-        # Convert the PIL image to RGB mode if necessary
-        pil_image = pil_image.convert("RGB")
-
-        # Get the image dimensions and data
-        width, height = pil_image.size
-        data = pil_image.tobytes()
-
-        # Create a QImage from the data
-        qimage = QImage(data, width, height, QImage.Format.Format_RGB888)
-
-        return qimage
+        """Display the image."""
+        pixmap = QPixmap.fromImage(self.image)
+        self.image_label.setPixmap(pixmap)
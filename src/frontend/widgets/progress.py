@@ -64,7 +64,8 @@ class ProgressWidget(QWidget):
     def increment(self) -> None:
         current_count = self.progress_bar.value() + 1
         self.progress_bar.setValue(current_count)
-        self.counter.setText(f"{current_count}/{self.progress_bar.maximum()}")
+        if self.progress_bar.maximum():
+            self.counter.setText(f"{current_count}/{self.progress_bar.maximum()}")
 
     def complete(self) -> None:
         self.cancel_button.hide()
@@ -438,7 +438,7 @@ class NumberEntryWidget(QWidget):
         self.setLayout(layout)
 
     def get_value(self) -> int:
-        return int(self.input.text() or self.min_default)
+        return int(float(self.input.text() or self.min_default))
 
 
 class CheckBox(QWidget):
@@ -687,6 +687,46 @@ class MetaPropFilter(QWidget):
         self.setLayout(main_layout)
 
 
+class EntityFilter(QWidget):
+    def __init__(
+        self, filter_l: list[dict[str, Any]], remove_handle: Callable | None = None
+    ) -> None:
+        super().__init__()
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
+        self.setFixedHeight(50)
+        self.color = random_color_rgb()
+        self.setStyleSheet(f"""
+            .QWidget {{
+                border-radius: 5px;
+                border: 2px solid rgb{self.color}; 
+            }}
+        """)
+        # Sentences with any of the entities (see DatabaseManager.get_sents)
+        self.filter_l = filter_l
+        main_layout = QHBoxLayout()
+        main_layout.setContentsMargins(10, 0, 0, 0)
+        main_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
+
+        if remove_handle:
+            x_tag = SmallXButton("Remove filter")
+            x_tag.clicked.connect(remove_handle)
+            main_layout.addWidget(x_tag)
+
+        tooltip_parts = []
+        for filter_d in filter_l:
+            type_label = CorpusLabel(
+                text=filter_d.get("type") or "any type", color=self.color
+            )
+            main_layout.addWidget(type_label)
+            text = filter_d.get("text") or ""
+            if text:
+                main_layout.addWidget(QLabel(text))
+            tooltip_parts.append(f"<i>{type_label.text()}:</i> <b>{text}</b>")
+        add_tooltip(self, " ".join(tooltip_parts))
+
+        self.setLayout(main_layout)
+
+
 class ErrorDisplay(QWidget):
     def __init__(self, error: str):
         super().__init__()
@@ -0,0 +1,121 @@
+"""
+Checks that trigram candidates never drop a sentence that matches the regex.
+
+Run from the repository root with: PYTHONPATH=src python -m pytest tests
+"""
+
+import re
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from backend.db import trigrams
+from backend.db.stores import TextStore
+from backend.db.trigrams import TrigramIndex, trigram_query
+
+SENTENCES = [
+    "The cat sat on the mat.",
+    "THE CAT SAT ON THE MAT.",
+    "A dog ran after the cat yesterday.",
+    "John visited Paris yesterday.",
+    "john visited London last year.",
+    "Nobody visited Berlin.",
+    "The car sat in the garage for 12 days.",
+    "Doggg! The dogs ran and ran and ran.",
+    "xx marks the spot, xxx marks more.",
+    "Kelvin is spelled with a K sometimes: Kelvin.",
+    "Café au lait, CAFÉ AU LAIT.",
+    "Numbers: 3.14, 42 and 1000.",
+    "abcabcabc abab",
+    "Hi",
+    "",
+    "Colour or color, grey or gray.",
+]
+
+PATTERNS = [
+    # Literals
+    "cat",
+    "Paris",
+    "zzz",
+    "the mat",
+    # IGNORECASE
+    "(?i)paris",
+    "(?i)THE CAT",
+    "(?i:JOHN) visited",
+    "(?i)kelvin",
+    "(?i)Kelvin",
+    "(?i)café",
+    "(?i)SPOT",
+    # Branches
+    "(London|Paris) yesterday",
+    "Paris|Berlin",
+    "colou?r|gr[ae]y",
+    "(?i)(john|nobody) visited",
+    "(cat|dog)s? (sat|ran)",
+    # Repeats
+    "x{2}",
+    "x{3} marks",
+    "dog+",
+    "(abc){3}",
+    "(ab)+ab",
+    "ran( and ran)*",
+    "(?:ab){2,}",
+    "Do(g){3}!",
+    "a{0}cat",
+    # Classes
+    "ca[tr] sat",
+    "[Tt]he [cd]a[a-z]",
+    "[A-Z]ohn",
+    "(?i)[a-c]at",
+    "[^x]at",
+    r"\d+ days",
+    r"\bcat\b.*mat",
+    r"[\w]+ visited",
+    "t.e",
+    "a(?=t)t s",
+    r"\.",
+]
+
+
+@pytest.fixture(scope="module")
+def store_and_index():
+    encoded = [sentence.encode("utf-8") for sentence in SENTENCES]
+    offsets = np.cumsum([0] + [len(data) for data in encoded]).astype(np.int64)
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+    store = TextStore(data, offsets)
+    return store, TrigramIndex.build(store)
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_candidates_include_all_matches(store_and_index, pattern):
+    store, index = store_and_index
+    regex = re.compile(pattern)
+    matches = [i for i in range(store.size) if regex.search(store.get(i))]
+    candidates = index.candidates(pattern)
+    if candidates is None:
+        return
+    assert set(matches) <= set(candidates.tolist())
+
+
+def test_literal_patterns_are_pre_filtered(store_and_index):
+    _, index = store_and_index
+    assert index.candidates("Paris").tolist() == [3]
+    assert index.candidates("zzz").tolist() == []
+    assert index.candidates(r"\d+") is None
+
+
+def test_unexpected_parser_output_falls_back_to_full_scan(store_and_index):
+    _, index = store_and_index
+    with mock.patch.object(
+        trigrams, "_analyse_sequence", side_effect=TypeError("unknown opcode")
+    ):
+        assert trigram_query("Paris") == []
+        assert index.candidates("Paris") is None
+    with mock.patch.object(trigrams, "sre_parse", None):
+        assert index.candidates("Paris") is None
+
+
+def test_invalid_pattern_falls_back_to_full_scan(store_and_index):
+    _, index = store_and_index
+    assert index.candidates("(unclosed") is None